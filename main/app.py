@@ -1,4 +1,5 @@
 import asyncio
+import uuid
 import streamlit as st
 import aiohttp
 import sys
@@ -21,13 +22,13 @@ def _store_conversation(user, ai, cost):
         f.write(f"Assistant: {ai}\n\n")
         f.write(f"Total Cost: ${cost:.2f}\n\n")
 
-async def _get_answer(prompt, chat_history):
+async def _get_answer(prompt, conversation_id):
     """
     Makes API call to RAG engine microservice
 
     Parameters:
     - prompt: The user's input query/question which needs answering
-    - chat_history: The chat history to be used for context
+    - conversation_id: The id of the conversation, whose history is kept by the RAG engine
 
     Returns:
     - The response from the RAG engine microservice
@@ -41,7 +42,7 @@ async def _get_answer(prompt, chat_history):
         }
         json_data = {
             "user_input": prompt,
-            "history": chat_history,
+            "conversation_id": conversation_id,
             "few_shot": True,
             "format_response": True
         }
@@ -112,6 +113,8 @@ def _initialise_session_state():
         st.session_state.total_cost = 0.00
     if "messages" not in st.session_state:
         st.session_state.messages = []
+    if "conversation_id" not in st.session_state:
+        st.session_state.conversation_id = str(uuid.uuid4())
     if "processing" not in st.session_state:
         st.session_state.processing = False
     if "block_processing" not in st.session_state:
@@ -221,8 +224,7 @@ async def setup_page():
             try:
                 # Get response from RAG engine
                 with st.spinner("Gathering relevant information and synthesising response..."):
-                    chat_history = "\n".join([m["content"] for m in st.session_state.messages])
-                    response = await _get_answer(prompt, chat_history)
+                    response = await _get_answer(prompt, st.session_state.conversation_id)
                     answer = response["answer"]
                     generation_cost = response["generation_cost"]
                     retrieval_cost = response["retrieval_cost"]
@@ -239,7 +241,7 @@ async def setup_page():
                 if st.session_state.store_logs:
                     _store_conversation(prompt, response, total_cost)
 
-                # Manage chat history size
+                # Manage the size of the displayed history, the RAG engine summarises the conversation itself
                 _resize_history()
 
             except Exception as e:
@@ -252,6 +254,7 @@ async def setup_page():
 
     def clear_chat_history_callback():
         st.session_state.messages = []
+        st.session_state.conversation_id = str(uuid.uuid4())
         st.session_state.total_cost = 0.00
         _update_total_cost()
         st.rerun()
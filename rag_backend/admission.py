@@ -0,0 +1,250 @@
+import asyncio
+import hashlib
+import math
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+try:
+    from .deadline import REQUEST_DEADLINE_SECONDS
+except ImportError:
+    from deadline import REQUEST_DEADLINE_SECONDS
+
+ADMISSION_CONTROL = os.getenv("ADMISSION_CONTROL", "true").lower() == "true"
+# Pipelines a worker runs at once, and the requests which may wait for one
+ADMISSION_MAX_IN_FLIGHT = int(os.getenv("ADMISSION_MAX_IN_FLIGHT", "8"))
+ADMISSION_QUEUE_SIZE = int(os.getenv("ADMISSION_QUEUE_SIZE", "64"))
+# The time a pipeline is assumed to take until some have finished
+ADMISSION_SERVICE_SECONDS = float(os.getenv("ADMISSION_SERVICE_SECONDS", "10"))
+# The rate limit applied in process when Redis isn't available, the same as the Redis limit by default
+LOCAL_RATE_LIMIT_TIMES = int(os.getenv("LOCAL_RATE_LIMIT_TIMES", "10"))
+LOCAL_RATE_LIMIT_SECONDS = float(os.getenv("LOCAL_RATE_LIMIT_SECONDS", "60"))
+
+class AdmissionRejected(Exception):
+    """
+    A request turned away before any work was done for it, answered with status_code and a Retry-After header
+    """
+    def __init__(self, status_code, detail, retry_after):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = max(1, math.ceil(retry_after))
+
+'''
+Returns the key requests are queued fairly on, a hash of the caller's API key so keys aren't kept in memory
+'''
+def admission_key(api_key):
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+
+class AdmissionTicket:
+    """
+    A request's slot, released once its pipeline has finished. Releasing more than once does nothing, so
+    streamed responses can release from wherever they end.
+    """
+    def __init__(self, controller):
+        self.controller = controller
+        self.start = time.monotonic()
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.controller._release(time.monotonic() - self.start)
+
+class AdmissionController:
+    """
+    Caps the pipelines a worker runs at once. Requests over the cap wait in a bounded queue, served round robin
+    across keys so one busy caller can't starve the others. Requests are turned away with a 503 straight away when
+    the queue is full, or when the estimated wait plus the time a pipeline takes would run past the request's
+    deadline, rather than every request slowing down together under a burst.
+
+    Parameters:
+    - max_in_flight: The pipelines run at once
+    - queue_size: The requests which may wait
+    - service_seconds: The initial estimate of a pipeline's duration, then a moving average of finished pipelines
+    """
+    def __init__(self, max_in_flight=ADMISSION_MAX_IN_FLIGHT, queue_size=ADMISSION_QUEUE_SIZE, service_seconds=ADMISSION_SERVICE_SECONDS):
+        self.max_in_flight = max_in_flight
+        self.queue_size = queue_size
+        self.service_seconds = service_seconds
+        self.in_flight = 0
+        self._waiters = OrderedDict()
+        self.waiting = 0
+        self.admitted = 0
+        self.queued = 0
+        self.shed = 0
+
+    '''
+    Waits for a slot
+
+    Parameters:
+    - key: The caller's key, see admission_key
+    - deadline_seconds: The request's end-to-end budget
+
+    Returns:
+    - The AdmissionTicket to release once the pipeline has finished
+
+    Raises:
+    - AdmissionRejected: When the request can't be started in time
+    '''
+    async def acquire(self, key, deadline_seconds=REQUEST_DEADLINE_SECONDS):
+        if self.in_flight < self.max_in_flight and not self.waiting:
+            return self._admit()
+        if self.waiting >= self.queue_size:
+            self._reject(self.estimated_wait(key), "The server is too busy, please try again later")
+        wait = self.estimated_wait(key)
+        if wait + self.service_seconds > deadline_seconds:
+            self._reject(wait, "The server is too busy to answer in time, please try again later")
+
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(key, deque()).append(future)
+        self.waiting += 1
+        self.queued += 1
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout=max(deadline_seconds - self.service_seconds, 0))
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if future.done() and not future.cancelled():
+                # The slot was handed over as the wait ended, so it is passed on rather than lost
+                self._release(None)
+            else:
+                future.cancel()
+                self._remove(key, future)
+            if isinstance(e, asyncio.TimeoutError):
+                self._reject(self.service_seconds, "The server is too busy to answer in time, please try again later")
+            raise
+        self.admitted += 1
+        return AdmissionTicket(self)
+
+    '''
+    Estimates how long a new request from a key would wait. Round robin serves min(waiting, position) requests
+    from every other key before it, and a slot frees up every service_seconds / max_in_flight on average.
+    '''
+    def estimated_wait(self, key):
+        position = len(self._waiters.get(key, ())) + 1
+        ahead = sum(min(len(waiters), position) for waiter_key, waiters in self._waiters.items() if waiter_key != key)
+        ahead += position - 1
+        return (ahead + 1) * self.service_seconds / self.max_in_flight
+
+    def stats(self):
+        return {
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "max_in_flight": self.max_in_flight,
+            "service_ms": round(self.service_seconds * 1000, 2),
+            "admitted": self.admitted,
+            "queued": self.queued,
+            "shed": self.shed,
+        }
+
+    def _admit(self):
+        self.in_flight += 1
+        self.admitted += 1
+        return AdmissionTicket(self)
+
+    def _reject(self, retry_after, detail):
+        self.shed += 1
+        raise AdmissionRejected(503, detail, retry_after)
+
+    # Hands the slot to the next waiter round robin, or frees it. duration is None when no pipeline ran in it.
+    def _release(self, duration):
+        if duration is not None:
+            self.service_seconds += 0.2 * (duration - self.service_seconds)
+        while self._waiters:
+            key, waiters = next(iter(self._waiters.items()))
+            future = waiters.popleft()
+            self.waiting -= 1
+            del self._waiters[key]
+            if waiters:
+                self._waiters[key] = waiters
+            if not future.done():
+                future.set_result(None)
+                return
+        self.in_flight -= 1
+
+    def _remove(self, key, future):
+        waiters = self._waiters.get(key)
+        if waiters is None or future not in waiters:
+            return
+        waiters.remove(future)
+        self.waiting -= 1
+        if not waiters:
+            del self._waiters[key]
+
+class TokenBucket:
+    """
+    Allows capacity requests at once, refilled at capacity / period per second
+
+    Parameters:
+    - capacity: The burst size
+    - period: The seconds over which the bucket refills completely
+    """
+    def __init__(self, capacity, period):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    '''
+    Takes a token, returning 0 if there was one or otherwise the seconds until there will be
+    '''
+    def take(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+class LocalRateLimiter:
+    """
+    In-process stand-in for fastapi_limiter's RateLimiter, used when Redis isn't available. Callers are identified
+    the same way (forwarded IP and path), limits apply per worker.
+
+    Parameters:
+    - times: The requests allowed per period
+    - seconds: The period
+    - max_keys: The callers tracked, the least recently seen are forgotten
+    """
+    def __init__(self, times=LOCAL_RATE_LIMIT_TIMES, seconds=LOCAL_RATE_LIMIT_SECONDS, max_keys=10000):
+        self.times = times
+        self.seconds = seconds
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    async def __call__(self, request, response):
+        forwarded = request.headers.get("X-Forwarded-For")
+        client = forwarded.split(",")[0] if forwarded else (request.client.host if request.client else "")
+        key = f"{client}:{request.scope['path']}"
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(self.times, self.seconds)
+                if len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+            self._buckets.move_to_end(key)
+            retry_after = bucket.take()
+        if retry_after:
+            raise AdmissionRejected(429, "Too Many Requests", retry_after)
+
+_controller = None
+_rate_limiter = None
+
+'''
+Returns the worker's AdmissionController, or None when ADMISSION_CONTROL is off
+'''
+def get_admission_controller():
+    global _controller
+    if not ADMISSION_CONTROL:
+        return None
+    if _controller is None:
+        _controller = AdmissionController()
+    return _controller
+
+def get_local_rate_limiter():
+    global _rate_limiter
+    if _rate_limiter is None:
+        _rate_limiter = LocalRateLimiter()
+    return _rate_limiter
@@ -0,0 +1,68 @@
+"""
+Micro-benchmark of rank fusion over synthetic multi-query results, comparing the original tuple-keyed
+implementation (which hashed each split's full text and rebuilt the documents) with rank_fusion.py.
+
+python rag_backend/benchmarks/fusion_benchmark.py --variants 10 --k 200 --repeat 20
+"""
+
+import argparse
+import os
+import random
+import sys
+import timeit
+
+from langchain_core.documents import Document
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from rank_fusion import reciprocal_rank_fusion
+
+# The fusion from QueryTranslator before rank_fusion.py, kept here as the baseline
+def legacy_reciprocal_rank_fusion(result_docs, k=60):
+    def serialise(doc):
+        m = doc.metadata
+        return (m.get("chunk_index"), m.get("split_index"), m.get("video_id"), m.get("video_title"), m.get("video_url"), doc.page_content)
+    fused_scores = {}
+    for docs in result_docs:
+        for rank, doc in enumerate(docs):
+            key = serialise(doc)
+            fused_scores[key] = fused_scores.get(key, 0) + 1 / (rank + k)
+    ranked = sorted(fused_scores.items(), key=lambda x: x[1], reverse=True)
+    return [
+        Document(page_content=t[5], metadata={"chunk_index": t[0], "split_index": t[1], "video_id": t[2], "video_title": t[3], "video_url": t[4]})
+        for t, _ in ranked
+    ]
+
+'''
+Builds result lists the way the retriever returns them. Every search creates fresh Document objects,
+and the lists overlap because the variants are paraphrases of one question.
+'''
+def synthetic_results(variants, k, corpus_size, text_length, seed=0):
+    rng = random.Random(seed)
+    texts = ["".join(rng.choices("abcdefghijklmnopqrstuvwxyz ", k=text_length)) for _ in range(corpus_size)]
+    def make(i):
+        video = i // 50
+        # A new string per result, as a deserialised search response would have, so its hash isn't cached
+        return Document(page_content=(texts[i] + " ")[:-1], metadata={
+            "video_id": f"video{video}", "chunk_index": float(i % 50 // 10), "split_index": float(i % 10),
+            "video_title": f"Episode {video}", "video_url": f"https://www.youtube.com/watch?v=video{video}"
+        })
+    return [[make(i) for i in rng.sample(range(corpus_size), k)] for _ in range(variants)]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--variants", type=int, default=10)
+    parser.add_argument("--k", type=int, default=200)
+    parser.add_argument("--corpus", type=int, default=2000)
+    parser.add_argument("--text-length", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    results = synthetic_results(args.variants, args.k, max(args.corpus, args.k), args.text_length)
+    legacy = legacy_reciprocal_rank_fusion(results)
+    fused = [r.document for r in reciprocal_rank_fusion(results)]
+    assert [d.page_content for d in legacy] == [d.page_content for d in fused], "Both implementations should rank identically"
+
+    print(f"{args.variants} variants x k={args.k}, {args.text_length} character splits, {len(fused)} unique documents")
+    for name, fn in (("legacy tuple keys", legacy_reciprocal_rank_fusion), ("rank_fusion", reciprocal_rank_fusion)):
+        best = min(timeit.repeat(lambda: fn(results), number=1, repeat=args.repeat))
+        print(f"{name:>18}: {best * 1000:8.2f} ms")
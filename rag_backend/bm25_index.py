@@ -0,0 +1,166 @@
+"""
+BM25 keyword index over the split text of a local snapshot (see local_vector_index.py). It is stored in the
+snapshot's bm25/ folder as an inverted index in CSR form, opened with mmap like the vectors:
+- vocab.json: term to term id
+- offsets.npy: int64, the postings of term t are at offsets[t]:offsets[t + 1]
+- postings_rows.npy: int32 snapshot rows, postings_tf.npy: uint16 term frequencies
+- doc_lengths.npy: uint32 tokens per row
+- idf.npy: float32 inverse document frequency per term
+
+Exact terms (compound names, protocols, guest names) are where dense retrieval struggles, so tokens aren't stemmed.
+"""
+
+import argparse
+import json
+import os
+import re
+import sqlite3
+from collections import Counter
+
+import numpy as np
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+STOPWORDS = frozenset("""
+a about after all also am an and any are as at be because been but by can could did do does doing for from
+had has have having he her here him his how i if in into is it its just me more most my no not of on or our
+out over she so some such than that the their them then there these they this those to too up very was we
+were what when where which while who whom why will with would you your
+""".split())
+DEFAULT_K1 = 1.2
+DEFAULT_B = 0.75
+BM25_DIR = "bm25"
+
+'''
+Splits text into lowercase alphanumeric terms, dropping stopwords
+'''
+def tokenize(text):
+    return [token for token in TOKEN_PATTERN.findall(text.lower()) if token not in STOPWORDS]
+
+class BM25Index:
+    """
+    Okapi BM25 over an inverted index. Rows are the snapshot rows of the splits, so results can be
+    turned into documents with the snapshot's metadata.
+
+    Parameters:
+    - vocab: Term to term id
+    - offsets, postings_rows, postings_tf: The postings lists in CSR form
+    - doc_lengths: The number of terms in each row
+    - idf: The inverse document frequency of each term
+    - k1, b: The BM25 term frequency saturation and length normalisation parameters
+    """
+    def __init__(self, vocab, offsets, postings_rows, postings_tf, doc_lengths, idf, k1=DEFAULT_K1, b=DEFAULT_B):
+        self.vocab = vocab
+        self.offsets = offsets
+        self.postings_rows = postings_rows
+        self.postings_tf = postings_tf
+        self.doc_lengths = doc_lengths
+        self.idf = idf
+        self.k1 = k1
+        self.b = b
+        self.avg_doc_length = float(doc_lengths.mean()) if len(doc_lengths) else 0.0
+
+    '''
+    Returns up to k (row, score) pairs for the query, best first. Only the postings of the query's terms are touched.
+    '''
+    def search(self, query, k=5):
+        term_ids = [self.vocab[term] for term in dict.fromkeys(tokenize(query)) if term in self.vocab]
+        if not term_ids or k <= 0:
+            return []
+        rows = []
+        contributions = []
+        for term_id in term_ids:
+            start, end = self.offsets[term_id], self.offsets[term_id + 1]
+            term_rows = np.asarray(self.postings_rows[start:end])
+            tf = np.asarray(self.postings_tf[start:end], dtype=np.float32)
+            lengths = np.asarray(self.doc_lengths[term_rows], dtype=np.float32)
+            norm = self.k1 * (1.0 - self.b + self.b * lengths / self.avg_doc_length)
+            rows.append(term_rows)
+            contributions.append(self.idf[term_id] * tf * (self.k1 + 1.0) / (tf + norm))
+        unique_rows, inverse = np.unique(np.concatenate(rows), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(contributions)).astype(np.float32)
+        k = min(k, len(unique_rows))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [(int(unique_rows[i]), float(scores[i])) for i in top]
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, "vocab.json"), "w", encoding="utf-8") as f:
+            json.dump(self.vocab, f)
+        for name in ("offsets", "postings_rows", "postings_tf", "doc_lengths", "idf"):
+            np.save(os.path.join(path, f"{name}.npy"), getattr(self, name))
+        with open(os.path.join(path, "params.json"), "w") as f:
+            json.dump({"k1": self.k1, "b": self.b}, f)
+
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, "vocab.json"), encoding="utf-8") as f:
+            vocab = json.load(f)
+        with open(os.path.join(path, "params.json")) as f:
+            params = json.load(f)
+        arrays = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+                  for name in ("offsets", "postings_rows", "postings_tf", "doc_lengths", "idf")}
+        return cls(vocab, **arrays, **params)
+
+'''
+Builds the index from the split texts
+
+Parameters:
+- texts: The text of each row, in row order
+
+Returns:
+- The BM25Index
+'''
+def build_bm25_index(texts, k1=DEFAULT_K1, b=DEFAULT_B):
+    vocab = {}
+    term_ids = []
+    rows = []
+    tfs = []
+    doc_lengths = []
+    for row, text in enumerate(texts):
+        tokens = tokenize(text)
+        doc_lengths.append(len(tokens))
+        for term, count in Counter(tokens).items():
+            term_ids.append(vocab.setdefault(term, len(vocab)))
+            rows.append(row)
+            tfs.append(min(count, np.iinfo(np.uint16).max))
+
+    term_ids = np.asarray(term_ids, dtype=np.int64)
+    order = np.argsort(term_ids, kind="stable")
+    document_frequency = np.bincount(term_ids, minlength=len(vocab))
+    offsets = np.zeros(len(vocab) + 1, dtype=np.int64)
+    np.cumsum(document_frequency, out=offsets[1:])
+    doc_count = len(doc_lengths)
+    idf = np.log(1.0 + (doc_count - document_frequency + 0.5) / (document_frequency + 0.5)).astype(np.float32)
+    return BM25Index(
+        vocab,
+        offsets,
+        np.asarray(rows, dtype=np.int32)[order],
+        np.asarray(tfs, dtype=np.uint16)[order],
+        np.asarray(doc_lengths, dtype=np.uint32),
+        idf,
+        k1=k1,
+        b=b
+    )
+
+'''
+Builds and saves the index for a snapshot directory from the split text in its metadata.db
+'''
+def build_snapshot_bm25(snapshot_path, text_key="text"):
+    conn = sqlite3.connect(os.path.join(snapshot_path, "metadata.db"))
+    try:
+        texts = (json.loads(metadata).get(text_key, "") for (metadata,) in conn.execute("SELECT metadata FROM splits ORDER BY row"))
+        index = build_bm25_index(texts)
+    finally:
+        conn.close()
+    index.save(os.path.join(snapshot_path, BM25_DIR))
+    return index
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the BM25 index for a local snapshot which doesn't have one")
+    parser.add_argument("--root", default=os.getenv("LOCAL_INDEX_DIR"), help="The local index root directory")
+    args = parser.parse_args()
+    with open(os.path.join(args.root, "CURRENT")) as f:
+        snapshot_name = f.read().strip()
+    built = build_snapshot_bm25(os.path.join(args.root, "snapshots", snapshot_name))
+    print(f"Built BM25 index for snapshot {snapshot_name} with {len(built.vocab)} terms")
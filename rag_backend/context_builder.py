@@ -0,0 +1,78 @@
+import os
+from html import escape
+
+try:
+    from .neighbour_expansion import LAST_SPLIT_KEY
+except ImportError:
+    from neighbour_expansion import LAST_SPLIT_KEY
+
+DEFAULT_CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))
+DEFAULT_CONTEXT_MAX_DOCUMENTS = int(os.getenv("CONTEXT_MAX_DOCUMENTS", "10"))
+
+'''
+Serialises retrieved documents into the compact tagged context passed to the generation prompt.
+Splits are grouped by video so each title and url appears once, and documents are taken in rank order
+until the token budget or the document cap is reached. Within a video, splits are ordered by their
+position in the transcript so adjacent splits read naturally. Passages merged by neighbour expansion
+are tagged with the range of splits they cover.
+
+Parameters:
+- documents: The retrieved documents, best first
+- tokenizer: The tiktoken encoding used to measure the context
+- max_tokens: The input token budget for the context
+- max_documents: The maximum number of splits to include
+- span: An optional tracing span to record the size of the context on
+
+Returns:
+- The context string
+'''
+def build_context(documents, tokenizer, max_tokens=DEFAULT_CONTEXT_TOKEN_BUDGET, max_documents=DEFAULT_CONTEXT_MAX_DOCUMENTS, span=None):
+    videos = {}
+    used_tokens = 0
+    selected = 0
+    for doc in documents:
+        if selected >= max_documents:
+            break
+        video_key = doc.metadata.get("video_id") or doc.metadata.get("video_url")
+        split = _format_split(doc)
+        cost = len(tokenizer.encode(split))
+        if video_key not in videos:
+            cost += len(tokenizer.encode(_format_video_open(doc) + "</video>\n"))
+        # Skip rather than stop, a shorter lower ranked split may still fit
+        if used_tokens + cost > max_tokens:
+            continue
+        if video_key not in videos:
+            videos[video_key] = (_format_video_open(doc), [])
+        videos[video_key][1].append((_position(doc), split))
+        used_tokens += cost
+        selected += 1
+    if span is not None:
+        span.set(candidates=len(documents), documents=selected, videos=len(videos), tokens=used_tokens)
+
+    parts = []
+    for video_open, splits in videos.values():
+        parts.append(video_open)
+        parts.extend(split for _, split in sorted(splits, key=lambda item: item[0]))
+        parts.append("</video>\n")
+    return "".join(parts)
+
+def _format_video_open(doc):
+    title = escape(str(doc.metadata.get("video_title", "")))
+    url = escape(str(doc.metadata.get("video_url", "")))
+    return f'<video title="{title}" url="{url}">\n'
+
+def _format_split(doc):
+    chunk_index, split_index = _position(doc)
+    if LAST_SPLIT_KEY in doc.metadata:
+        return f'<split chunk="{chunk_index}" index="{split_index}" to="{_as_int(doc.metadata[LAST_SPLIT_KEY])}">{doc.page_content}</split>\n'
+    return f'<split chunk="{chunk_index}" index="{split_index}">{doc.page_content}</split>\n'
+
+# Pinecone returns numeric metadata as floats, so indices are normalised to ints
+def _position(doc):
+    return (_as_int(doc.metadata.get("chunk_index")), _as_int(doc.metadata.get("split_index")))
+
+def _as_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 0
@@ -0,0 +1,223 @@
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+# The end-to-end budget of a request, each stage is given a slice of what is left when it starts
+REQUEST_DEADLINE_SECONDS = float(os.getenv("REQUEST_DEADLINE_SECONDS", "45"))
+# The share of the remaining budget given to retrieval, generation gets whatever retrieval leaves
+RETRIEVAL_BUDGET_SHARE = float(os.getenv("RETRIEVAL_BUDGET_SHARE", "0.4"))
+# Multi-query retrieval is skipped when retrieval gets less than this
+MULTI_QUERY_MIN_SECONDS = float(os.getenv("MULTI_QUERY_MIN_SECONDS", "4"))
+
+HEDGING_ENABLED = os.getenv("HEDGING_ENABLED", "true").lower() == "true"
+# A second attempt is sent once the first has taken longer than this percentile of recent calls
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "95"))
+# Calls are never hedged sooner than this, so fast upstreams aren't hedged on noise
+HEDGE_MIN_DELAY_SECONDS = float(os.getenv("HEDGE_MIN_DELAY_SECONDS", "0.05"))
+# Latencies kept per upstream, and the number needed before hedging starts
+HEDGE_WINDOW = int(os.getenv("HEDGE_WINDOW", "1000"))
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "50"))
+
+class Deadline:
+    """
+    The time budget of one request. Created per request alongside RequestCosts and RequestTrace and passed down
+    to the stages, which take a slice of what is left rather than a fixed timeout.
+
+    Parameters:
+    - seconds: The budget from now
+    """
+    def __init__(self, seconds=REQUEST_DEADLINE_SECONDS):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self):
+        return max(self.expires_at - time.monotonic(), 0.0)
+
+    @property
+    def expired(self):
+        return self.remaining() <= 0
+
+    '''
+    Returns the time given to a stage, a share of the remaining budget
+    '''
+    def slice(self, share):
+        return self.remaining() * share
+
+class Timeout:
+    """
+    Async context manager bounding the time spent in its block, like asyncio.timeout which only exists from
+    Python 3.11. When the time runs out the task is cancelled and asyncio.TimeoutError is raised out of the block.
+
+    Parameters:
+    - seconds: The time allowed, None for no limit
+    """
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.expired = False
+        self._task = None
+        self._handle = None
+
+    async def __aenter__(self):
+        if self.seconds is not None:
+            self._task = asyncio.current_task()
+            self._handle = asyncio.get_running_loop().call_later(self.seconds, self._expire)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.disarm()
+        if self.expired and exc_type is asyncio.CancelledError:
+            # The cancellation was ours, so it isn't counted against the task (Python 3.11+)
+            if hasattr(self._task, "uncancel"):
+                self._task.uncancel()
+            raise asyncio.TimeoutError() from None
+        return False
+
+    '''
+    Stops the timer, the rest of the block runs without a limit
+    '''
+    def disarm(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def _expire(self):
+        self.expired = True
+        self._task.cancel()
+
+class LatencyTracker:
+    """
+    Rolling window of an upstream's latencies, giving the percentile used as the hedging delay
+    """
+    def __init__(self, window=HEDGE_WINDOW, min_samples=HEDGE_MIN_SAMPLES):
+        self.min_samples = min_samples
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    '''
+    Returns the latency percentile in seconds, or None until there are enough samples
+    '''
+    def percentile(self, q):
+        with self._lock:
+            if len(self._samples) < self.min_samples:
+                return None
+            samples = np.fromiter(self._samples, dtype=np.float64, count=len(self._samples))
+        return float(np.percentile(samples, q))
+
+class Hedger:
+    """
+    Hedged requests to an idempotent upstream. When the first attempt takes longer than the upstream's recent
+    p95, an identical second attempt is sent and whichever succeeds first is used, the other is cancelled.
+    Only the slowest ~5% of calls are duplicated, so the tail is cut for a small increase in load.
+
+    Parameters:
+    - name: The upstream's name, used for stats
+    - percentile: The latency percentile after which a second attempt is sent
+    - min_delay: The shortest hedging delay
+    - enabled: Whether to hedge at all, latencies are tracked either way
+    """
+    def __init__(self, name, percentile=HEDGE_PERCENTILE, min_delay=HEDGE_MIN_DELAY_SECONDS, enabled=HEDGING_ENABLED, tracker=None):
+        self.name = name
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.enabled = enabled
+        self.tracker = tracker if tracker is not None else LatencyTracker()
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    '''
+    Returns the current hedging delay, or None when calls shouldn't be hedged
+    '''
+    def delay(self):
+        if not self.enabled:
+            return None
+        latency = self.tracker.percentile(self.percentile)
+        return None if latency is None else max(latency, self.min_delay)
+
+    '''
+    Calls the upstream, hedging it if the first attempt is slow
+
+    Parameters:
+    - attempt: A callable returning a new awaitable for each attempt
+
+    Returns:
+    - The result of the first attempt to succeed
+    '''
+    async def call(self, attempt):
+        with self._lock:
+            self.calls += 1
+        delay = self.delay()
+        first = asyncio.ensure_future(self._timed(attempt))
+        second = None
+        try:
+            if delay is not None:
+                done, _ = await asyncio.wait({first}, timeout=delay)
+                if not done:
+                    second = asyncio.ensure_future(self._timed(attempt))
+                    with self._lock:
+                        self.hedged += 1
+                    return await self._first_success(first, second)
+            return await first
+        finally:
+            for task in (first, second):
+                if task is not None and not task.done():
+                    task.cancel()
+
+    async def _first_success(self, first, second):
+        pending = {first, second}
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is second:
+                        with self._lock:
+                            self.hedge_wins += 1
+                    return task.result()
+                error = task.exception()
+        raise error
+
+    # Cancelled attempts are recorded too, otherwise the slowest calls would drop out of the window and the delay would creep down
+    async def _timed(self, attempt):
+        start = time.perf_counter()
+        try:
+            return await attempt()
+        finally:
+            self.tracker.record(time.perf_counter() - start)
+
+    def stats(self):
+        delay = self.delay()
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "hedged": self.hedged,
+                "hedge_wins": self.hedge_wins,
+                "delay_ms": None if delay is None else round(delay * 1000, 2),
+            }
+
+_hedgers = {}
+_lock = threading.Lock()
+
+'''
+Returns the process-wide Hedger for an upstream, so its latency window covers every request
+'''
+def get_hedger(name):
+    hedger = _hedgers.get(name)
+    if hedger is None:
+        with _lock:
+            hedger = _hedgers.get(name)
+            if hedger is None:
+                hedger = _hedgers[name] = Hedger(name)
+    return hedger
+
+def get_hedging_stats():
+    return {name: hedger.stats() for name, hedger in list(_hedgers.items())}
@@ -0,0 +1,109 @@
+import os
+
+import numpy as np
+
+try:
+    from .rank_fusion import document_key
+except ImportError:
+    from rank_fusion import document_key
+
+DIVERSE_SELECTION = os.getenv("DIVERSE_SELECTION", "false").lower() == "true"
+# Candidates fetched (with their vectors) per search, and the number of splits kept after selection
+DIVERSITY_FETCH_K = int(os.getenv("DIVERSITY_FETCH_K", "20"))
+DIVERSITY_K = int(os.getenv("DIVERSITY_K", "6"))
+# 1.0 ranks on relevance alone, lower values favour splits unlike the ones already selected
+DIVERSITY_LAMBDA = float(os.getenv("DIVERSITY_LAMBDA", "0.7"))
+MAX_SPLITS_PER_VIDEO = int(os.getenv("MAX_SPLITS_PER_VIDEO", "2"))
+# Cosine similarity above which a split is treated as a near-duplicate of one already selected
+DUPLICATE_SIMILARITY = float(os.getenv("DUPLICATE_SIMILARITY", "0.95"))
+
+'''
+Maximal Marginal Relevance over a candidate matrix. Each step picks the candidate maximising
+lambda * relevance - (1 - lambda) * (highest similarity to anything already selected), updating the
+similarities for every candidate at once.
+
+Parameters:
+- vectors: An (n, dimensions) matrix of unit-normalised candidate vectors, zero rows for unknown vectors
+- relevance: The relevance of each candidate to the question, higher is better
+- k: The number of candidates to select
+- lambda_mult: The relevance / diversity trade-off
+- groups: An optional group per candidate (e.g. video id)
+- max_per_group: The most candidates selected from one group, None for no cap
+- duplicate_threshold: Candidates at least this similar to a selected one are dropped, None to keep them
+
+Returns:
+- The selected indices in selection order, and the number of candidates dropped as near-duplicates
+'''
+def mmr_select(vectors, relevance, k, lambda_mult=DIVERSITY_LAMBDA, groups=None, max_per_group=None, duplicate_threshold=None):
+    n = len(relevance)
+    relevance = np.asarray(relevance, dtype=np.float32)
+    similarities = vectors @ vectors.T
+    max_similarity = np.zeros(n, dtype=np.float32)
+    available = np.ones(n, dtype=bool)
+    group_counts = {}
+    selected = []
+    duplicates = 0
+    while len(selected) < k and available.any():
+        scores = lambda_mult * relevance - (1.0 - lambda_mult) * max_similarity
+        scores[~available] = -np.inf
+        pick = int(np.argmax(scores))
+        available[pick] = False
+        if groups is not None and max_per_group is not None:
+            if group_counts.get(groups[pick], 0) >= max_per_group:
+                continue
+            group_counts[groups[pick]] = group_counts.get(groups[pick], 0) + 1
+        selected.append(pick)
+        max_similarity = np.maximum(max_similarity, similarities[pick])
+        if duplicate_threshold is not None:
+            near_duplicates = available & (similarities[pick] >= duplicate_threshold)
+            duplicates += int(near_duplicates.sum())
+            available &= ~near_duplicates
+    return selected, duplicates
+
+'''
+Selects a diverse subset of retrieved documents, capping splits per video and dropping near-duplicates
+
+Parameters:
+- documents: The retrieved documents, best first
+- vectors: The vector of each document by document_key, documents without one are never treated as duplicates
+- query_vector: The question's embedding; relevance is the cosine similarity to it when given,
+  otherwise it falls with the documents' rank (e.g. after rank fusion)
+- k: The number of documents to keep
+- span: An optional tracing span to record the selection on
+
+Returns:
+- The selected documents, in selection order
+'''
+def select_diverse(documents, vectors, query_vector=None, k=DIVERSITY_K, lambda_mult=DIVERSITY_LAMBDA,
+                   max_per_video=MAX_SPLITS_PER_VIDEO, duplicate_threshold=DUPLICATE_SIMILARITY, span=None):
+    if not documents:
+        return []
+    candidate_vectors = [vectors.get(document_key(doc)) for doc in documents]
+    dimensions = next((len(v) for v in candidate_vectors if v is not None), 0)
+    matrix = np.zeros((len(documents), dimensions), dtype=np.float32)
+    for row, vector in enumerate(candidate_vectors):
+        if vector is not None:
+            matrix[row] = vector
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    np.divide(matrix, norms, out=matrix, where=norms > 0)
+
+    if query_vector is not None and dimensions and all(v is not None for v in candidate_vectors):
+        query = np.asarray(query_vector, dtype=np.float32)
+        relevance = matrix @ (query / (np.linalg.norm(query) or 1.0))
+    else:
+        relevance = 1.0 - np.arange(len(documents), dtype=np.float32) / len(documents)
+
+    selected, duplicates = mmr_select(
+        matrix,
+        relevance,
+        k,
+        lambda_mult=lambda_mult,
+        groups=[doc.metadata.get("video_id") for doc in documents],
+        max_per_group=max_per_video or None,
+        duplicate_threshold=duplicate_threshold
+    )
+    result = [documents[i] for i in selected]
+    if span is not None:
+        span.set(candidates=len(documents), selected=len(result), duplicates=duplicates,
+                 videos=len({doc.metadata.get("video_id") for doc in result}))
+    return result
@@ -0,0 +1,266 @@
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import List
+
+import numpy as np
+import redis
+from langchain_core.embeddings import Embeddings
+
+try:
+    from .deadline import get_hedger
+    from .executors import ExecutorSaturatedError, get_executor
+    from .logger import logger as logger
+except ImportError:
+    from deadline import get_hedger
+    from executors import ExecutorSaturatedError, get_executor
+    from logger import logger as logger
+
+DEFAULT_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "4096"))
+DEFAULT_SHARED_TTL_SECONDS = int(os.getenv("EMBEDDING_CACHE_TTL", str(30 * 24 * 3600)))
+
+'''
+Normalises text so trivially different inputs (whitespace, unicode forms) share a cache entry
+'''
+def normalise_text(text):
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFKC", text)).strip()
+
+'''
+Returns the cache key for a text embedded with the given model
+'''
+def embedding_cache_key(text, model):
+    return hashlib.sha256(f"{model}\0{normalise_text(text)}".encode("utf-8")).hexdigest()
+
+# Vectors are stored as raw float32 bytes, 4 bytes per dimension rather than a JSON list of floats
+def vector_to_bytes(vector):
+    return np.asarray(vector, dtype=np.float32).tobytes()
+
+def bytes_to_vector(data):
+    return np.frombuffer(data, dtype=np.float32).tolist()
+
+class MemoryEmbeddingStore:
+    """
+    In-process LRU of embedding bytes
+    """
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_many(self, keys):
+        found = {}
+        with self._lock:
+            for key in keys:
+                data = self._entries.get(key)
+                if data is not None:
+                    self._entries.move_to_end(key)
+                    found[key] = data
+        return found
+
+    def set_many(self, items):
+        with self._lock:
+            for key, data in items.items():
+                self._entries[key] = data
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+class SQLiteEmbeddingStore:
+    """
+    Shared tier backed by a local SQLite file, shared by every worker process on the host
+    """
+    def __init__(self, path):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+        self._conn.commit()
+        self._lock = threading.Lock()
+
+    def get_many(self, keys):
+        if not keys:
+            return {}
+        placeholders = ",".join("?" for _ in keys)
+        with self._lock:
+            rows = self._conn.execute(f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", list(keys)).fetchall()
+        return {key: bytes(data) for key, data in rows}
+
+    def set_many(self, items):
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)", list(items.items()))
+            self._conn.commit()
+
+class RedisEmbeddingStore:
+    """
+    Shared tier backed by Redis, shared by every worker and host
+    """
+    def __init__(self, url, ttl_seconds=DEFAULT_SHARED_TTL_SECONDS, prefix="emb:"):
+        self._client = redis.Redis.from_url(url, ssl_cert_reqs=None) if url.startswith("rediss://") else redis.Redis.from_url(url)
+        self.ttl_seconds = ttl_seconds
+        self.prefix = prefix
+
+    def get_many(self, keys):
+        if not keys:
+            return {}
+        values = self._client.mget([self.prefix + key for key in keys])
+        return {key: value for key, value in zip(keys, values) if value is not None}
+
+    def set_many(self, items):
+        pipeline = self._client.pipeline(transaction=False)
+        for key, data in items.items():
+            pipeline.set(self.prefix + key, data, ex=self.ttl_seconds)
+        pipeline.execute()
+
+'''
+Creates the shared tier from a URL, redis://, rediss:// or sqlite:///path/to/file.db
+'''
+def create_shared_store(url):
+    if url.startswith(("redis://", "rediss://")):
+        return RedisEmbeddingStore(url)
+    if url.startswith("sqlite:///"):
+        return SQLiteEmbeddingStore(url[len("sqlite:///"):])
+    raise ValueError(f"Unsupported embedding cache URL: {url}")
+
+class CachedEmbeddings(Embeddings):
+    """
+    Caching wrapper around an embedding model, with an in-process LRU in front of an optional shared tier.
+    Keys are the normalised text plus the model name. Queries and documents share entries, which holds for
+    OpenAI embeddings where embed_query is embed_documents on a single text.
+    Failures in the shared tier are logged and treated as misses, they never fail a request.
+
+    Parameters:
+    - embeddings: The underlying embedding model
+    - model: The name of the embedding model, part of every key
+    - memory_store: The in-process tier
+    - shared_store: The optional shared tier (Redis or SQLite)
+    """
+    def __init__(self, embeddings, model, memory_store, shared_store=None):
+        self.embeddings = embeddings
+        self.model = model
+        self.memory_store = memory_store
+        self.shared_store = shared_store
+        self.memory_hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [embedding_cache_key(text, self.model) for text in texts]
+        found = self._lookup_memory(keys)
+        if self.shared_store:
+            found.update(self._lookup_shared(self._missing(keys, found)))
+        missing = self._missing_texts(texts, keys, found)
+        if missing:
+            vectors = self.embeddings.embed_documents(list(missing.values()))
+            computed = self._remember(list(missing.keys()), vectors)
+            found.update(computed)
+            if self.shared_store:
+                self._write_shared(computed)
+        return [bytes_to_vector(found[key]) for key in keys]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+    '''
+    Embeds texts through the cache. When a tracing span is given, the cache hits and misses of this call are recorded on it.
+    '''
+    async def aembed_documents(self, texts: List[str], span=None) -> List[List[float]]:
+        keys = [embedding_cache_key(text, self.model) for text in texts]
+        found = self._lookup_memory(keys)
+        memory_hits = len(found)
+        if self.shared_store:
+            found.update(await self._arun_shared(self._lookup_shared, self._missing(keys, found), {}))
+        missing = self._missing_texts(texts, keys, found)
+        if span is not None:
+            span.set(texts=len(texts), memory_hits=memory_hits, shared_hits=len(found) - memory_hits, misses=len(missing))
+        if missing:
+            vectors = await get_hedger("embedding").call(lambda: self.embeddings.aembed_documents(list(missing.values())))
+            computed = self._remember(list(missing.keys()), vectors)
+            found.update(computed)
+            if self.shared_store:
+                await self._arun_shared(self._write_shared, computed, None)
+        return [bytes_to_vector(found[key]) for key in keys]
+
+    async def aembed_query(self, text: str, span=None) -> List[float]:
+        return (await self.aembed_documents([text], span=span))[0]
+
+    def stats(self):
+        lookups = self.memory_hits + self.shared_hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "shared_hits": self.shared_hits,
+            "misses": self.misses,
+            "hit_rate": (self.memory_hits + self.shared_hits) / lookups if lookups else 0.0,
+        }
+
+    def _lookup_memory(self, keys):
+        found = self.memory_store.get_many(keys)
+        self.memory_hits += len(found)
+        return found
+
+    def _lookup_shared(self, keys):
+        if not keys:
+            return {}
+        try:
+            found = self.shared_store.get_many(keys)
+        except Exception as e:
+            logger.warning(f"Embedding cache shared tier lookup failed: {e}")
+            return {}
+        self.shared_hits += len(found)
+        self.memory_store.set_many(found)
+        return found
+
+    # Runs a shared tier call on its executor, a saturated executor is treated like a failed call
+    async def _arun_shared(self, fn, arg, default):
+        try:
+            return await get_executor("embedding_cache").run(fn, arg)
+        except ExecutorSaturatedError as e:
+            logger.warning(f"Embedding cache shared tier skipped: {e}")
+            return default
+
+    def _write_shared(self, items):
+        try:
+            self.shared_store.set_many(items)
+        except Exception as e:
+            logger.warning(f"Embedding cache shared tier write failed: {e}")
+
+    def _missing(self, keys, found):
+        return list(dict.fromkeys(key for key in keys if key not in found))
+
+    # Unique texts still to embed, keyed by cache key so duplicates in one batch are only embedded once
+    def _missing_texts(self, texts, keys, found):
+        missing = {}
+        for text, key in zip(texts, keys):
+            if key not in found and key not in missing:
+                missing[key] = text
+        self.misses += len(missing)
+        return missing
+
+    def _remember(self, keys, vectors):
+        computed = {key: vector_to_bytes(vector) for key, vector in zip(keys, vectors)}
+        self.memory_store.set_many(computed)
+        return computed
+
+_memory_store = None
+_shared_store = None
+_stores_lock = threading.Lock()
+
+'''
+Returns the process-wide (memory, shared) stores, every engine's cached embeddings share them.
+The shared tier is configured with EMBEDDING_CACHE_URL and is None when it isn't set.
+'''
+def get_embedding_stores():
+    global _memory_store, _shared_store
+    if _memory_store is None:
+        with _stores_lock:
+            if _memory_store is None:
+                url = os.getenv("EMBEDDING_CACHE_URL")
+                if url:
+                    try:
+                        _shared_store = create_shared_store(url)
+                    except Exception as e:
+                        logger.error(f"Embedding cache shared tier disabled - Error initializing it: {e}")
+                _memory_store = MemoryEmbeddingStore()
+    return _memory_store, _shared_store
@@ -0,0 +1,84 @@
+import os
+import threading
+from collections import OrderedDict
+
+try:
+    from .rag_engine import RAGEngine, CLAUDE_SONNET_MODEL
+    from .shared_resources import hash_api_keys
+except ImportError:
+    from rag_engine import RAGEngine, CLAUDE_SONNET_MODEL
+    from shared_resources import hash_api_keys
+
+DEFAULT_POOL_SIZE = int(os.getenv("ENGINE_POOL_SIZE", "64"))
+
+class EnginePool:
+    """
+    Bounded LRU of RAG engines keyed on a hash of the caller's API keys and model.
+    Engines hold the per-key LLM, embedding and query translation clients; the Pinecone index,
+    vector store and tokenizers are process-wide singletons shared by every engine.
+
+    Parameters:
+    - max_size: The maximum number of engines to keep before evicting the least recently used
+    """
+    def __init__(self, max_size=DEFAULT_POOL_SIZE):
+        if max_size < 1:
+            raise ValueError("Engine pool size must be at least 1")
+        self.max_size = max_size
+        self._engines = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    '''
+    Returns a pooled engine for the given keys, building one if needed
+
+    Parameters:
+    - openai_api_key: The caller's OpenAI API key
+    - anthropic_api_key: The caller's Anthropic API key
+    - model: The Claude model the engine should generate with
+
+    Returns:
+    - A RAGEngine which is safe to share between concurrent requests
+    '''
+    def get(self, openai_api_key, anthropic_api_key, model=CLAUDE_SONNET_MODEL):
+        key = hash_api_keys(openai_api_key, anthropic_api_key, model)
+        with self._lock:
+            engine = self._engines.get(key)
+            if engine is not None:
+                self._engines.move_to_end(key)
+                self.hits += 1
+                return engine
+            self.misses += 1
+
+        # Build outside the lock, client construction is slow and shouldn't block other keys
+        engine = RAGEngine(openai_api_key=openai_api_key, anthropic_api_key=anthropic_api_key, model=model)
+        with self._lock:
+            # Another request may have built the same engine meanwhile, keep the first one
+            existing = self._engines.get(key)
+            if existing is not None:
+                self._engines.move_to_end(key)
+                return existing
+            self._engines[key] = engine
+            while len(self._engines) > self.max_size:
+                self._engines.popitem(last=False)
+        return engine
+
+    def __len__(self):
+        return len(self._engines)
+
+    def stats(self):
+        return {"size": len(self._engines), "max_size": self.max_size, "hits": self.hits, "misses": self.misses}
+
+_pool = None
+_pool_lock = threading.Lock()
+
+'''
+Returns the process-wide engine pool
+'''
+def get_engine_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = EnginePool()
+    return _pool
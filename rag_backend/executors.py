@@ -0,0 +1,134 @@
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from .logger import logger as logger
+except ImportError:
+    from logger import logger as logger
+
+# (max workers, max queued calls) per executor, overridable with e.g. VECTOR_SEARCH_EXECUTOR_WORKERS
+EXECUTOR_DEFAULTS = {
+    "vector_search": (16, 64),
+    "embedding_cache": (8, 64),
+}
+
+class ExecutorSaturatedError(RuntimeError):
+    pass
+
+class BoundedExecutor:
+    """
+    Dedicated thread pool for blocking client calls which have no async equivalent (e.g. Pinecone queries),
+    so they never compete with each other or anything else for the default executor.
+    Calls beyond max_workers queue up to max_queue, after which new calls are rejected rather than
+    piling up behind a slow upstream.
+
+    Parameters:
+    - name: The name of the executor, used for thread names and metrics
+    - max_workers: The number of threads running calls
+    - max_queue: The number of calls allowed to wait for a thread
+    """
+    def __init__(self, name, max_workers, max_queue):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"rag-{name}")
+        self._lock = threading.Lock()
+        self.active = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.submitted = 0
+        self.completed = 0
+        self.rejected = 0
+        self.total_queue_wait = 0.0
+        self.max_queue_wait = 0.0
+
+    '''
+    Runs a blocking function on the executor without blocking the event loop
+
+    Returns:
+    - The return value of the function
+    '''
+    async def run(self, fn, *args, **kwargs):
+        with self._lock:
+            if self.in_flight >= self.max_workers + self.max_queue:
+                self.rejected += 1
+                logger.warning(f"Executor '{self.name}' saturated with {self.in_flight} calls in flight, rejecting call")
+                raise ExecutorSaturatedError(f"Executor '{self.name}' is saturated")
+            self.in_flight += 1
+            self.submitted += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        try:
+            future = self._executor.submit(self._run, time.perf_counter(), fn, args, kwargs)
+        except BaseException:
+            self._done(None)
+            raise
+        # The slot is freed once the call has finished (or was cancelled before starting) rather than when the
+        # caller stops waiting, a cancelled caller leaves its call queued or running
+        future.add_done_callback(self._done)
+        return await asyncio.wrap_future(future)
+
+    def _done(self, future):
+        with self._lock:
+            self.in_flight -= 1
+
+    def _run(self, submitted_at, fn, args, kwargs):
+        queue_wait = time.perf_counter() - submitted_at
+        with self._lock:
+            self.active += 1
+            self.total_queue_wait += queue_wait
+            self.max_queue_wait = max(self.max_queue_wait, queue_wait)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self._lock:
+                self.active -= 1
+                self.completed += 1
+
+    '''
+    Returns saturation metrics for the executor
+    '''
+    def stats(self):
+        with self._lock:
+            return {
+                "max_workers": self.max_workers,
+                "max_queue": self.max_queue,
+                "active": self.active,
+                "queued": max(self.in_flight - self.active, 0),
+                "peak_in_flight": self.peak_in_flight,
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "avg_queue_wait": self.total_queue_wait / self.completed if self.completed else 0.0,
+                "max_queue_wait": self.max_queue_wait,
+            }
+
+_executors = {}
+_lock = threading.Lock()
+
+'''
+Returns the named process-wide executor, creating it on first use
+'''
+def get_executor(name):
+    executor = _executors.get(name)
+    if executor is None:
+        with _lock:
+            executor = _executors.get(name)
+            if executor is None:
+                default_workers, default_queue = EXECUTOR_DEFAULTS[name]
+                prefix = name.upper()
+                executor = BoundedExecutor(
+                    name,
+                    max_workers=int(os.getenv(f"{prefix}_EXECUTOR_WORKERS", default_workers)),
+                    max_queue=int(os.getenv(f"{prefix}_EXECUTOR_QUEUE", default_queue))
+                )
+                _executors[name] = executor
+    return executor
+
+'''
+Returns saturation metrics for every executor created so far
+'''
+def get_executor_stats():
+    return {name: executor.stats() for name, executor in list(_executors.items())}
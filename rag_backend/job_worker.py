@@ -0,0 +1,27 @@
+import asyncio
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from jobs import JOB_QUEUE, JOB_WORKERS, get_job_queue
+from main import run_job
+from logger import logger as logger
+
+'''
+Runs generation workers without the web app, draining the Redis job queue which the web processes fill.
+Start the web processes with JOB_WORKERS=0 and scale these separately, e.g. `JOB_QUEUE=redis python job_worker.py`.
+'''
+async def serve():
+    if JOB_QUEUE != "redis":
+        logger.warning("JOB_QUEUE isn't redis, this worker can only run jobs queued in its own process")
+    job_queue = get_job_queue()
+    job_queue.start(run_job)
+    logger.info(f"Job worker started with {JOB_WORKERS} workers")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await job_queue.stop()
+
+if __name__ == "__main__":
+    asyncio.run(serve())
@@ -0,0 +1,372 @@
+import asyncio
+import json
+import os
+import time
+import uuid
+
+import redis.asyncio as redis
+from redis.exceptions import RedisError
+
+try:
+    from .logger import logger as logger
+except ImportError:
+    from logger import logger as logger
+
+# "local" keeps the queue in process, "redis" shares it through REDIS_URL so generation workers can run separately (see job_worker.py)
+JOB_QUEUE = os.getenv("JOB_QUEUE", "local")
+# Jobs run at once by this process, 0 for a web process which only enqueues
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+# Queued jobs above which new ones are turned away
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", "1000"))
+# How long a job and its events are kept after they last changed
+JOB_RESULT_TTL_SECONDS = int(os.getenv("JOB_RESULT_TTL_SECONDS", "3600"))
+# How long a Redis worker holds a job it took, after which the job is requeued if that worker never finished it.
+# Must be longer than a job can run, which REQUEST_DEADLINE_SECONDS bounds.
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "300"))
+
+STATUS_QUEUED = "queued"
+STATUS_RUNNING = "running"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+
+# The events ending a job's stream
+EVENT_DONE = "done"
+EVENT_ERROR = "error"
+
+class JobQueueFull(Exception):
+    pass
+
+class LocalJobBackend:
+    """
+    Jobs, their queue and their events in process. Only this process's workers can run them.
+
+    Parameters:
+    - max_size: The number of queued jobs
+    - ttl_seconds: How long a finished job is kept
+    """
+    def __init__(self, max_size=JOB_QUEUE_SIZE, ttl_seconds=JOB_RESULT_TTL_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self._queue = asyncio.Queue(maxsize=max_size)
+        self._jobs = {}
+        self._events = {}
+        self._changed = {}
+
+    async def enqueue(self, job_id, payload):
+        try:
+            self._queue.put_nowait((job_id, payload))
+        except asyncio.QueueFull as e:
+            raise JobQueueFull() from e
+
+    async def dequeue(self):
+        return await self._queue.get()
+
+    # Jobs leave the queue when taken, a process which stops loses its queue anyway
+    async def ack(self, job_id):
+        pass
+
+    async def save(self, job):
+        self._expire()
+        self._jobs[job["id"]] = (time.monotonic() + self.ttl_seconds, dict(job))
+        self._events.setdefault(job["id"], [])
+        self._changed.setdefault(job["id"], asyncio.Event())
+
+    async def load(self, job_id):
+        entry = self._jobs.get(job_id)
+        if entry is None or entry[0] <= time.monotonic():
+            return None
+        return dict(entry[1])
+
+    async def publish(self, job_id, event, data):
+        self._events.setdefault(job_id, []).append((event, data))
+        changed, self._changed[job_id] = self._changed.get(job_id, asyncio.Event()), asyncio.Event()
+        changed.set()
+
+    async def subscribe(self, job_id):
+        events = self._events.get(job_id)
+        if events is None:
+            return
+        index = 0
+        while True:
+            while index < len(events):
+                event, data = events[index]
+                index += 1
+                yield event, data
+                if event in (EVENT_DONE, EVENT_ERROR):
+                    return
+            await self._changed[job_id].wait()
+
+    def queued(self):
+        return self._queue.qsize()
+
+    # Finished jobs are dropped once their TTL has passed, checked whenever a job is saved
+    def _expire(self):
+        now = time.monotonic()
+        for job_id in [job_id for job_id, (expires_at, _) in self._jobs.items() if expires_at <= now]:
+            del self._jobs[job_id]
+            self._events.pop(job_id, None)
+            self._changed.pop(job_id, None)
+
+class RedisJobBackend:
+    """
+    Jobs as JSON keys, a Redis list as the queue and a Redis stream of each job's events, so any process can
+    enqueue, run or follow a job. The API keys a job runs with are only part of its queue entry, which is removed
+    once a worker finishes the job, and are never saved with the job.
+
+    A worker moves the entries it takes to a processing list and holds a lease on each until it finishes. Entries
+    left there without a lease, by a worker which crashed, are moved back to the queue by the next idle worker.
+
+    Parameters:
+    - redis_client: A redis.asyncio client
+    - max_size: The number of queued jobs
+    - ttl_seconds: How long a job and its events are kept after they last changed
+    - lease_seconds: How long a worker holds a job it took before it may be requeued
+    - poll_seconds: How long a worker or subscriber blocks on Redis before checking again
+    - prefix: The prefix of every key
+    """
+    def __init__(self, redis_client, max_size=JOB_QUEUE_SIZE, ttl_seconds=JOB_RESULT_TTL_SECONDS, lease_seconds=JOB_LEASE_SECONDS,
+                 poll_seconds=5, prefix="jobs:"):
+        self.redis = redis_client
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.lease_seconds = lease_seconds
+        self.poll_seconds = poll_seconds
+        self.prefix = prefix
+        self._taken = {}
+        self._unleased = set()
+        self._next_requeue = 0
+
+    async def enqueue(self, job_id, payload):
+        if await self.redis.llen(self.prefix + "queue") >= self.max_size:
+            raise JobQueueFull()
+        await self.redis.lpush(self.prefix + "queue", json.dumps({"id": job_id, "payload": payload}))
+
+    async def dequeue(self):
+        while True:
+            entry = await self.redis.blmove(self.prefix + "queue", self.prefix + "processing", self.poll_seconds, "RIGHT", "LEFT")
+            if entry is None:
+                await self._requeue_abandoned()
+                continue
+            message = json.loads(entry)
+            await self.redis.set(f"{self.prefix}lease:{message['id']}", 1, ex=self.lease_seconds)
+            self._taken[message["id"]] = entry
+            return message["id"], message["payload"]
+
+    async def ack(self, job_id):
+        entry = self._taken.pop(job_id, None)
+        if entry is None:
+            return
+        pipeline = self.redis.pipeline(transaction=False)
+        pipeline.lrem(self.prefix + "processing", 1, entry)
+        pipeline.delete(f"{self.prefix}lease:{job_id}")
+        await pipeline.execute()
+
+    # A worker sets its lease just after taking an entry, so only entries which had no lease at the last check
+    # as well are requeued. Removing the entry first means only one of the workers checking at once requeues it.
+    async def _requeue_abandoned(self):
+        if time.monotonic() < self._next_requeue:
+            return
+        self._next_requeue = time.monotonic() + self.lease_seconds
+        unleased = set()
+        for entry in await self.redis.lrange(self.prefix + "processing", 0, -1):
+            job_id = json.loads(entry)["id"]
+            if await self.redis.exists(f"{self.prefix}lease:{job_id}"):
+                continue
+            if entry not in self._unleased:
+                unleased.add(entry)
+            elif await self.redis.lrem(self.prefix + "processing", 1, entry):
+                await self.redis.rpush(self.prefix + "queue", entry)
+                logger.warning(f"Requeued job {job_id}, its worker stopped before finishing it")
+        self._unleased = unleased
+
+    async def save(self, job):
+        await self.redis.set(f"{self.prefix}job:{job['id']}", json.dumps(job), ex=self.ttl_seconds)
+
+    async def load(self, job_id):
+        data = await self.redis.get(f"{self.prefix}job:{job_id}")
+        return None if data is None else json.loads(data)
+
+    async def publish(self, job_id, event, data):
+        stream_key = f"{self.prefix}events:{job_id}"
+        pipeline = self.redis.pipeline(transaction=False)
+        pipeline.xadd(stream_key, {"data": json.dumps([event, data])})
+        pipeline.expire(stream_key, self.ttl_seconds)
+        await pipeline.execute()
+
+    # Queued jobs may not have any events for a while, so the job is checked whenever nothing arrives
+    async def subscribe(self, job_id):
+        stream_key = f"{self.prefix}events:{job_id}"
+        last_id = "0"
+        while True:
+            response = await self.redis.xread({stream_key: last_id}, block=int(self.poll_seconds * 1000))
+            if not response:
+                job = await self.load(job_id)
+                if job is None or job["status"] in (STATUS_DONE, STATUS_FAILED):
+                    return
+                continue
+            for entry_id, fields in response[0][1]:
+                last_id = entry_id
+                event, data = json.loads(fields[b"data"])
+                yield event, data
+                if event in (EVENT_DONE, EVENT_ERROR):
+                    return
+
+    def queued(self):
+        return None
+
+class JobQueue:
+    """
+    Questions answered in the background. Submitting a job returns its id at once, the client then polls for the
+    result or follows the job's events (the same events as /prompt/stream, ending with a "done" or "error" event).
+    Each worker runs one job at a time, so the number of workers bounds the pipelines this process runs at once,
+    whatever the number of queued jobs.
+
+    Parameters:
+    - backend: A LocalJobBackend or RedisJobBackend
+    - workers: The number of jobs run at once
+    """
+    def __init__(self, backend, workers=JOB_WORKERS):
+        self.backend = backend
+        self.workers = workers
+        self._tasks = []
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+
+    '''
+    Queues a job
+
+    Parameters:
+    - request: The job's JSON serialisable request, saved with the job
+    - secrets: Anything the job needs which shouldn't be saved with it, e.g. the API keys
+
+    Returns:
+    - The queued job
+    '''
+    async def submit(self, request, secrets=None):
+        now = time.time()
+        job = {"id": uuid.uuid4().hex, "status": STATUS_QUEUED, "request": request, "result": None, "error": None,
+               "created_at": now, "started_at": None, "finished_at": None}
+        await self.backend.save(job)
+        await self.backend.enqueue(job["id"], {"request": request, "secrets": secrets or {}})
+        return job
+
+    async def get(self, job_id):
+        return await self.backend.load(job_id)
+
+    '''
+    Returns an async generator of a job's (event, data) tuples, from the first event, which ends with the job
+    '''
+    def events(self, job_id):
+        return self.backend.subscribe(job_id)
+
+    '''
+    Starts the workers
+
+    Parameters:
+    - runner: An async generator function of (request, secrets), yielding the job's (event, data) tuples
+    '''
+    def start(self, runner):
+        self._tasks = [asyncio.create_task(self._work(runner)) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def stats(self):
+        return {
+            "backend": type(self.backend).__name__,
+            "workers": len(self._tasks),
+            "queued": self.backend.queued(),
+            "running": self.running,
+            "completed": self.completed,
+            "failed": self.failed,
+        }
+
+    async def _work(self, runner):
+        while True:
+            try:
+                job_id, payload = await self.backend.dequeue()
+            except RedisError as e:
+                logger.warning(f"Failed to take a job from the queue - Redis error: {e}")
+                await asyncio.sleep(1)
+                continue
+            self.running += 1
+            try:
+                await self._run(job_id, payload, runner)
+            except RedisError as e:
+                logger.error(f"Failed to save job {job_id} - Redis error: {e}")
+            finally:
+                self.running -= 1
+
+    async def _run(self, job_id, payload, runner):
+        job = await self.backend.load(job_id)
+        if job is None:
+            logger.warning(f"Job {job_id} expired before it was run")
+            await self.backend.ack(job_id)
+            return
+        # Requeued after its worker saved the result but stopped before removing it from the queue
+        if job["status"] in (STATUS_DONE, STATUS_FAILED):
+            await self.backend.ack(job_id)
+            return
+        job.update(status=STATUS_RUNNING, started_at=time.time())
+        await self.backend.save(job)
+        try:
+            result = {}
+            answer = []
+            async for event, data in runner(payload["request"], payload["secrets"]):
+                await self.backend.publish(job_id, event, data)
+                if event == "token":
+                    answer.append(data)
+                elif event == "costs":
+                    result.update(data)
+                else:
+                    result[event] = data
+            job.update(status=STATUS_DONE, result={"answer": "".join(answer), **result})
+            self.completed += 1
+        except asyncio.CancelledError:
+            # The worker is stopping, so the job is ended for its subscribers rather than left running
+            logger.warning(f"Job {job_id} was stopped before it finished")
+            job.update(status=STATUS_FAILED, error="The job was stopped before it finished")
+            self.failed += 1
+            try:
+                await self._finish(job)
+            except RedisError as e:
+                logger.error(f"Failed to save job {job_id} - Redis error: {e}")
+            raise
+        except Exception as e:
+            logger.error(f"Job {job_id} failed: {e}")
+            job.update(status=STATUS_FAILED, error=str(e))
+            self.failed += 1
+        await self._finish(job)
+
+    async def _finish(self, job):
+        job["finished_at"] = time.time()
+        # The last event is published first, so subscribers which see the job finished have it to read
+        if job["status"] == STATUS_DONE:
+            await self.backend.publish(job["id"], EVENT_DONE, job["result"])
+        else:
+            await self.backend.publish(job["id"], EVENT_ERROR, {"detail": job["error"]})
+        await self.backend.save(job)
+        await self.backend.ack(job["id"])
+
+_job_queue = None
+
+'''
+Returns the process's JobQueue, backed by Redis when JOB_QUEUE is "redis" and REDIS_URL is set.
+Created on first use from within the event loop, which the queue and Redis client are bound to.
+'''
+def get_job_queue():
+    global _job_queue
+    if _job_queue is None:
+        redis_url = os.getenv("REDIS_URL")
+        if JOB_QUEUE == "redis" and redis_url:
+            client = redis.from_url(redis_url, ssl_cert_reqs=None) if redis_url.startswith("rediss://") else redis.from_url(redis_url)
+            backend = RedisJobBackend(client)
+        else:
+            if JOB_QUEUE == "redis":
+                logger.warning("JOB_QUEUE is redis but no Redis URL was found, jobs will be queued in process")
+            backend = LocalJobBackend()
+        _job_queue = JobQueue(backend)
+    return _job_queue
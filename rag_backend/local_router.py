@@ -0,0 +1,258 @@
+"""
+Local multi-query router, a logistic regression over the question embedding which replaces the LLM yes/no routing
+call when it is confident. It is trained offline from the LLM router's logged decisions:
+
+1. Set ROUTER_DECISION_LOG to a JSONL file, every LLM routing decision is logged with the question's embedding
+2. python rag_backend/local_router.py train --log decisions.jsonl --out router.npz
+   trains on a split of the log and reports agreement with the LLM router on the held-out decisions
+3. Set ROUTER_MODEL_PATH to router.npz, questions the model is unsure about still go to the LLM router (and keep
+   being logged), and ROUTER_SHADOW_RATE samples confident decisions to keep measuring agreement in production
+"""
+
+import argparse
+import base64
+import json
+import os
+import random
+import threading
+import time
+
+import numpy as np
+
+try:
+    from .logger import logger as logger
+    from .tracing import JsonlSink
+except ImportError:
+    from logger import logger as logger
+    from tracing import JsonlSink
+
+ROUTER_MODEL_PATH = os.getenv("ROUTER_MODEL_PATH")
+ROUTER_DECISION_LOG = os.getenv("ROUTER_DECISION_LOG")
+ROUTER_SHADOW_RATE = float(os.getenv("ROUTER_SHADOW_RATE", "0.0"))
+# Probabilities between 1 - confidence and confidence are left to the LLM router
+DEFAULT_CONFIDENCE = float(os.getenv("ROUTER_CONFIDENCE", "0.9"))
+
+class LocalRouter:
+    """
+    Logistic regression router, deciding whether a question would benefit from multi-query generation.
+
+    Parameters:
+    - weights: The weight per embedding dimension
+    - bias: The intercept
+    - confidence: The probability required to decide without the LLM router
+    - metadata: Anything recorded at training time (embedding model, training size, evaluation results)
+    """
+    def __init__(self, weights, bias, confidence=DEFAULT_CONFIDENCE, metadata=None):
+        self.weights = np.asarray(weights, dtype=np.float32)
+        self.bias = float(bias)
+        self.confidence = confidence
+        self.metadata = metadata or {}
+        self._lock = threading.Lock()
+        self.local_decisions = 0
+        self.fallbacks = 0
+        self.shadow_compared = 0
+        self.shadow_agreed = 0
+
+    '''
+    Returns the probability that multi-query generation should be used, for one vector or a matrix of them
+    '''
+    def predict_proba(self, vectors):
+        logits = np.asarray(vectors, dtype=np.float32) @ self.weights + self.bias
+        return 1.0 / (1.0 + np.exp(-logits))
+
+    '''
+    Returns (decision, probability), the decision being None when the router isn't confident either way
+    '''
+    def decide(self, vector):
+        probability = float(self.predict_proba(vector))
+        if probability >= self.confidence:
+            decision = True
+        elif probability <= 1.0 - self.confidence:
+            decision = False
+        else:
+            decision = None
+        with self._lock:
+            if decision is None:
+                self.fallbacks += 1
+            else:
+                self.local_decisions += 1
+        return decision, probability
+
+    '''
+    Records whether a confident local decision matched the LLM router's, for sampled requests
+    '''
+    def record_shadow(self, local_decision, llm_decision):
+        with self._lock:
+            self.shadow_compared += 1
+            self.shadow_agreed += int(local_decision == llm_decision)
+
+    def stats(self):
+        with self._lock:
+            decisions = self.local_decisions + self.fallbacks
+            return {
+                "local_decisions": self.local_decisions,
+                "fallbacks": self.fallbacks,
+                "coverage": self.local_decisions / decisions if decisions else 0.0,
+                "shadow_compared": self.shadow_compared,
+                "shadow_agreement": self.shadow_agreed / self.shadow_compared if self.shadow_compared else None,
+            }
+
+    def save(self, path):
+        np.savez(path, weights=self.weights, bias=np.float32(self.bias), confidence=np.float32(self.confidence), metadata=json.dumps(self.metadata))
+
+    @classmethod
+    def load(cls, path, confidence=None):
+        with np.load(path) as data:
+            return cls(
+                data["weights"],
+                float(data["bias"]),
+                confidence=confidence if confidence is not None else float(data["confidence"]),
+                metadata=json.loads(str(data["metadata"]))
+            )
+
+'''
+Trains a logistic regression with full-batch gradient descent and L2 regularisation.
+Classes are weighted by inverse frequency, routing logs are usually dominated by "no".
+
+Parameters:
+- vectors: An (n, dimensions) matrix of question embeddings
+- labels: The LLM router's decisions, 1 for multi-query
+- l2: The regularisation strength
+- learning_rate: The gradient descent step size
+- epochs: The number of passes over the data
+
+Returns:
+- The trained LocalRouter
+'''
+def train_router(vectors, labels, l2=1e-3, learning_rate=0.5, epochs=500, confidence=DEFAULT_CONFIDENCE):
+    X = np.asarray(vectors, dtype=np.float32)
+    y = np.asarray(labels, dtype=np.float32)
+    positives = max(y.sum(), 1.0)
+    negatives = max(len(y) - y.sum(), 1.0)
+    sample_weights = np.where(y == 1, len(y) / (2 * positives), len(y) / (2 * negatives)).astype(np.float32)
+
+    weights = np.zeros(X.shape[1], dtype=np.float32)
+    bias = 0.0
+    for _ in range(epochs):
+        probabilities = 1.0 / (1.0 + np.exp(-(X @ weights + bias)))
+        error = (probabilities - y) * sample_weights
+        weights -= learning_rate * (X.T @ error / len(y) + l2 * weights)
+        bias -= learning_rate * float(error.mean())
+    return LocalRouter(weights, bias, confidence=confidence, metadata={"trained_on": len(y), "positives": int(y.sum())})
+
+'''
+Compares the router with the LLM router's decisions
+
+Returns:
+- agreement: How often the router's most likely decision matches the LLM router's
+- coverage: The share of questions the router is confident enough to decide alone
+- confident_agreement: The agreement on just those questions, i.e. the agreement seen in production
+'''
+def evaluate_router(router, vectors, labels):
+    labels = np.asarray(labels, dtype=bool)
+    probabilities = router.predict_proba(vectors)
+    predictions = probabilities >= 0.5
+    confident = (probabilities >= router.confidence) | (probabilities <= 1.0 - router.confidence)
+    return {
+        "examples": int(len(labels)),
+        "agreement": float((predictions == labels).mean()) if len(labels) else 0.0,
+        "coverage": float(confident.mean()) if len(labels) else 0.0,
+        "confident_agreement": float((predictions[confident] == labels[confident]).mean()) if confident.any() else None,
+    }
+
+'''
+Reads a decision log into (vectors, labels), keeping the latest decision for each question
+'''
+def load_decisions(path):
+    decisions = {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                decisions[record["question"]] = record
+    vectors = np.stack([np.frombuffer(base64.b64decode(r["embedding"]), dtype=np.float32) for r in decisions.values()])
+    labels = np.array([r["use_multi_query"] for r in decisions.values()], dtype=np.float32)
+    return vectors, labels
+
+_decision_sink = None
+_router = None
+_router_loaded = False
+_lock = threading.Lock()
+
+'''
+Logs an LLM routing decision with the question's embedding as training data, if ROUTER_DECISION_LOG is set
+'''
+def log_routing_decision(question, vector, use_multi_query):
+    global _decision_sink
+    if not ROUTER_DECISION_LOG:
+        return
+    if _decision_sink is None:
+        with _lock:
+            if _decision_sink is None:
+                _decision_sink = JsonlSink(ROUTER_DECISION_LOG)
+    _decision_sink.write({
+        "question": question,
+        "use_multi_query": use_multi_query,
+        "embedding": base64.b64encode(np.asarray(vector, dtype=np.float32).tobytes()).decode("ascii"),
+        "timestamp": time.time(),
+    })
+
+'''
+Returns whether a routing decision should also be made by the LLM router to measure agreement
+'''
+def should_shadow():
+    return ROUTER_SHADOW_RATE > 0 and random.random() < ROUTER_SHADOW_RATE
+
+'''
+Returns the process-wide local router loaded from ROUTER_MODEL_PATH, or None when it isn't configured
+'''
+def get_local_router():
+    global _router, _router_loaded
+    if not _router_loaded:
+        with _lock:
+            if not _router_loaded:
+                if ROUTER_MODEL_PATH:
+                    try:
+                        _router = LocalRouter.load(ROUTER_MODEL_PATH)
+                        logger.info(f"Loaded local router from {ROUTER_MODEL_PATH}")
+                    except Exception as e:
+                        logger.error(f"Local router disabled - Error loading {ROUTER_MODEL_PATH}: {e}")
+                _router_loaded = True
+    return _router
+
+def _print_evaluation(name, evaluation):
+    print(f"{name}: {evaluation['examples']} decisions, agreement {evaluation['agreement']:.3f}, "
+          f"coverage {evaluation['coverage']:.3f}, confident agreement "
+          f"{'n/a' if evaluation['confident_agreement'] is None else format(evaluation['confident_agreement'], '.3f')}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train or evaluate the local multi-query router")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    train_parser = subparsers.add_parser("train", help="Train on a decision log and report held-out agreement")
+    train_parser.add_argument("--log", required=True, help="The JSONL decision log")
+    train_parser.add_argument("--out", required=True, help="Where to save the router weights (.npz)")
+    train_parser.add_argument("--holdout", type=float, default=0.2, help="The share of decisions held out for evaluation")
+    train_parser.add_argument("--confidence", type=float, default=DEFAULT_CONFIDENCE)
+    train_parser.add_argument("--l2", type=float, default=1e-3)
+    train_parser.add_argument("--epochs", type=int, default=500)
+    train_parser.add_argument("--seed", type=int, default=0)
+    evaluate_parser = subparsers.add_parser("evaluate", help="Report a saved router's agreement with a decision log")
+    evaluate_parser.add_argument("--log", required=True)
+    evaluate_parser.add_argument("--model", required=True)
+    evaluate_parser.add_argument("--confidence", type=float, default=None)
+    args = parser.parse_args()
+
+    vectors, labels = load_decisions(args.log)
+    if args.command == "train":
+        order = np.random.default_rng(args.seed).permutation(len(labels))
+        holdout = int(len(labels) * args.holdout)
+        test_rows, train_rows = order[:holdout], order[holdout:]
+        router = train_router(vectors[train_rows], labels[train_rows], l2=args.l2, epochs=args.epochs, confidence=args.confidence)
+        _print_evaluation("train", evaluate_router(router, vectors[train_rows], labels[train_rows]))
+        if holdout:
+            router.metadata["holdout"] = evaluate_router(router, vectors[test_rows], labels[test_rows])
+            _print_evaluation("holdout", router.metadata["holdout"])
+        router.save(args.out)
+        print(f"Saved router to {args.out}")
+    else:
+        _print_evaluation("evaluation", evaluate_router(LocalRouter.load(args.model, confidence=args.confidence), vectors, labels))
@@ -0,0 +1,267 @@
+"""
+Exact vector search over a local snapshot of the index, as an alternative to querying Pinecone.
+
+A snapshot directory holds:
+- vectors.npy: an (n, dimensions) float16 or float32 matrix of unit-normalised vectors, opened with mmap
+  so the pages are shared by every uvicorn worker on the host
+- metadata.db: a SQLite sidecar mapping each row to its vector id and metadata (including the split text)
+- manifest.json: the dimensions, dtype and row count
+- bm25/: a keyword index over the split text (see bm25_index.py), for hybrid retrieval
+
+The root directory contains a snapshots/ folder and a CURRENT file naming the active snapshot. Publishing a new
+snapshot rewrites CURRENT with os.replace, which is atomic, and running indexes pick it up on their next query.
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+from langchain_core.documents import Document
+
+try:
+    from .bm25_index import BM25_DIR, BM25Index, build_snapshot_bm25
+    from .logger import logger as logger
+except ImportError:
+    from bm25_index import BM25_DIR, BM25Index, build_snapshot_bm25
+    from logger import logger as logger
+
+CURRENT_FILE = "CURRENT"
+SNAPSHOTS_DIR = "snapshots"
+TEXT_KEY = "text"
+# Rows scored per block when the matrix is float16, bounds the float32 temporary
+SCORE_BLOCK_ROWS = 4096
+
+class _Snapshot:
+    def __init__(self, path):
+        self.name = os.path.basename(path)
+        with open(os.path.join(path, "manifest.json")) as f:
+            self.manifest = json.load(f)
+        self.vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode="r")
+        bm25_path = os.path.join(path, BM25_DIR)
+        self.bm25 = BM25Index.load(bm25_path) if os.path.isdir(bm25_path) else None
+        self._metadata_path = os.path.join(path, "metadata.db")
+        self._local = threading.local()
+
+    # SQLite connections can't be shared between threads, each executor thread gets its own read-only one
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(f"file:{self._metadata_path}?mode=ro", uri=True)
+            self._local.conn = conn
+        return conn
+
+    def rows(self, row_ids):
+        placeholders = ",".join("?" for _ in row_ids)
+        result = self._connection().execute(f"SELECT row, id, metadata FROM splits WHERE row IN ({placeholders})", [int(r) for r in row_ids]).fetchall()
+        by_row = {row: (vector_id, json.loads(metadata)) for row, vector_id, metadata in result}
+        return [by_row[int(r)] for r in row_ids]
+
+    def rows_for_ids(self, vector_ids):
+        placeholders = ",".join("?" for _ in vector_ids)
+        result = self._connection().execute(f"SELECT row, id, metadata FROM splits WHERE id IN ({placeholders})", list(vector_ids)).fetchall()
+        return {vector_id: (row, json.loads(metadata)) for row, vector_id, metadata in result}
+
+    def scores(self, query):
+        if self.vectors.dtype == np.float32:
+            return self.vectors @ query
+        scores = np.empty(self.vectors.shape[0], dtype=np.float32)
+        for start in range(0, self.vectors.shape[0], SCORE_BLOCK_ROWS):
+            block = self.vectors[start:start + SCORE_BLOCK_ROWS].astype(np.float32)
+            scores[start:start + SCORE_BLOCK_ROWS] = block @ query
+        return scores
+
+class LocalVectorIndex:
+    """
+    Drop-in replacement for the shared PineconeVectorStore, answering similarity_search_by_vector_with_score
+    with one vectorised matmul and argpartition over a memory-mapped snapshot. Scores are cosine similarities,
+    the same as the Pinecone index, and documents come back in the same shape.
+
+    Parameters:
+    - root: The directory containing CURRENT and the snapshots
+    - reload_interval: How often (in seconds) to check whether a new snapshot has been published
+    """
+    def __init__(self, root, reload_interval=5.0):
+        self.root = root
+        self.reload_interval = reload_interval
+        self._lock = threading.Lock()
+        self._checked_at = time.monotonic()
+        self._current_mtime = None
+        self._snapshot = self._load_current()
+
+    @property
+    def generation(self):
+        return self._snapshot.name
+
+    def similarity_search_by_vector_with_score(self, embedding, *, k=4, filter=None, namespace=None):
+        snapshot, top, scores = self._top_rows(embedding, k, filter)
+        return [
+            (self._to_document(vector_id, metadata), float(scores[row]))
+            for row, (vector_id, metadata) in zip(top, snapshot.rows(top))
+        ]
+
+    '''
+    Like similarity_search_by_vector_with_score, but also returns each document's (unit-normalised) vector
+    '''
+    def similarity_search_by_vector_with_vectors(self, embedding, *, k=4, filter=None, namespace=None):
+        snapshot, top, scores = self._top_rows(embedding, k, filter)
+        vectors = np.asarray(snapshot.vectors[top], dtype=np.float32)
+        return [
+            (self._to_document(vector_id, metadata), float(scores[row]), vector)
+            for row, (vector_id, metadata), vector in zip(top, snapshot.rows(top), vectors)
+        ]
+
+    def _top_rows(self, embedding, k, filter):
+        if filter is not None:
+            raise NotImplementedError("Metadata filters aren't supported by the local vector index")
+        snapshot = self._get_snapshot()
+        query = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        if norm:
+            query = query / norm
+        scores = snapshot.scores(query)
+        k = min(k, scores.shape[0])
+        if k <= 0:
+            return snapshot, np.empty(0, dtype=np.int64), scores
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return snapshot, top, scores
+
+    '''
+    Searches the split text with BM25, returning (document, score) pairs like the vector search
+    '''
+    def keyword_search(self, query, *, k=4):
+        snapshot = self._get_snapshot()
+        if snapshot.bm25 is None:
+            raise RuntimeError(f"Snapshot {snapshot.name} has no keyword index, build one with bm25_index.py")
+        results = snapshot.bm25.search(query, k=k)
+        if not results:
+            return []
+        rows = [row for row, _ in results]
+        return [
+            (self._to_document(vector_id, metadata), score)
+            for (vector_id, metadata), (_, score) in zip(snapshot.rows(rows), results)
+        ]
+
+    '''
+    Returns the documents for the given vector ids by id, ids which aren't in the snapshot are left out
+    '''
+    def fetch_documents(self, vector_ids):
+        snapshot = self._get_snapshot()
+        return {vector_id: self._to_document(vector_id, metadata) for vector_id, (_, metadata) in snapshot.rows_for_ids(vector_ids).items()}
+
+    def _to_document(self, vector_id, metadata):
+        text = metadata.pop(TEXT_KEY, "")
+        return Document(id=vector_id, page_content=text, metadata=metadata)
+
+    # Snapshots are swapped by replacing one reference, queries already running keep the snapshot they started with
+    def _get_snapshot(self):
+        now = time.monotonic()
+        if now - self._checked_at >= self.reload_interval:
+            with self._lock:
+                if now - self._checked_at >= self.reload_interval:
+                    self._checked_at = now
+                    mtime = os.stat(os.path.join(self.root, CURRENT_FILE)).st_mtime_ns
+                    if mtime != self._current_mtime:
+                        self._snapshot = self._load_current()
+        return self._snapshot
+
+    def _load_current(self):
+        current_path = os.path.join(self.root, CURRENT_FILE)
+        self._current_mtime = os.stat(current_path).st_mtime_ns
+        with open(current_path) as f:
+            name = f.read().strip()
+        snapshot = _Snapshot(os.path.join(self.root, SNAPSHOTS_DIR, name))
+        logger.info(f"Loaded local vector snapshot {name} with {snapshot.vectors.shape[0]} vectors{'' if snapshot.bm25 is not None else ' and no keyword index'}")
+        return snapshot
+
+'''
+Writes a snapshot and atomically makes it the current one
+
+Parameters:
+- root: The index root directory
+- rows: An iterable of (vector id, vector, metadata) tuples, the metadata including the split text
+- count: The number of rows
+- dimensions: The size of the vectors
+- dtype: "float16" (half the memory) or "float32"
+- name: The snapshot name, defaults to a UTC timestamp
+- keyword_index: Whether to build the BM25 keyword index for the snapshot
+
+Returns:
+- The snapshot name
+'''
+def write_snapshot(root, rows, count, dimensions, dtype="float16", name=None, keyword_index=True):
+    name = name or datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%fZ")
+    path = os.path.join(root, SNAPSHOTS_DIR, name)
+    os.makedirs(path)
+
+    matrix = np.lib.format.open_memmap(os.path.join(path, "vectors.npy"), mode="w+", dtype=dtype, shape=(count, dimensions))
+    conn = sqlite3.connect(os.path.join(path, "metadata.db"))
+    conn.execute("CREATE TABLE splits (row INTEGER PRIMARY KEY, id TEXT UNIQUE NOT NULL, metadata TEXT NOT NULL)")
+    for row, (vector_id, vector, metadata) in enumerate(rows):
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        matrix[row] = vector / norm if norm else vector
+        conn.execute("INSERT INTO splits (row, id, metadata) VALUES (?, ?, ?)", (row, vector_id, json.dumps(metadata)))
+    matrix.flush()
+    del matrix
+    conn.commit()
+    conn.close()
+
+    if keyword_index:
+        build_snapshot_bm25(path, text_key=TEXT_KEY)
+
+    with open(os.path.join(path, "manifest.json"), "w") as f:
+        json.dump({"dimensions": dimensions, "dtype": dtype, "count": count, "created": name}, f)
+
+    # Publish by atomically replacing CURRENT
+    tmp_path = os.path.join(root, f"{CURRENT_FILE}.tmp")
+    with open(tmp_path, "w") as f:
+        f.write(name)
+    os.replace(tmp_path, os.path.join(root, CURRENT_FILE))
+    return name
+
+'''
+Exports the whole Pinecone index into a new local snapshot
+
+Parameters:
+- index: The Pinecone index to export
+- root: The index root directory
+- dtype: The dtype to store vectors as
+- batch_size: The number of vectors fetched per request
+'''
+def build_snapshot_from_pinecone(index, root, dtype="float16", batch_size=100):
+    ids = []
+    for id_list in index.list(limit=batch_size):
+        ids.extend(id_list)
+    logger.info(f"Exporting {len(ids)} vectors from Pinecone")
+
+    # Fetched lazily batch by batch, so the export never holds more than one batch of vectors in memory
+    def fetch_rows():
+        for start in range(0, len(ids), batch_size):
+            batch = ids[start:start + batch_size]
+            fetched = index.fetch(ids=batch).vectors
+            for vector_id in batch:
+                yield vector_id, fetched[vector_id].values, dict(fetched[vector_id].metadata)
+
+    dimensions = index.describe_index_stats()["dimension"]
+    return write_snapshot(root, fetch_rows(), len(ids), dimensions, dtype=dtype)
+
+if __name__ == "__main__":
+    sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+    from dotenv import load_dotenv, find_dotenv
+    from shared_resources import get_pinecone_index
+
+    load_dotenv(find_dotenv(filename=".rag_engine.env"))
+    parser = argparse.ArgumentParser(description="Build a local vector snapshot from the Pinecone index")
+    parser.add_argument("--root", default=os.getenv("LOCAL_INDEX_DIR"), help="The local index root directory")
+    parser.add_argument("--dtype", default="float16", choices=["float16", "float32"])
+    args = parser.parse_args()
+    os.makedirs(args.root, exist_ok=True)
+    snapshot_name = build_snapshot_from_pinecone(get_pinecone_index(), args.root, dtype=args.dtype)
+    print(f"Published snapshot {snapshot_name}")
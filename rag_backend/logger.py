@@ -1,29 +1,162 @@
+import atexit
+import copy
+import json
 import logging
 import os
+import queue
+import random
 import sys
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# "json" writes one JSON object per record, "text" the original human readable lines
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()
+# The log file, relative to the working directory, empty to only log to stdout. {pid} is replaced with the process id,
+# as every process (uvicorn workers, job_worker.py) rotates its file on its own and a shared file loses records.
+LOG_FILE = os.getenv("LOG_FILE", "app-{pid}.log")
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", "5"))
+# Records allowed to wait for the writer thread, more are dropped rather than blocking the request
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+# Messages and payload strings longer than this are truncated
+LOG_MAX_FIELD_CHARS = int(os.getenv("LOG_MAX_FIELD_CHARS", "1000"))
+# The share of request and response bodies logged in full (truncated), the rest are logged as field sizes
+LOG_PAYLOAD_SAMPLE_RATE = float(os.getenv("LOG_PAYLOAD_SAMPLE_RATE", "0.05"))
+
+'''
+Returns the path of this process's log file, relative paths being under the current working directory
+'''
+def log_file_path(log_file):
+    return os.path.join(os.getcwd(), log_file.replace("{pid}", str(os.getpid())))
+
+# The attributes every LogRecord has, anything else was passed with extra= and is logged as a field
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "taskName"}
+
+def _truncate(text, max_chars=LOG_MAX_FIELD_CHARS):
+    if len(text) <= max_chars:
+        return text
+    return f"{text[:max_chars]}... ({len(text) - max_chars} more chars)"
+
+def _extra_fields(record):
+    return {key: value for key, value in vars(record).items() if key not in _RECORD_ATTRIBUTES}
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats records as single line JSON objects, with any fields passed with extra=
+    """
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            **_extra_fields(record),
+        }
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+class TextFormatter(logging.Formatter):
+    """
+    The original "time - level - message" lines, followed by any fields passed with extra= as JSON
+    """
+    def __init__(self):
+        super().__init__("%(asctime)s - %(levelname)s - %(message)s")
+
+    def format(self, record):
+        line = super().format(record)
+        fields = _extra_fields(record)
+        return f"{line} {json.dumps(fields, default=str)}" if fields else line
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    Hands records to the writer thread without blocking. The message is built and truncated here, so the writer
+    never formats arguments which may have changed since, and records are dropped and counted when the queue is full.
+    """
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    # Like QueueHandler.prepare, but the traceback is kept out of the (truncated) message
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = _truncate(record.getMessage())
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
 
 def __setup_logger():
     # Create a logger
     logger = logging.getLogger()
-    logger.setLevel(logging.INFO)
+    logger.setLevel(LOG_LEVEL)
 
-    # Create handlers
-    console_handler = logging.StreamHandler(sys.stdout)
-    # Use the current working directory for the log file
-    log_file_path = os.path.join(os.getcwd(), "app.log")
-    file_handler = logging.FileHandler(log_file_path)
+    # Create handlers, which run on the listener's thread
+    formatter = JsonFormatter() if LOG_FORMAT == "json" else TextFormatter()
+    handlers = [logging.StreamHandler(sys.stdout)]
+    if LOG_FILE:
+        # Use the current working directory for relative paths
+        handlers.append(RotatingFileHandler(log_file_path(LOG_FILE), maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT))
+    for handler in handlers:
+        handler.setFormatter(formatter)
 
-    # Create formatters and add it to handlers
-    formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
-    console_handler.setFormatter(formatter)
-    file_handler.setFormatter(formatter)
-
-    # Add handlers to the logger
-    logger.addHandler(console_handler)
-    logger.addHandler(file_handler)
+    # Only the queue handler runs on the calling thread
+    queue_handler = DroppingQueueHandler(queue.Queue(maxsize=LOG_QUEUE_SIZE))
+    logger.addHandler(queue_handler)
+    listener = QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+    listener.start()
+    # Writes out whatever is still queued on exit
+    atexit.register(listener.stop)
 
     logger.propagate = False
 
-    return logger
+    return logger, queue_handler
+
+logger, _queue_handler = __setup_logger()
+
+def get_dropped_log_records():
+    return _queue_handler.dropped
+
+'''
+Truncates the long strings in a payload, and the lists longer than 20 items
+'''
+def truncate_payload(payload, max_chars=LOG_MAX_FIELD_CHARS):
+    if isinstance(payload, str):
+        return _truncate(payload, max_chars)
+    if isinstance(payload, dict):
+        return {key: truncate_payload(value, max_chars) for key, value in payload.items()}
+    if isinstance(payload, (list, tuple)):
+        items = [truncate_payload(value, max_chars) for value in payload[:20]]
+        return items + [f"... ({len(payload) - 20} more items)"] if len(payload) > 20 else items
+    return payload
+
+'''
+Returns a payload's top level fields as sizes, the length of strings and collections and other values as they are
+'''
+def payload_sizes(payload):
+    return {key: len(value) if isinstance(value, (str, list, tuple, dict)) else value for key, value in payload.items()}
+
+'''
+Logs a request or response body as a structured field. Large bodies such as the chat history would make every
+request pay for formatting and writing them, so only LOG_PAYLOAD_SAMPLE_RATE of them are logged (truncated), the
+rest are logged as their field sizes.
 
-logger = __setup_logger()
+Parameters:
+- message: The log message
+- payload: The body as a dict
+- level: The log level
+'''
+def log_payload(message, payload, level=logging.INFO):
+    if not logger.isEnabledFor(level):
+        return
+    if random.random() < LOG_PAYLOAD_SAMPLE_RATE:
+        logger.log(level, message, extra={"payload": truncate_payload(payload)})
+    else:
+        logger.log(level, message, extra={"payload_sizes": payload_sizes(payload)})
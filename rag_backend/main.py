@@ -1,16 +1,48 @@
 try:
-    from rag_engine import RAGEngine as engine
-    from logger import logger as logger
+    from engine_pool import get_engine_pool
+    from rag_engine import EMBEDDING_DIMENSIONS
+    from executors import get_executor_stats
+    from semantic_cache import get_answer_cache
+    from local_router import get_local_router
+    from request_costs import get_prompt_cache_stats
+    from single_flight import get_single_flight
+    from deadline import get_hedging_stats
+    from profiles import PROFILE_AUTO, PROFILE_BALANCED, PROFILE_FAST, PROFILE_THOROUGH, aresolve_profile
+    from sessions import get_sessions
+    from jobs import JobQueueFull, get_job_queue
+    from admission import AdmissionRejected, admission_key, get_admission_controller, get_local_rate_limiter
+    from metrics import render_metrics
+    from profiling import PROFILE_MAX_SECONDS, PROFILING_ENABLED, ADMIN_TOKEN, StackSampler, get_memory_tracker, is_admin, profile_process
+    from logger import get_dropped_log_records, log_payload, logger as logger
 except ImportError:
-    from .rag_engine import RAGEngine as engine
-    from .logger import logger as logger
+    from .engine_pool import get_engine_pool
+    from .rag_engine import EMBEDDING_DIMENSIONS
+    from .executors import get_executor_stats
+    from .semantic_cache import get_answer_cache
+    from .local_router import get_local_router
+    from .request_costs import get_prompt_cache_stats
+    from .single_flight import get_single_flight
+    from .deadline import get_hedging_stats
+    from .profiles import PROFILE_AUTO, PROFILE_BALANCED, PROFILE_FAST, PROFILE_THOROUGH, aresolve_profile
+    from .sessions import get_sessions
+    from .jobs import JobQueueFull, get_job_queue
+    from .admission import AdmissionRejected, admission_key, get_admission_controller, get_local_rate_limiter
+    from .metrics import render_metrics
+    from .profiling import PROFILE_MAX_SECONDS, PROFILING_ENABLED, ADMIN_TOKEN, StackSampler, get_memory_tracker, is_admin, profile_process
+    from .logger import get_dropped_log_records, log_payload, logger as logger
 
 from contextlib import asynccontextmanager
+import asyncio
+import json
 import os
-from fastapi import Depends, FastAPI, HTTPException, Header, Request, Response
+import time
+from typing import Literal
+from starlette.background import BackgroundTask
+from fastapi import Depends, FastAPI, HTTPException, Header, Query, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi_limiter import FastAPILimiter
 from fastapi_limiter.depends import RateLimiter
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
 import redis.asyncio as redis
 
@@ -19,11 +51,27 @@ class PromptRequest(BaseModel):
     user_input: str
     few_shot: bool = True
     format_response: bool = True
-    history: str = "",
+    history: str = ""
+    include_trace: bool = False # include per-stage timings and token counts in the response
+    # latency tier, see profiles.py; without one the request runs on Sonnet with the engine's retrieval defaults
+    profile: Literal[PROFILE_FAST, PROFILE_BALANCED, PROFILE_THOROUGH, PROFILE_AUTO] | None = None
+    # server-side conversation, see sessions.py; when set the history is kept by the server and the history field is ignored
+    conversation_id: str | None = Field(default=None, min_length=1, max_length=128)
 
 # Lifecycle management
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    # Job workers run alongside the web app unless JOB_WORKERS is 0, see jobs.py and job_worker.py
+    job_queue = get_job_queue()
+    job_queue.start(run_job)
+    try:
+        async with _rate_limiting(app):
+            yield
+    finally:
+        await job_queue.stop()
+
+@asynccontextmanager
+async def _rate_limiting(app: FastAPI):
     redis_url = os.getenv("REDIS_URL")
     if redis_url:
         redis_client = redis.from_url(redis_url,
@@ -41,18 +89,122 @@ async def lifespan(app: FastAPI):
                 await redis_client.close()
                 yield
     else:
-        logger.warning("No Redis URL found, rate limiting will not be applied")
+        logger.warning("No Redis URL found, rate limiting will be applied per worker")
         yield
 
-# Rate limiting with Redis
+# Rate limiting with Redis, or per worker when Redis isn't available
 async def get_rate_limiter():
     if FastAPILimiter.redis:
         return RateLimiter(times=10, seconds=60)
     else:
-        return None
+        return get_local_rate_limiter()
 
 app = FastAPI(lifespan=lifespan)
 
+@app.exception_handler(AdmissionRejected)
+async def admission_rejected_handler(request: Request, exc: AdmissionRejected):
+    return JSONResponse(status_code=exc.status_code, content={"detail": exc.detail}, headers={"Retry-After": str(exc.retry_after)})
+
+'''
+Waits for a pipeline slot (see admission.py), fairly across API keys. Returns the ticket to release once the
+answer has finished, or None when admission control is off.
+'''
+async def _admit(api_key):
+    controller = get_admission_controller()
+    if controller is None:
+        return None
+    return await controller.acquire(admission_key(api_key))
+
+def _release(ticket):
+    if ticket is not None:
+        ticket.release()
+
+# The most sampled stacks returned with a profiled request
+PIPELINE_PROFILE_TOP = 50
+
+'''
+Checks the admin token of the admin endpoints, which don't exist unless profiling is on (see profiling.py)
+'''
+async def require_admin(admin_token: str | None = Header(default=None, alias="X-Admin-Token")):
+    if not PROFILING_ENABLED or not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not is_admin(admin_token):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+'''
+Whether a request asked for its pipeline to be profiled, which needs the admin token.
+The header is ignored unless profiling is on.
+'''
+def _profile_requested(profile_request, admin_token):
+    if not PROFILING_ENABLED or profile_request is None or profile_request.lower() not in ("1", "true"):
+        return False
+    if not is_admin(admin_token):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+    return True
+
+def _stop_sampler(sampler):
+    if sampler is not None:
+        sampler.stop()
+
+'''
+Picks the engine, profile and few-shot setting for a request. A profile's model picks the engine, and its few-shot
+setting applies unless few_shot was sent explicitly. "auto" is decided from the question (see profiles.py).
+'''
+async def _resolve_engine(prompt_request, openai_api_key, anthropic_api_key):
+    pool = get_engine_pool()
+    if prompt_request.profile is None:
+        return pool.get(openai_api_key=openai_api_key, anthropic_api_key=anthropic_api_key), None, prompt_request.few_shot
+    aembed = None
+    if prompt_request.profile == PROFILE_AUTO:
+        # Embedding models are shared through the embedding cache, so retrieval reuses this vector
+        aembed = pool.get(openai_api_key=openai_api_key, anthropic_api_key=anthropic_api_key).embedding_model.aembed_query
+    profile = await aresolve_profile(prompt_request.profile, prompt_request.user_input, aembed)
+    few_shot = prompt_request.few_shot if "few_shot" in prompt_request.model_fields_set else profile.few_shot
+    eng = pool.get(openai_api_key=openai_api_key, anthropic_api_key=anthropic_api_key, model=profile.model)
+    return eng, profile, few_shot
+
+'''
+Returns the key a request's conversation is stored under. Conversation ids are chosen by clients, so they're scoped
+to the caller's API key, and a caller can't read or add to someone else's conversation by sending its id.
+'''
+def _conversation_key(prompt_request, anthropic_api_key):
+    return f"{admission_key(anthropic_api_key)}:{prompt_request.conversation_id}"
+
+'''
+Returns the history a request is answered with, the conversation's when it has a conversation_id
+'''
+async def _resolve_history(prompt_request, anthropic_api_key):
+    if prompt_request.conversation_id is None:
+        return prompt_request.history
+    return await get_sessions().ahistory(_conversation_key(prompt_request, anthropic_api_key))
+
+@app.get("/health")
+async def health():
+    answer_cache = get_answer_cache(EMBEDDING_DIMENSIONS)
+    local_router = get_local_router()
+    single_flight = get_single_flight()
+    admission = get_admission_controller()
+    return {
+        "status": "ok",
+        "engine_pool": get_engine_pool().stats(),
+        "executors": get_executor_stats(),
+        "answer_cache": answer_cache.stats() if answer_cache else None,
+        "local_router": local_router.stats() if local_router else None,
+        "prompt_cache": get_prompt_cache_stats().stats(),
+        "single_flight": single_flight.stats() if single_flight else None,
+        "hedging": get_hedging_stats(),
+        "sessions": get_sessions().stats(),
+        "jobs": get_job_queue().stats(),
+        "admission": admission.stats() if admission else None,
+        "dropped_log_records": get_dropped_log_records()
+    }
+
+# Prometheus text format, see metrics.py
+@app.get("/metrics")
+async def metrics():
+    content, content_type = render_metrics()
+    return Response(content=content, media_type=content_type)
+
 @app.post("/prompt")
 async def prompt(
     request: Request,
@@ -60,26 +212,228 @@ async def prompt(
     prompt_request: PromptRequest,
     openai_api_key: str = Header(..., alias="X-OpenAI-API-Key"),
     anthropic_api_key: str = Header(..., alias="X-Anthropic-API-Key"),
+    profile_request: str | None = Header(default=None, alias="X-Profile-Request"),
+    admin_token: str | None = Header(default=None, alias="X-Admin-Token"),
     rate_limiter: RateLimiter | None = Depends(get_rate_limiter)
 ):
     if rate_limiter:
         await rate_limiter(request, response)
+    profiling = _profile_requested(profile_request, admin_token)
+    ticket = await _admit(anthropic_api_key)
+    # Started once admitted, so the profile is of the pipeline rather than of the wait for a slot
+    sampler = StackSampler(task=asyncio.current_task()).start() if profiling else None
     
     try:
-        logger.info(f"Received request: {prompt_request}")
+        log_payload("Received request", prompt_request.model_dump())
         
-        eng = engine(openai_api_key=openai_api_key, anthropic_api_key=anthropic_api_key)
+        # Engines are pooled per API key, building the clients on every request is expensive
+        eng, profile, few_shot = await _resolve_engine(prompt_request, openai_api_key, anthropic_api_key)
+        history = await _resolve_history(prompt_request, anthropic_api_key)
         
         result = await eng.get_answer(
             prompt_request.user_input, 
-            prompt_request.few_shot, 
+            few_shot, 
             prompt_request.format_response, 
-            prompt_request.history
+            history,
+            include_trace=prompt_request.include_trace,
+            profile=profile,
+            rewrite_question=prompt_request.conversation_id is not None
         )
+        if profile is not None:
+            result = {**result, "profile": profile.name}
+        if prompt_request.conversation_id is not None:
+            await get_sessions().arecord_turn(_conversation_key(prompt_request, anthropic_api_key), prompt_request.user_input, result["answer"], eng.query_translator)
+            result = {**result, "conversation_id": prompt_request.conversation_id}
+        if sampler is not None:
+            sampler.stop()
+            result = {**result, "pipeline_profile": sampler.as_dict(PIPELINE_PROFILE_TOP)}
         
-        logger.info(f"Prompt response: {result}")
+        log_payload("Prompt response", result)
         
         return result
     except Exception as e:
         logger.error(f"Error processing request: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e)) from e
+    finally:
+        _stop_sampler(sampler)
+        _release(ticket)
+
+# Formats a single Server-Sent Event
+def _format_sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.post("/prompt/stream")
+async def prompt_stream(
+    request: Request,
+    response: Response,
+    prompt_request: PromptRequest,
+    openai_api_key: str = Header(..., alias="X-OpenAI-API-Key"),
+    anthropic_api_key: str = Header(..., alias="X-Anthropic-API-Key"),
+    profile_request: str | None = Header(default=None, alias="X-Profile-Request"),
+    admin_token: str | None = Header(default=None, alias="X-Admin-Token"),
+    rate_limiter: RateLimiter | None = Depends(get_rate_limiter)
+):
+    if rate_limiter:
+        await rate_limiter(request, response)
+    profiling = _profile_requested(profile_request, admin_token)
+
+    log_payload("Received streaming request", prompt_request.model_dump())
+    ticket = await _admit(anthropic_api_key)
+    try:
+        eng, profile, few_shot = await _resolve_engine(prompt_request, openai_api_key, anthropic_api_key)
+        history = await _resolve_history(prompt_request, anthropic_api_key)
+    except BaseException:
+        _release(ticket)
+        raise
+
+    async def event_stream():
+        start = time.perf_counter()
+        first_token = True
+        # The body is streamed from its own task, so the profile follows that one
+        sampler = StackSampler(task=asyncio.current_task()).start() if profiling else None
+        try:
+            async for event, data in _answer_events(prompt_request, eng, profile, few_shot, history):
+                if event == "token" and first_token:
+                    first_token = False
+                    logger.info("Time to first visible token", extra={"seconds": round(time.perf_counter() - start, 3)})
+                yield _format_sse(event, data)
+            if sampler is not None:
+                sampler.stop()
+                yield _format_sse("pipeline_profile", sampler.as_dict(PIPELINE_PROFILE_TOP))
+        except Exception as e:
+            # Headers are already sent, so errors have to be reported in-band
+            logger.error(f"Error streaming response: {str(e)}")
+            yield _format_sse("error", {"detail": str(e)})
+        finally:
+            _stop_sampler(sampler)
+            _release(ticket)
+
+    # The slot is also released after the response, in case the client left before the stream started
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        background=BackgroundTask(_release, ticket)
+    )
+
+'''
+Streams the answer to a request as (event, data) tuples, for /prompt/stream and the job workers.
+The turn is added to the request's conversation once the answer has finished.
+'''
+async def _answer_events(prompt_request, eng, profile, few_shot, history):
+    answer = []
+    if profile is not None:
+        yield "profile", {"profile": profile.name, "model": profile.model}
+    async for event, data in eng.stream_answer(
+        prompt_request.user_input,
+        few_shot,
+        prompt_request.format_response,
+        history,
+        include_trace=prompt_request.include_trace,
+        profile=profile,
+        rewrite_question=prompt_request.conversation_id is not None
+    ):
+        if event == "token":
+            answer.append(data)
+        yield event, data
+    # Only finished answers become part of the conversation
+    if prompt_request.conversation_id is not None:
+        await get_sessions().arecord_turn(_conversation_key(prompt_request, eng.anthropic_api_key), prompt_request.user_input, "".join(answer), eng.query_translator)
+
+'''
+Runs a queued job (see jobs.py), yielding the same events as /prompt/stream
+'''
+async def run_job(request, secrets):
+    prompt_request = PromptRequest(**request)
+    eng, profile, few_shot = await _resolve_engine(prompt_request, secrets["openai_api_key"], secrets["anthropic_api_key"])
+    history = await _resolve_history(prompt_request, secrets["anthropic_api_key"])
+    async for event in _answer_events(prompt_request, eng, profile, few_shot, history):
+        yield event
+
+@app.post("/jobs", status_code=202)
+async def submit_job(
+    request: Request,
+    response: Response,
+    prompt_request: PromptRequest,
+    openai_api_key: str = Header(..., alias="X-OpenAI-API-Key"),
+    anthropic_api_key: str = Header(..., alias="X-Anthropic-API-Key"),
+    rate_limiter: RateLimiter | None = Depends(get_rate_limiter)
+):
+    if rate_limiter:
+        await rate_limiter(request, response)
+
+    try:
+        job = await get_job_queue().submit(
+            prompt_request.model_dump(),
+            {"openai_api_key": openai_api_key, "anthropic_api_key": anthropic_api_key}
+        )
+    except JobQueueFull as e:
+        raise HTTPException(status_code=503, detail="The job queue is full, please try again later") from e
+    logger.info(f"Queued job {job['id']}")
+    return {"job_id": job["id"], "status": job["status"]}
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = await get_job_queue().get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@app.get("/jobs/{job_id}/stream")
+async def stream_job(job_id: str):
+    job_queue = get_job_queue()
+    if await job_queue.get(job_id) is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    async def event_stream():
+        try:
+            async for event, data in job_queue.events(job_id):
+                yield _format_sse(event, data)
+        except Exception as e:
+            logger.error(f"Error streaming job {job_id}: {str(e)}")
+            yield _format_sse("error", {"detail": str(e)})
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+'''
+Profiles the whole worker for a number of seconds, writing its collapsed stacks to PROFILE_OUTPUT_DIR for
+flamegraph.pl or speedscope. Only one runs at a time.
+'''
+@app.post("/admin/profile", dependencies=[Depends(require_admin)])
+async def admin_profile(seconds: float = Query(default=10, gt=0, le=PROFILE_MAX_SECONDS), top: int = Query(default=20, ge=1, le=200)):
+    result = await profile_process(seconds, top)
+    if result is None:
+        raise HTTPException(status_code=409, detail="A profile is already running")
+    return result
+
+# Starts tracing allocations, with now as the baseline of later diffs
+@app.post("/admin/memory/start", dependencies=[Depends(require_admin)])
+async def admin_memory_start():
+    await asyncio.to_thread(get_memory_tracker().start)
+    return {"tracing": True}
+
+'''
+Returns what grew the most since tracing started, or since the last reset
+'''
+@app.get("/admin/memory/diff", dependencies=[Depends(require_admin)])
+async def admin_memory_diff(
+    group_by: Literal["lineno", "filename", "traceback"] = "lineno",
+    limit: int = Query(default=20, ge=1, le=200),
+    reset: bool = False
+):
+    tracker = get_memory_tracker()
+    if not tracker.tracing:
+        raise HTTPException(status_code=409, detail="Memory tracing isn't running, start it first")
+    diff = await asyncio.to_thread(tracker.diff, group_by, limit)
+    if reset:
+        await asyncio.to_thread(tracker.reset)
+    return diff
+
+@app.post("/admin/memory/stop", dependencies=[Depends(require_admin)])
+async def admin_memory_stop():
+    get_memory_tracker().stop()
+    return {"tracing": False}
@@ -0,0 +1,123 @@
+import os
+
+# prometheus_client is only imported once metrics are recorded or rendered, so it's not needed with METRICS_ENABLED=false
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+# With several uvicorn workers, set PROMETHEUS_MULTIPROC_DIR to an empty directory before starting them. Each worker
+# then writes its samples to memory-mapped files there, and /metrics adds them up across every worker.
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+
+REQUEST_BUCKETS = (0.25, 0.5, 1, 2, 3, 5, 7.5, 10, 15, 20, 30, 45, 60)
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2, 3, 5, 10, 20, 30)
+
+class Metrics:
+    """
+    The service's Prometheus metrics. Created once per process, as prometheus_client registers each metric by name.
+    """
+    def __init__(self):
+        from prometheus_client import Counter, Histogram
+
+        self.request_duration = Histogram("rag_request_duration_seconds", "End-to-end duration of answered questions",
+                                          ["streaming", "outcome"], buckets=REQUEST_BUCKETS)
+        self.stage_duration = Histogram("rag_stage_duration_seconds", "Duration of each pipeline stage, from the request traces",
+                                        ["stage"], buckets=STAGE_BUCKETS)
+        self.tokens = Counter("rag_tokens_total", "LLM tokens by model and kind (input, output, cache_read, cache_write)", ["model", "kind"])
+        self.cost = Counter("rag_cost_dollars_total", "Estimated cost in dollars by kind (generation, retrieval, translation)", ["kind"])
+        self.routing_decisions = Counter("rag_routing_decisions_total", "Multi-query routing decisions by router", ["router", "multi_query"])
+        self.cache_requests = Counter("rag_cache_requests_total", "Cache lookups by cache and result", ["cache", "result"])
+        self.upstream_errors = Counter("rag_upstream_errors_total", "Failed pipeline stages by stage and error", ["stage", "error"])
+        self.upstream_timeouts = Counter("rag_upstream_timeouts_total", "Pipeline stages which ran out of time", ["stage"])
+
+_metrics = None
+
+'''
+Returns the process's Metrics, created on first use
+'''
+def get_metrics():
+    global _metrics
+    if _metrics is None:
+        _metrics = Metrics()
+    return _metrics
+
+# Span attributes holding token counts, by the kind they're reported as
+TOKEN_ATTRIBUTES = {"input_tokens": "input", "output_tokens": "output", "cache_read_tokens": "cache_read", "cache_write_tokens": "cache_write"}
+COST_ATTRIBUTES = {"generation_cost": "generation", "retrieval_cost": "retrieval", "translation_cost": "translation"}
+
+'''
+Records a finished request's metrics from its trace (see tracing.py), so the pipeline needs no instrumentation of its
+own. Called by export_trace for every request.
+
+Parameters:
+- trace: The finished RequestTrace
+'''
+def record_trace(trace):
+    if not METRICS_ENABLED:
+        return
+    metrics = get_metrics()
+    attributes = trace.attributes
+    if "error" in attributes:
+        outcome = "error"
+    elif attributes.get("cached"):
+        outcome = "cached"
+    else:
+        outcome = "ok"
+    metrics.request_duration.labels(streaming=str(bool(attributes.get("streaming"))).lower(), outcome=outcome).observe(trace.duration)
+    for attribute, kind in COST_ATTRIBUTES.items():
+        if attributes.get(attribute):
+            metrics.cost.labels(kind=kind).inc(attributes[attribute])
+
+    timed_out = False
+    for span in trace.spans:
+        metrics.stage_duration.labels(stage=span.name).observe(span.duration)
+        span_attributes = span.attributes
+        model = span_attributes.get("model")
+        if model and model != "local":
+            for attribute, kind in TOKEN_ATTRIBUTES.items():
+                if span_attributes.get(attribute):
+                    metrics.tokens.labels(model=model, kind=kind).inc(span_attributes[attribute])
+        if span.name == "routing" and "use_multi_query" in span_attributes:
+            metrics.routing_decisions.labels(router="local" if model == "local" else "llm",
+                                             multi_query=str(bool(span_attributes["use_multi_query"])).lower()).inc()
+        _record_cache(metrics, span)
+        error = span_attributes.get("error")
+        # Cancelled spans were stopped by something else, e.g. the retrieval timeout, which is counted below
+        if error == "TimeoutError":
+            timed_out = True
+            metrics.upstream_timeouts.labels(stage=span.name).inc()
+        elif error and error != "CancelledError":
+            metrics.upstream_errors.labels(stage=span.name, error=error).inc()
+
+    # Retrieval's timeout cancels its spans rather than timing out within one
+    if attributes.get("degraded") == "direct_after_timeout" or (attributes.get("error_type") == "TimeoutError" and not timed_out):
+        metrics.upstream_timeouts.labels(stage="retrieval").inc()
+
+def _record_cache(metrics, span):
+    attributes = span.attributes
+    if span.name == "answer_cache" and "hit" in attributes:
+        metrics.cache_requests.labels(cache="answer", result="hit" if attributes["hit"] else "miss").inc()
+    elif span.name == "embedding" and "misses" in attributes:
+        _count_cache(metrics, "embedding", attributes.get("memory_hits", 0) + attributes.get("shared_hits", 0), attributes["misses"])
+    elif span.name == "neighbour_expansion" and "cache_hits" in attributes:
+        _count_cache(metrics, "neighbour", attributes["cache_hits"], attributes.get("fetched", 0) + attributes.get("not_found", 0))
+
+def _count_cache(metrics, cache, hits, misses):
+    if hits:
+        metrics.cache_requests.labels(cache=cache, result="hit").inc(hits)
+    if misses:
+        metrics.cache_requests.labels(cache=cache, result="miss").inc(misses)
+
+'''
+Returns the metrics in the Prometheus text format and its content type, added up across the uvicorn workers
+when PROMETHEUS_MULTIPROC_DIR is set. Nothing is rendered when METRICS_ENABLED is false.
+'''
+def render_metrics():
+    if not METRICS_ENABLED:
+        return b"", "text/plain; version=0.0.4; charset=utf-8"
+    from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, generate_latest, multiprocess
+
+    get_metrics()
+    if PROMETHEUS_MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
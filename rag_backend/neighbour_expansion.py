@@ -0,0 +1,191 @@
+import os
+import re
+import threading
+from collections import OrderedDict
+
+from langchain_core.documents import Document
+
+try:
+    from .deadline import get_hedger
+    from .executors import get_executor
+    from .rank_fusion import document_key
+except ImportError:
+    from deadline import get_hedger
+    from executors import get_executor
+    from rank_fusion import document_key
+
+NEIGHBOUR_EXPANSION = os.getenv("NEIGHBOUR_EXPANSION", "false").lower() == "true"
+# Splits added on either side of a hit, and the number of top hits expanded
+NEIGHBOUR_WINDOW = int(os.getenv("NEIGHBOUR_WINDOW", "1"))
+NEIGHBOUR_EXPANSION_TOP = int(os.getenv("NEIGHBOUR_EXPANSION_TOP", "3"))
+NEIGHBOUR_CACHE_SIZE = int(os.getenv("NEIGHBOUR_CACHE_SIZE", "4096"))
+
+# The vector ids created by the scraper-indexer (see TranscriptIndexer.process_and_index_chunks)
+VECTOR_ID_PATTERN = re.compile(r"^(?P<video_id>.+)_chunk(?P<chunk>\d+)_split(?P<split>\d+)$")
+# Metadata key holding the last split of a merged passage, the first being split_index
+LAST_SPLIT_KEY = "last_split_index"
+
+'''
+Returns (video_id, chunk index, split index) for a vector id, or None if it isn't a split id
+'''
+def parse_vector_id(vector_id):
+    match = VECTOR_ID_PATTERN.match(vector_id)
+    if match is None:
+        return None
+    return match["video_id"], int(match["chunk"]), int(match["split"])
+
+def vector_id(video_id, chunk_index, split_index):
+    return f"{video_id}_chunk{chunk_index}_split{split_index}"
+
+class SplitCache:
+    """
+    Thread-safe LRU of fetched splits by vector id. Ids which don't exist (past the last split of a chunk)
+    are cached as None, so the same misses aren't fetched again.
+
+    Parameters:
+    - max_size: The number of ids kept
+    """
+    def __init__(self, max_size=NEIGHBOUR_CACHE_SIZE):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    '''
+    Returns the cached entries for the ids which are cached, and the ids which aren't
+    '''
+    def get_many(self, split_ids):
+        found = {}
+        missing = []
+        with self._lock:
+            for split_id in split_ids:
+                if split_id in self._entries:
+                    self._entries.move_to_end(split_id)
+                    found[split_id] = self._entries[split_id]
+                else:
+                    missing.append(split_id)
+        return found, missing
+
+    def put_many(self, entries):
+        with self._lock:
+            for split_id, doc in entries.items():
+                self._entries[split_id] = doc
+                self._entries.move_to_end(split_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+class NeighbourExpander:
+    """
+    "Sentence window" expansion of the top hits. The splits either side of a hit are addressed by vector id and
+    fetched in one batch, then merged with the hit (and any other retrieved split they touch) into one contiguous
+    passage. Neighbours are taken from the hit's chunk only, as the number of splits in the previous chunk isn't
+    known from the id.
+
+    Parameters:
+    - store: The vector store, anything with fetch_documents(ids) returning a dict of the ids found
+    - window: The number of splits added on either side of a hit
+    - top_n: The number of top hits expanded
+    - cache: The SplitCache of fetched splits
+    """
+    def __init__(self, store, window=NEIGHBOUR_WINDOW, top_n=NEIGHBOUR_EXPANSION_TOP, cache=None):
+        self.store = store
+        self.window = window
+        self.top_n = top_n
+        self.cache = cache if cache is not None else SplitCache()
+
+    '''
+    Expands the top hits into passages, keeping the rank order. Retrieved splits absorbed into a passage are dropped
+    from their own position.
+
+    Parameters:
+    - documents: The retrieved documents, best first
+    - span: An optional tracing span to record the fetches on
+
+    Returns:
+    - The documents with the top hits replaced by passages
+    '''
+    async def aexpand(self, documents, span=None):
+        known = {document_key(doc): doc for doc in documents}
+        hits = []
+        for doc in documents[:self.top_n]:
+            position = parse_vector_id(document_key(doc))
+            if position is not None:
+                hits.append((doc, position))
+        wanted = [
+            vector_id(video_id, chunk, split)
+            for _, (video_id, chunk, split) in hits
+            for split in range(max(split - self.window, 0), split + self.window + 1)
+        ]
+        wanted = [split_id for split_id in dict.fromkeys(wanted) if split_id not in known]
+        cached, missing = self.cache.get_many(wanted)
+        fetched = {}
+        if missing:
+            fetched = await get_hedger("vector_fetch").call(lambda: get_executor("vector_search").run(self.store.fetch_documents, missing))
+            self.cache.put_many({split_id: fetched.get(split_id) for split_id in missing})
+        available = {**known, **{k: v for k, v in cached.items() if v is not None}, **fetched}
+
+        passages, absorbed = self._merge(hits, available)
+        expanded = []
+        for doc in documents:
+            key = document_key(doc)
+            if key in passages:
+                expanded.append(passages[key])
+            elif key not in absorbed:
+                expanded.append(doc)
+        if span is not None:
+            span.set(hits=len(hits), cache_hits=len(cached), fetched=len(fetched), not_found=len(missing) - len(fetched),
+                     passages=len(passages), absorbed=len(absorbed))
+        return expanded
+
+    # Builds a passage per run of contiguous splits around the hits, keyed on the best ranked hit in the run
+    def _merge(self, hits, available):
+        runs = {}
+        for doc, (video_id, chunk, split) in hits:
+            start = split
+            while start > max(split - self.window, 0) and vector_id(video_id, chunk, start - 1) in available:
+                start -= 1
+            end = split
+            while end < split + self.window and vector_id(video_id, chunk, end + 1) in available:
+                end += 1
+            runs.setdefault((video_id, chunk), []).append([start, end, document_key(doc)])
+
+        hit_order = {document_key(doc): rank for rank, (doc, _) in enumerate(hits)}
+        passages = {}
+        absorbed = set()
+        for (video_id, chunk), intervals in runs.items():
+            merged = []
+            for start, end, hit_key in sorted(intervals, key=lambda interval: interval[0]):
+                if merged and start <= merged[-1][1] + 1:
+                    merged[-1][1] = max(merged[-1][1], end)
+                    merged[-1][2].append(hit_key)
+                else:
+                    merged.append([start, end, [hit_key]])
+            for start, end, hit_keys in merged:
+                best = min(hit_keys, key=hit_order.get)
+                split_ids = [vector_id(video_id, chunk, split) for split in range(start, end + 1)]
+                passages[best] = self._passage(available[best], [available[split_id] for split_id in split_ids], start, end)
+                absorbed.update(split_id for split_id in split_ids if split_id != best)
+        return passages, absorbed
+
+    def _passage(self, hit, splits, start, end):
+        if len(splits) == 1:
+            return hit
+        metadata = {**hit.metadata, "split_index": start, LAST_SPLIT_KEY: end}
+        return Document(
+            id=getattr(hit, "id", None),
+            page_content=" ".join(split.page_content for split in splits),
+            metadata=metadata
+        )
+
+_expander = None
+_lock = threading.Lock()
+
+'''
+Returns the process-wide NeighbourExpander over the given store, so the fetched split LRU is shared by every engine
+'''
+def get_neighbour_expander(store):
+    global _expander
+    if _expander is None:
+        with _lock:
+            if _expander is None:
+                _expander = NeighbourExpander(store)
+    return _expander
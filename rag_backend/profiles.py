@@ -0,0 +1,91 @@
+import os
+import re
+from typing import NamedTuple, Optional
+
+try:
+    from .local_router import get_local_router
+    from .rag_engine import CLAUDE_HAIKU_MODEL, CLAUDE_SONNET_MODEL, ROUTING_ALWAYS, ROUTING_DIRECT
+except ImportError:
+    from local_router import get_local_router
+    from rag_engine import CLAUDE_HAIKU_MODEL, CLAUDE_SONNET_MODEL, ROUTING_ALWAYS, ROUTING_DIRECT
+
+PROFILE_FAST = "fast"
+PROFILE_BALANCED = "balanced"
+PROFILE_THOROUGH = "thorough"
+PROFILE_AUTO = "auto"
+
+# Questions up to this many words with a factual opener can be answered by the fast profile
+AUTO_FAST_MAX_WORDS = int(os.getenv("AUTO_FAST_MAX_WORDS", "12"))
+# The local router's multi-query probability above which "auto" never picks the fast profile
+AUTO_MULTI_QUERY_PROBABILITY = float(os.getenv("AUTO_MULTI_QUERY_PROBABILITY", "0.5"))
+
+FACTUAL_OPENER = re.compile(r"^(what|who|when|where|which|how (much|many|long|often)|is|are|does|do|can|should)\b", re.IGNORECASE)
+# Questions asking to relate, compare or explain need more context than a lookup
+COMPLEX_CUE = re.compile(r"\b(why|compare|comparison|difference|differences|versus|vs|between|explain|relationship|mechanism|mechanisms|pros|cons|trade-?offs?)\b", re.IGNORECASE)
+
+class Profile(NamedTuple):
+    """
+    A latency tier, bundling the generation model with how much work goes into retrieval
+
+    - name: The profile's name, reported in the response
+    - model: The Claude model the answer is generated with
+    - k: The number of retrieved splits passed on to generation
+    - routing: The multi-query routing mode, None for the engine's default (MULTI_QUERY_ROUTING)
+    - use_reranking: Whether multi-query results are fused with Reciprocal Rank Fusion
+    - few_shot: Whether the few-shot prompt is used
+    """
+    name: str
+    model: str
+    k: int
+    routing: Optional[str]
+    use_reranking: bool
+    few_shot: bool
+
+PROFILES = {
+    # Haiku over the top few splits of one direct search, for sub-3-second interactive answers
+    PROFILE_FAST: Profile(PROFILE_FAST, CLAUDE_HAIKU_MODEL, k=3, routing=ROUTING_DIRECT, use_reranking=False, few_shot=False),
+    # What the API has always done
+    PROFILE_BALANCED: Profile(PROFILE_BALANCED, CLAUDE_SONNET_MODEL, k=5, routing=None, use_reranking=True, few_shot=True),
+    PROFILE_THOROUGH: Profile(PROFILE_THOROUGH, CLAUDE_SONNET_MODEL, k=8, routing=ROUTING_ALWAYS, use_reranking=True, few_shot=True),
+}
+
+'''
+Picks a tier for a question from cheap features of the text and, when there is one, the local router's signal.
+Short factual lookups go to the fast profile, anything which looks like it needs several angles stays on balanced.
+The thorough profile is never picked automatically, as it costs more for every question.
+
+Parameters:
+- question: The user's question
+- multi_query_probability: The local router's probability that multi-query retrieval would help, if known
+
+Returns:
+- The chosen Profile
+'''
+def choose_profile(question, multi_query_probability=None):
+    words = len(question.split())
+    if multi_query_probability is not None and multi_query_probability >= AUTO_MULTI_QUERY_PROBABILITY:
+        return PROFILES[PROFILE_BALANCED]
+    if words <= AUTO_FAST_MAX_WORDS and FACTUAL_OPENER.match(question.strip()) and not COMPLEX_CUE.search(question):
+        return PROFILES[PROFILE_FAST]
+    return PROFILES[PROFILE_BALANCED]
+
+'''
+Resolves a requested profile name, deciding "auto" with choose_profile
+
+Parameters:
+- name: The requested profile
+- question: The user's question
+- aembed: An optional async function embedding the question, only called when the local router is loaded.
+  The embedding cache means retrieval reuses the vector, so this adds no embedding call.
+
+Returns:
+- The Profile
+'''
+async def aresolve_profile(name, question, aembed=None):
+    if name != PROFILE_AUTO:
+        return PROFILES[name]
+    probability = None
+    router = get_local_router()
+    if router is not None and aembed is not None:
+        probability = float(router.predict_proba(await aembed(question)))
+    return choose_profile(question, probability)
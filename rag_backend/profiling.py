@@ -0,0 +1,295 @@
+import asyncio
+import gc
+import hmac
+import os
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+# Nothing here runs, and the admin endpoints and profile header are ignored, unless this is on and ADMIN_TOKEN is set
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "false").lower() == "true"
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+PROFILE_SAMPLE_INTERVAL_MS = float(os.getenv("PROFILE_SAMPLE_INTERVAL_MS", "5"))
+# The longest process-wide profile, and where its collapsed stacks are written
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "60"))
+PROFILE_OUTPUT_DIR = os.getenv("PROFILE_OUTPUT_DIR", os.path.join(tempfile.gettempdir(), "rag_profiles"))
+# Frames kept per allocation traceback while tracemalloc is on
+TRACEMALLOC_FRAMES = int(os.getenv("TRACEMALLOC_FRAMES", "25"))
+
+MAX_STACK_DEPTH = 128
+# Top frames of threads with nothing to do; the event loop waiting for I/O, and pool threads waiting for work
+IDLE_FRAMES = {("selectors.py", "select"), ("threading.py", "wait"), ("queue.py", "get"), ("thread.py", "_worker")}
+
+'''
+Whether profiling is on and the token is the admin token, compared in constant time
+'''
+def is_admin(token):
+    return PROFILING_ENABLED and bool(ADMIN_TOKEN) and bool(token) and hmac.compare_digest(token.encode("utf-8"), ADMIN_TOKEN.encode("utf-8"))
+
+def _frame_name(frame):
+    code = frame.f_code
+    # co_qualname is only there from Python 3.11
+    return f"{getattr(code, 'co_qualname', code.co_name)} ({os.path.basename(code.co_filename)})"
+
+def _is_idle(frame):
+    return (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name) in IDLE_FRAMES
+
+# Returns the frames from the outermost caller to the given frame
+def _thread_stack(frame):
+    frames = []
+    while frame is not None and len(frames) < MAX_STACK_DEPTH:
+        frames.append(frame)
+        frame = frame.f_back
+    return frames[::-1]
+
+# Returns the frames of a suspended task, following what each coroutine (or async generator) is awaiting
+def _await_stack(task):
+    frames = []
+    awaitable = task.get_coro()
+    while awaitable is not None and len(frames) < MAX_STACK_DEPTH:
+        frame = getattr(awaitable, "cr_frame", None) or getattr(awaitable, "ag_frame", None) or getattr(awaitable, "gi_frame", None)
+        if frame is None:
+            break
+        frames.append(frame)
+        awaitable = getattr(awaitable, "cr_await", None) or getattr(awaitable, "ag_await", None) or getattr(awaitable, "gi_yieldfrom", None)
+    return frames
+
+# Samplers following a request's tasks, and the task factory there was before they were added
+_request_samplers = []
+_previous_task_factory = None
+
+# Installed only while a request is profiled, so tasks created by the request's tasks join its family
+def _task_factory(loop, coro, **kwargs):
+    if _previous_task_factory is not None:
+        task = _previous_task_factory(loop, coro, **kwargs)
+    else:
+        task = asyncio.Task(coro, loop=loop, **kwargs)
+    parent = asyncio.current_task(loop)
+    for sampler in _request_samplers:
+        sampler._adopt(task, parent)
+    return task
+
+class StackSampler:
+    """
+    Wall-clock sampling profiler. A background thread records stacks each interval as collapsed stacks
+    ("outer;inner count", the input of flamegraph.pl and speedscope). Only runs between start and stop, so there's
+    no cost otherwise.
+
+    Without a task it profiles the process, sampling every busy thread and the event loop's idle time.
+    With a task it profiles a request; the tasks the request's task creates (directly or not) are followed through a
+    task factory installed while it runs. Each sample records the event loop's stack when it is running one of them,
+    and where each of the request's waiting leaf tasks is waiting, so the time spent awaiting upstreams shows up.
+    Concurrent branches each count, the profile is of task time rather than of one thread.
+
+    Parameters:
+    - interval: The seconds between samples
+    - task: The request's root task, None to profile the process
+    """
+    def __init__(self, interval=PROFILE_SAMPLE_INTERVAL_MS / 1000, task=None):
+        self.interval = interval
+        self.task = task
+        self.stacks = Counter()
+        self.samples = 0
+        self.loop = None
+        self.loop_thread = None
+        self._parents = {task: None} if task is not None else {}
+        self._family_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    '''
+    Starts sampling, from the event loop's thread
+    '''
+    def start(self):
+        global _previous_task_factory
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        if self.task is not None:
+            if not _request_samplers:
+                _previous_task_factory = self.loop.get_task_factory()
+                self.loop.set_task_factory(_task_factory)
+            _request_samplers.append(self)
+        self._thread = threading.Thread(target=self._run, name="rag-profiler", daemon=True)
+        self._thread.start()
+        return self
+
+    '''
+    Stops sampling, returning the collapsed stacks and their sample counts. Stopping more than once does nothing.
+    '''
+    def stop(self):
+        if self._stop.is_set():
+            return self.stacks
+        self._stop.set()
+        if self in _request_samplers:
+            _request_samplers.remove(self)
+            if not _request_samplers:
+                self.loop.set_task_factory(_previous_task_factory)
+        if self._thread is not None:
+            self._thread.join()
+        return self.stacks
+
+    def collapsed(self):
+        return "\n".join(f"{stack} {count}" for stack, count in self.stacks.most_common())
+
+    def as_dict(self, top=None):
+        return {
+            "interval_ms": round(self.interval * 1000, 3),
+            "samples": self.samples,
+            "stacks": [{"stack": stack, "samples": count} for stack, count in self.stacks.most_common(top)],
+        }
+
+    def _adopt(self, task, parent):
+        with self._family_lock:
+            if parent in self._parents:
+                self._parents[task] = parent
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.samples += 1
+            if self.task is None:
+                self._sample_process()
+            else:
+                self._sample_request()
+
+    def _sample_process(self):
+        own = threading.get_ident()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own:
+                continue
+            if not _is_idle(frame):
+                stack = ";".join(_frame_name(f) for f in _thread_stack(frame))
+            elif thread_id == self.loop_thread:
+                stack = "<idle>"
+            else:
+                continue
+            self.stacks[f"{names.get(thread_id, thread_id)};{stack}"] += 1
+
+    def _sample_request(self):
+        with self._family_lock:
+            pending = [task for task in self._parents if not task.done()]
+            waited_on = {self._parents[task] for task in pending}
+        running = asyncio.current_task(self.loop)
+        if running in pending:
+            frame = sys._current_frames().get(self.loop_thread)
+            if frame is not None:
+                self.stacks[";".join(_frame_name(f) for f in _thread_stack(frame))] += 1
+        for task in pending:
+            if task is not running and task not in waited_on:
+                self.stacks[";".join([*(_frame_name(f) for f in _await_stack(task)), "<awaiting>"])] += 1
+
+_process_profile_lock = None
+
+'''
+Profiles the whole process for a number of seconds, writing its collapsed stacks to PROFILE_OUTPUT_DIR
+
+Parameters:
+- seconds: How long to profile for, at most PROFILE_MAX_SECONDS
+- top: The number of most sampled stacks returned
+
+Returns:
+- The file written, the sample count and the most sampled stacks, or None if a profile is already running
+'''
+async def profile_process(seconds, top=20):
+    global _process_profile_lock
+    # Created on first use, as before Python 3.10 a lock is bound to the event loop current when it's created
+    if _process_profile_lock is None:
+        _process_profile_lock = asyncio.Lock()
+    if _process_profile_lock.locked():
+        return None
+    async with _process_profile_lock:
+        sampler = StackSampler().start()
+        try:
+            await asyncio.sleep(min(seconds, PROFILE_MAX_SECONDS))
+        finally:
+            sampler.stop()
+        path = os.path.join(PROFILE_OUTPUT_DIR, f"profile-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}.collapsed")
+        await asyncio.to_thread(_write, path, sampler.collapsed())
+        return {"path": path, **sampler.as_dict(top)}
+
+def _write(path, text):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text + "\n")
+
+class MemoryTracker:
+    """
+    tracemalloc snapshot diffs against a baseline, with live object counts by type, to find what grows between two
+    points, e.g. cached clients or LangChain runnables piling up. tracemalloc slows every allocation while it's on,
+    so it's only on between start and stop.
+    """
+    def __init__(self):
+        self.baseline = None
+        self.baseline_types = None
+
+    @property
+    def tracing(self):
+        return tracemalloc.is_tracing()
+
+    def start(self, frames=TRACEMALLOC_FRAMES):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+        self.reset()
+
+    def stop(self):
+        tracemalloc.stop()
+        self.baseline = None
+        self.baseline_types = None
+
+    '''
+    Makes now the point later diffs are taken against
+    '''
+    def reset(self):
+        self.baseline = self._snapshot()
+        self.baseline_types = self._type_counts()
+
+    '''
+    Returns the allocation sites and object types which grew the most since the baseline
+
+    Parameters:
+    - group_by: "lineno", "filename" or "traceback"
+    - limit: The number of allocation sites and types returned
+    '''
+    def diff(self, group_by="lineno", limit=20):
+        snapshot = self._snapshot()
+        types = self._type_counts()
+        stats = snapshot.compare_to(self.baseline, group_by)
+        current, peak = tracemalloc.get_traced_memory()
+        growth = Counter({name: count - self.baseline_types.get(name, 0) for name, count in types.items()})
+        return {
+            "traced_bytes": current,
+            "peak_traced_bytes": peak,
+            "allocations": [
+                {
+                    "size_diff": stat.size_diff,
+                    "size": stat.size,
+                    "count_diff": stat.count_diff,
+                    "traceback": [str(frame) for frame in stat.traceback.format()] if group_by == "traceback" else str(stat.traceback[0]),
+                }
+                for stat in stats[:limit]
+            ],
+            "object_growth": [{"type": name, "count_diff": diff, "count": types[name]} for name, diff in growth.most_common(limit) if diff > 0],
+        }
+
+    def _snapshot(self):
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+        ))
+
+    def _type_counts(self):
+        counts = Counter()
+        for obj in gc.get_objects():
+            cls = type(obj)
+            counts[f"{cls.__module__}.{cls.__qualname__}"] += 1
+        return counts
+
+_memory_tracker = MemoryTracker()
+
+def get_memory_tracker():
+    return _memory_tracker
@@ -1,4 +1,4 @@
-
+from functools import lru_cache
 from langchain_core.prompts import(ChatPromptTemplate,
                                    FewShotChatMessagePromptTemplate,
                                    HumanMessagePromptTemplate,
@@ -41,65 +41,14 @@ sys_msg = """
         </vital_instructions>
         """
 
-def get_few_shot_prompt():
-    inp_vars = ["chat_history", "question", "documents"]
-    examples = [
-        example_with_context,
-        example_without_context,
-        example_with_history,
-        example_with_bad_context
-    ]
-
-    # Create the system prompt which is used to give the AI it's role and define rules and restrictions for the chat
-    sys_prompt = SystemMessage(content=sys_msg, cache_control={"type": "ephemeral"})
-
-    # Create the human format prompt which is used to format the human's response
-    human_prompt = HumanMessagePromptTemplate.from_template(
-                """
+# The human turn of the generation prompts, the only part which changes between requests
+human_template = """
                 <chat_history>{chat_history}</chat_history>
                 <scientific_question>{question}</scientific_question>
                 <context>{documents}</context>
                 """
-    )
-
-    # Create the AI format prompt which is used to format the AI's response
-    ai_format_prompt = AIMessage(content="<answer>{answer}</answer>", cache_control={"type": "ephemeral"})
-
-    # Create the few shot prompt providing human and AI format examples, exemplary question / answer pairs and input variables needed
-    few_shot_prompt = FewShotChatMessagePromptTemplate(
-        input_variables = inp_vars,
-        examples = examples,
-        example_prompt = ChatPromptTemplate.from_messages([
-            human_prompt,
-            ai_format_prompt
-        ])
-    )
-
-    # Create the final chat prompt by combining the system prompt, few shot prompt and human prompt
-    final_chat_prompt = ChatPromptTemplate.from_messages([
-        sys_prompt,
-        few_shot_prompt,
-        human_prompt
-    ])
-
-    return final_chat_prompt
-
-# Returns the main prompt for the RAG engine which is used to answer user questions
-def get_main_prompt():
-    return ChatPromptTemplate.from_template(
-            """
-        <chat_history>
-        {chat_history}
-        </chat_history>
-
-        <scientific_question>
-        {question}
-        </scientific_question>
-
-        <context>
-        {documents}
-        </context>
 
+main_sys_msg = """
         <instructions>
         You are an excellent assistant in a high risk environment. You are tasked with providing
         answers to scientific questions based only on the provided context.
@@ -130,7 +79,53 @@ def get_main_prompt():
         If you have to mention it, just call it the "Huberman Lab podcast" or "Huberman Lab YouTube videos".
         </vital_instructions>
         """
-    )
+
+# Marks the end of a cacheable prefix. Anthropic caches everything up to and including the marked block
+# when the prefix is at least 1024 tokens (2048 for Haiku), cache_control is only read from content blocks.
+def _cache_breakpoint(text):
+    return [{"type": "text", "text": text, "cache_control": {"type": "ephemeral"}}]
+
+# Built once per process. The system prompt and examples are literal messages, never re-rendered, so the
+# prefix sent to Anthropic is byte-identical on every request and hits the prompt cache.
+@lru_cache(maxsize=None)
+def get_few_shot_prompt():
+    examples = [
+        example_with_context,
+        example_without_context,
+        example_with_history,
+        example_with_bad_context
+    ]
+
+    # Create the system prompt which is used to give the AI it's role and define rules and restrictions for the chat
+    sys_prompt = SystemMessage(content=sys_msg)
+
+    # Render the exemplary question / answer pairs in the same format as the final human turn
+    example_messages = []
+    for example in examples:
+        example_messages.append(HumanMessage(content=human_template.format(**example)))
+        example_messages.append(AIMessage(content=f"<answer>{example['answer']}</answer>"))
+
+    # One breakpoint after the last example caches the system prompt and every example
+    example_messages[-1] = AIMessage(content=_cache_breakpoint(example_messages[-1].content))
+
+    # Create the final chat prompt, the static prefix followed by the human prompt
+    final_chat_prompt = ChatPromptTemplate.from_messages([
+        sys_prompt,
+        *example_messages,
+        HumanMessagePromptTemplate.from_template(human_template)
+    ])
+
+    return final_chat_prompt
+
+# Returns the main prompt for the RAG engine which is used to answer user questions.
+# The instructions are a static system prompt ahead of the question. At around 450 tokens they're below the
+# minimum cacheable prefix, so only the few-shot prompt has a cache breakpoint.
+@lru_cache(maxsize=None)
+def get_main_prompt():
+    return ChatPromptTemplate.from_messages([
+        SystemMessage(content=main_sys_msg),
+        HumanMessagePromptTemplate.from_template(human_template)
+    ])
 
 # Returns the prompt for the multi query generation chain
 def get_multi_query_generation_prompt():
@@ -162,4 +157,60 @@ def get_check_if_multi_query_should_be_used_prompt():
 
             Decision (Yes/No):
             """
-        )
\ No newline at end of file
+        )
+
+# Returns the prompt for deciding on and generating multiple queries in a single call
+def get_route_and_generate_prompt():
+    return ChatPromptTemplate.from_template(
+            """
+            Analyze the following user query and determine if it would benefit from multi-query generation.
+            Consider the following factors:
+            1. Vagueness: Is the query too broad or unclear?
+            2. Complexity: Does the query involve multiple concepts or require a nuanced understanding?
+            3. Ambiguity: Could the query be interpreted in multiple ways?
+            4. Lack of context: Is there missing information that could lead to multiple interpretations?
+
+            If the query would benefit from multi-query generation, set use_multi_query to true and generate
+            5 different versions of the user query to retrieve relevant documents from a vector database.
+            Otherwise, set use_multi_query to false and leave queries empty.
+
+            User query: {query}
+            """
+        )
+
+# Returns the prompt for rewriting a follow-up question into a standalone retrieval query
+def get_standalone_question_prompt():
+    return ChatPromptTemplate.from_template(
+            """
+            Given the following conversation and a follow-up question, rewrite the follow-up question as a
+            standalone question which can be understood without the conversation. Resolve any pronouns or references
+            to earlier messages, and keep the wording of the original question where you can.
+            If the question is already standalone, return it unchanged. Respond with the question only.
+
+            Conversation:
+            {chat_history}
+
+            Follow-up question: {question}
+
+            Standalone question:
+            """
+        )
+
+# Returns the prompt for folding older conversation turns into the rolling summary
+def get_history_summary_prompt():
+    return ChatPromptTemplate.from_template(
+            """
+            Progressively summarise a conversation between a user and an assistant answering questions using the
+            Huberman Lab podcast. Extend the existing summary with the new messages, keeping the topics discussed,
+            the user's goals and circumstances, and any protocols or recommendations given.
+            Keep the summary under {max_words} words. Respond with the summary only.
+
+            Existing summary:
+            {summary}
+
+            New messages:
+            {messages}
+
+            Updated summary:
+            """
+        )
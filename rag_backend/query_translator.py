@@ -1,56 +1,162 @@
+import asyncio
+
 from langchain_openai import ChatOpenAI
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.documents import Document
+from langchain_core.pydantic_v1 import BaseModel, Field
 
 try:
-    from .prompts import get_check_if_multi_query_should_be_used_prompt, get_multi_query_generation_prompt
+    from .prompts import get_check_if_multi_query_should_be_used_prompt, get_multi_query_generation_prompt, get_route_and_generate_prompt
+    from .prompts import get_history_summary_prompt, get_standalone_question_prompt
+    from .shared_resources import get_tokenizer
+    from .tracing import trace_span
+    from .local_router import ROUTER_DECISION_LOG, get_local_router, log_routing_decision, should_shadow
+    from .logger import logger as logger
+    from .rank_fusion import reciprocal_rank_fusion, unique_union
 except ImportError:
-    from prompts import get_check_if_multi_query_should_be_used_prompt, get_multi_query_generation_prompt
-import tiktoken
+    from prompts import get_check_if_multi_query_should_be_used_prompt, get_multi_query_generation_prompt, get_route_and_generate_prompt
+    from prompts import get_history_summary_prompt, get_standalone_question_prompt
+    from shared_resources import get_tokenizer
+    from tracing import trace_span
+    from local_router import ROUTER_DECISION_LOG, get_local_router, log_routing_decision, should_shadow
+    from logger import logger as logger
+    from rank_fusion import reciprocal_rank_fusion, unique_union
 
 LOW_COST_LLM = "gpt-4o-mini"
+LOW_COST_LLM_INPUT_COST_PER_TOKEN = 0.00000015 # $0.15 per 1m tokens in
+LOW_COST_LLM_OUTPUT_COST_PER_TOKEN = 0.00000060 # $0.60 per 1m tokens out
+
+class MultiQueryPlan(BaseModel):
+    """Routing decision and alternative queries for a user query."""
+    use_multi_query: bool = Field(description="Whether the query would benefit from multi-query generation")
+    queries: list[str] = Field(default_factory=list, description="Alternative versions of the query, empty if use_multi_query is false")
 
 class QueryTranslator:
     # We only need a low cost LLM as it is only used for generating alternative queries
     def __init__(self, openai_api_key):
         self.llm = ChatOpenAI(model=LOW_COST_LLM, api_key=openai_api_key, temperature=0.0)
-        self.total_cost = 0.00
+        # Routes confidently from the question embedding without an LLM call when configured, see local_router.py
+        self.local_router = get_local_router()
+        self._shadow_tasks = set()
+
+    '''
+        Whether routing can use the question's embedding, either to route locally or to log training data.
+        Callers should embed the question before routing when this is true.
+    '''
+    @property
+    def uses_query_vector(self):
+        return self.local_router is not None or bool(ROUTER_DECISION_LOG)
 
     '''
         This method is used to determine if the user query would benefit from multi-query generation.
     '''
     def calculate_cost(self, query, response):
-        input_tokens = len(tiktoken.encoding_for_model(LOW_COST_LLM).encode(query))
-        output_tokens = len(tiktoken.encoding_for_model(LOW_COST_LLM).encode(response))
-        input_cost = input_tokens * 0.00000015 # $0.15 per 1m tokens in
-        output_cost = output_tokens * 0.00000060 # $0.60 per 1m tokens out
-        total_cost = input_cost + output_cost
-        return total_cost
+        input_tokens, output_tokens = self.count_tokens(query, response)
+        return self.calculate_token_cost(input_tokens, output_tokens)
 
     '''
-        This method is used to get the total cost of the query translator.
+        This method is used to estimate the input and output token counts of a call from its text.
     '''
-    def get_total_cost(self):
-        return self.total_cost
+    def count_tokens(self, query, response):
+        tokenizer = get_tokenizer(LOW_COST_LLM)
+        return len(tokenizer.encode(query)), len(tokenizer.encode(response))
 
     '''
-        This method is used to reset the total cost of the query translator.
+        This method is used to calculate the cost of a call from its token counts.
     '''
-    def reset_total_cost(self):
-        self.total_cost = 0.00
+    def calculate_token_cost(self, input_tokens, output_tokens):
+        input_cost = input_tokens * LOW_COST_LLM_INPUT_COST_PER_TOKEN
+        output_cost = output_tokens * LOW_COST_LLM_OUTPUT_COST_PER_TOKEN
+        total_cost = input_cost + output_cost
+        return total_cost
 
     '''
         This method is used to determine if the user query would benefit from multi-query generation.
+        The cost is added to the given per-request RequestCosts object when one is provided.
     '''
-    def should_use_multi_query(self, query):
+    def should_use_multi_query(self, query, costs=None):
         prompt_template = get_check_if_multi_query_should_be_used_prompt()
         
         decision_chain = prompt_template | self.llm | StrOutputParser()
         decision = decision_chain.invoke({"query": query}).strip().lower()
-        self.total_cost += self.calculate_cost(query, decision)
+        cost = self.calculate_cost(query, decision)
+        if costs is not None:
+            costs.translation_cost += cost
+
+        return decision == "yes"
+
+    '''
+        Async version of should_use_multi_query, so the routing call doesn't block the event loop.
+        When the question's embedding is given, the local router decides if it is confident, otherwise the LLM
+        router's decision is logged with the embedding as training data.
+        The decision is recorded as a "routing" span when a RequestTrace is provided.
+    '''
+    async def ashould_use_multi_query(self, query, costs=None, trace=None, query_vector=None):
+        if query_vector is not None and self.local_router is not None:
+            with trace_span(trace, "routing", model="local") as span:
+                decision, probability = self.local_router.decide(query_vector)
+                span.set(probability=round(probability, 4), use_multi_query=decision)
+            if decision is not None:
+                if should_shadow():
+                    task = asyncio.create_task(self._shadow_route(query, query_vector, decision))
+                    self._shadow_tasks.add(task)
+                    task.add_done_callback(self._shadow_tasks.discard)
+                return decision
+
+        decision = await self._allm_should_use_multi_query(query, costs=costs, trace=trace)
+        if query_vector is not None:
+            log_routing_decision(query, query_vector, decision)
+        return decision
+
+    '''
+        Asks the LLM router for a sampled decision the local router already made, to measure their agreement.
+        Runs in the background, so the request neither waits for it nor pays for it.
+    '''
+    async def _shadow_route(self, query, query_vector, local_decision):
+        try:
+            decision = await self._allm_should_use_multi_query(query)
+        except Exception as e:
+            logger.warning(f"Shadow routing call failed: {e}")
+            return
+        self.local_router.record_shadow(local_decision, decision)
+        log_routing_decision(query, query_vector, decision)
+
+    async def _allm_should_use_multi_query(self, query, costs=None, trace=None):
+        prompt_template = get_check_if_multi_query_should_be_used_prompt()
+
+        with trace_span(trace, "routing", model=LOW_COST_LLM) as span:
+            decision_chain = prompt_template | self.llm | StrOutputParser()
+            decision = (await decision_chain.ainvoke({"query": query})).strip().lower()
+            input_tokens, output_tokens = self.count_tokens(query, decision)
+            cost = self.calculate_token_cost(input_tokens, output_tokens)
+            span.set(input_tokens=input_tokens, output_tokens=output_tokens, use_multi_query=decision == "yes")
+        if costs is not None:
+            costs.translation_cost += cost
 
         return decision == "yes"
 
+    '''
+        This method makes the routing decision and generates the alternative queries in one structured LLM call.
+        Returns the alternative queries, or an empty list if multi-query generation shouldn't be used.
+    '''
+    async def aroute_and_generate(self, query, costs=None, trace=None):
+        plan_chain = get_route_and_generate_prompt() | self.llm.with_structured_output(MultiQueryPlan, include_raw=True)
+        with trace_span(trace, "routing", model=LOW_COST_LLM, merged=True) as span:
+            result = await plan_chain.ainvoke({"query": query})
+            usage = result["raw"].usage_metadata or {}
+            span.set(input_tokens=usage.get("input_tokens", 0), output_tokens=usage.get("output_tokens", 0))
+        cost = self.calculate_token_cost(usage.get("input_tokens", 0), usage.get("output_tokens", 0))
+        if costs is not None:
+            costs.translation_cost += cost
+
+        plan = result["parsed"]
+        if plan is None or not plan.use_multi_query:
+            span.set(use_multi_query=False, queries=0)
+            return []
+        queries = [q for q in plan.queries if q.strip()]
+        span.set(use_multi_query=True, queries=len(queries))
+        return queries
+
     '''
         This method is used to generate multiple queries from a user input.
         The alternative queries are used to retrieve more relevant documents from a vector database.
@@ -62,54 +168,75 @@ class QueryTranslator:
 
         return generate_queries_chain
 
+    '''
+        Async version of the multi query generation chain, recording a "query_generation" span with the
+        token usage reported by the LLM when a RequestTrace is provided. The cost is added to the given
+        RequestCosts, including the prompt's estimated cost when the call is cancelled, e.g. by speculative routing.
+    '''
+    async def agenerate_queries(self, query, costs=None, trace=None):
+        prompt_template = get_multi_query_generation_prompt()
+        with trace_span(trace, "query_generation", model=LOW_COST_LLM) as span:
+            try:
+                message = await (prompt_template | self.llm).ainvoke({"user_input": query})
+            except asyncio.CancelledError:
+                # The prompt has most likely been sent and is billed whether or not the answer is read
+                input_tokens, _ = self.count_tokens(prompt_template.format(user_input=query), "")
+                span.set(input_tokens=input_tokens, output_tokens=0, cancelled=True)
+                self._add_cost(input_tokens, 0, costs)
+                raise
+            input_tokens, output_tokens = self._usage(message)
+            queries = StrOutputParser().invoke(message).split("\n")
+            span.set(input_tokens=input_tokens, output_tokens=output_tokens, queries=len(queries))
+        self._add_cost(input_tokens, output_tokens, costs)
+        return queries
+
+    '''
+        This method rewrites a follow-up question into a standalone question, so retrieval searches for what the
+        user is actually asking about rather than "what about the second one?". Falls back to the original question
+        if the LLM returns nothing.
+    '''
+    async def arewrite_question(self, question, chat_history, costs=None, trace=None):
+        with trace_span(trace, "question_rewrite", model=LOW_COST_LLM) as span:
+            message = await (get_standalone_question_prompt() | self.llm).ainvoke({"question": question, "chat_history": chat_history})
+            rewritten = StrOutputParser().invoke(message).strip()
+            input_tokens, output_tokens = self._usage(message)
+            span.set(input_tokens=input_tokens, output_tokens=output_tokens, rewritten=bool(rewritten) and rewritten != question)
+        self._add_cost(input_tokens, output_tokens, costs)
+        return rewritten or question
+
+    '''
+        This method folds older conversation messages into a conversation's rolling summary (see sessions.py)
+    '''
+    async def asummarise_history(self, summary, messages, max_words, costs=None):
+        message = await (get_history_summary_prompt() | self.llm).ainvoke({"summary": summary or "None", "messages": messages, "max_words": max_words})
+        self._add_cost(*self._usage(message), costs)
+        return StrOutputParser().invoke(message).strip()
+
+    def _usage(self, message):
+        usage = message.usage_metadata or {}
+        return usage.get("input_tokens", 0), usage.get("output_tokens", 0)
+
+    def _add_cost(self, input_tokens, output_tokens, costs):
+        cost = self.calculate_token_cost(input_tokens, output_tokens)
+        if costs is not None:
+            costs.translation_cost += cost
+
     '''
         Helper method in multi query generation. Goes through the list of lists of retrieved documents,
-        merges the lists and removes duplicates.
+        merges the lists and removes duplicates. Documents are compared by vector id (see rank_fusion.py)
+        and the original objects are returned.
     '''
     def get_unique_union(self, retrieved_docs):
-        # Flatten list of lists
-        list_all_docs = [doc for sublist in retrieved_docs for doc in sublist]
-        # Create a set of unique tuples representing each document
-        unique_doc_tuples = set(self.serialise_doc(doc=doc) for doc in list_all_docs)
-        # Convert tuples back to Document objects
-        unique_docs = [
-            self.deserialise_doc(doc=t) for t in unique_doc_tuples
-        ]
-        return unique_docs
+        return unique_union(retrieved_docs)
 
     '''
         Reciprocal Rank Fusion is a method of reranking a list of documents based on their relevance to a user query.
         It is used to overcome the limitations of distance-based similarity search, where documents that are similar
-        in content may be far apart in the vector space.
+        in content may be far apart in the vector space. See rank_fusion.py for the weighted version with scores
+        and provenance.
     '''
     def reciprocal_rank_fusion(self, result_docs, k = 60):
-
-        fused_scores = {}
-
-        # Iterate through each list of ranked results List[Document(Metadata dictionary, PageContent)]
-        # Apply Reciprocal Rank Fusion formula to each list of documents, re-ranking the documents
-        for docs in result_docs:
-            for rank, doc in enumerate(docs):
-                # Convert doc to tuple, use as key
-                key = self.serialise_doc(doc=doc)
-                # If no score yet, set to 0
-                if key not in fused_scores:
-                    fused_scores[key] = 0
-                # Reciprocal Rank Fusion formula
-                prev_score = fused_scores[key]
-                fused_scores[key] = prev_score + 1 / (rank + k)
-
-        # Sort documents based on fused scores, highest score ran
-        # The fused score dictionary removes duplicates by using repetitions in the key to improve score
-        # so no need to perform unique union operation
-        reranked_results = [
-            ((doc), score) for doc, score in sorted(fused_scores.items(), key = lambda x: x[1], reverse = True)
-        ]
-
-        # Convert back to Document objects
-        return [
-            self.deserialise_doc(doc=doc) for (doc, score) in reranked_results
-        ]
+        return [result.document for result in reciprocal_rank_fusion(result_docs, k=k)]
 
 # Decided not to serialise/deserialise to JSON as had no real use for it, only used in query translations
 
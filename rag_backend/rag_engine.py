@@ -1,23 +1,49 @@
 import re
 import sys
 import os
-import tiktoken
+import time
 import asyncio
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from langchain_anthropic import ChatAnthropic
 from langchain_openai import OpenAIEmbeddings
 from langchain_core.output_parsers import StrOutputParser
-from langchain_pinecone import PineconeVectorStore
-from pinecone import Pinecone
 from dotenv import (load_dotenv, find_dotenv)
 
 try:
     from .query_translator import QueryTranslator
     from .prompts import get_main_prompt, get_few_shot_prompt
+    from .request_costs import RequestCosts, get_prompt_cache_stats
+    from .retriever import SharedIndexRetriever
+    from .shared_resources import get_vector_store, get_tokenizer, get_keyword_index, hash_api_keys
+    from .thinking_filter import ThinkingStripper
+    from .semantic_cache import get_answer_cache
+    from .shared_resources import aget_index_generation
+    from .embedding_cache import CachedEmbeddings, get_embedding_stores
+    from .context_builder import build_context
+    from .rank_fusion import reciprocal_rank_fusion, unique_union
+    from .tracing import RequestTrace, export_trace, trace_span
+    from .diversity import DIVERSE_SELECTION, DIVERSITY_FETCH_K, select_diverse
+    from .neighbour_expansion import NEIGHBOUR_EXPANSION, get_neighbour_expander
+    from .single_flight import get_single_flight, request_key
+    from .deadline import Deadline, MULTI_QUERY_MIN_SECONDS, RETRIEVAL_BUDGET_SHARE, Timeout
 except ImportError:
     from query_translator import QueryTranslator
     from prompts import get_main_prompt, get_few_shot_prompt
+    from request_costs import RequestCosts, get_prompt_cache_stats
+    from retriever import SharedIndexRetriever
+    from shared_resources import get_vector_store, get_tokenizer, get_keyword_index, hash_api_keys
+    from thinking_filter import ThinkingStripper
+    from semantic_cache import get_answer_cache
+    from shared_resources import aget_index_generation
+    from embedding_cache import CachedEmbeddings, get_embedding_stores
+    from context_builder import build_context
+    from rank_fusion import reciprocal_rank_fusion, unique_union
+    from tracing import RequestTrace, export_trace, trace_span
+    from diversity import DIVERSE_SELECTION, DIVERSITY_FETCH_K, select_diverse
+    from neighbour_expansion import NEIGHBOUR_EXPANSION, get_neighbour_expander
+    from single_flight import get_single_flight, request_key
+    from deadline import Deadline, MULTI_QUERY_MIN_SECONDS, RETRIEVAL_BUDGET_SHARE, Timeout
 from concurrent.futures import TimeoutError
 try:
     from .logger import logger as logger
@@ -28,6 +54,7 @@ except ImportError:
 load_dotenv(find_dotenv(filename=".rag_engine.env"))
 
 EMBEDDING_MODEL="text-embedding-3-large"
+EMBEDDING_DIMENSIONS=3072
 
 CLAUDE_SONNET_MODEL="claude-3-5-sonnet-20240620" # most powerful
 SONNET_INPUT_COST_PER_TOKEN = 0.000003 # $3 per 1m tokens in
@@ -41,13 +68,31 @@ CLAUDE_OPUS_MODEL="claude-3-opus-20240229" # most performant
 OPUS_INPUT_COST_PER_TOKEN = 0.000015 # $15 per 1m tokens in
 OPUS_OUTPUT_COST_PER_TOKEN = 0.000075 # $75 per 1m tokens out
 
+# Prompt cache pricing relative to the model's input price
+CACHE_WRITE_COST_MULTIPLIER = 1.25
+CACHE_READ_COST_MULTIPLIER = 0.1
+
+# How the multi-query decision is made during retrieval
+ROUTING_SEQUENTIAL = "sequential" # route, then generate queries, then retrieve
+ROUTING_SPECULATIVE = "speculative" # route, direct retrieval and query generation run at once, the unused branch is cancelled
+ROUTING_MERGED = "merged" # one structured LLM call both routes and generates the queries
+ROUTING_DIRECT = "direct" # never generate queries, for when hybrid retrieval alone gives enough recall
+ROUTING_ALWAYS = "always" # always generate queries, skipping the routing decision
+DEFAULT_ROUTING = os.getenv("MULTI_QUERY_ROUTING", ROUTING_SPECULATIVE)
+# Documents taken from BM25 per query when hybrid retrieval is on, fused with the dense results using RRF
+KEYWORD_SEARCH_K = int(os.getenv("KEYWORD_SEARCH_K", "5"))
+# RRF weight of each keyword result list relative to a dense one
+KEYWORD_FUSION_WEIGHT = float(os.getenv("KEYWORD_FUSION_WEIGHT", "1.0"))
+
 #TODO: Calculate cost per query after the fact, display to user
 #TODO: Memory: Remember previous questions and answers in chat, and use them to inform the current answer
 #TODO: Ability to go back to previous chats - MAYBE - this would require storing it in a database with user id etc, good learning experience though
 
 class RAGEngine:
     """
-    Constructor class for the RAG engine class
+    Constructor class for the RAG engine class. The vector store (Pinecone or a local snapshot) is a process-wide
+    singleton, only the clients tied to the caller's API keys are built per engine. Engines hold no
+    per-request state, so a pooled engine can serve concurrent requests (see engine_pool.py).
     
     Parameters:
     - index_name: The name of the Pinecone index to use
@@ -56,18 +101,32 @@ class RAGEngine:
     - output_parser: The output parser to use for parsing the output of the LLM
     """
     def __init__(self, openai_api_key, anthropic_api_key, model=CLAUDE_SONNET_MODEL) :
-        self.embedding_model = OpenAIEmbeddings(model=EMBEDDING_MODEL, api_key=openai_api_key)
+        # Query embeddings are cached in process and optionally in a shared tier, see embedding_cache.py
+        memory_store, shared_store = get_embedding_stores()
+        self.embedding_model = CachedEmbeddings(
+            OpenAIEmbeddings(model=EMBEDDING_MODEL, api_key=openai_api_key),
+            model=EMBEDDING_MODEL,
+            memory_store=memory_store,
+            shared_store=shared_store
+        )
         self.anthropic_api_key = anthropic_api_key
-        self.index = Pinecone(api_key=os.getenv("PINECONE_API_KEY")).Index(name=os.getenv("INDEX_NAME"), host=os.getenv("INDEX_HOST"))
-        self.vector_store = PineconeVectorStore(index=self.index, embedding=self.embedding_model)
-        self.retriever = self.vector_store.as_retriever(search_kwargs={"k": 5})
+        # Coalesced requests are only shared between callers with the same keys, see single_flight.py
+        self.credentials_key = hash_api_keys(openai_api_key, anthropic_api_key, model)
+        self.vector_store = get_vector_store()
+        self.retriever = SharedIndexRetriever(
+            vector_store=self.vector_store,
+            embedding_model=self.embedding_model,
+            k=5,
+            keyword_index=get_keyword_index(),
+            keyword_k=KEYWORD_SEARCH_K,
+            fetch_k=DIVERSITY_FETCH_K
+        )
+        self.diverse_selection = DIVERSE_SELECTION
+        self.neighbour_expander = get_neighbour_expander(self.vector_store) if NEIGHBOUR_EXPANSION else None
         self._set_model(model)
         self.output_parser = StrOutputParser()
         self.query_translator = QueryTranslator(openai_api_key=openai_api_key)
-
-        self.generation_cost = 0.00
-        self.retrieval_cost = 0.00
-        self.translation_cost = 0.00
+        self.answer_cache = get_answer_cache(EMBEDDING_DIMENSIONS)
     '''
     Method for setting the model and updating the costs
     
@@ -77,7 +136,9 @@ class RAGEngine:
     def _set_model(self, model):
         self.model = model
         self.llm = ChatAnthropic(model=model, temperature=0, api_key=self.anthropic_api_key, model_kwargs={"extra_headers": {"anthropic-beta": "prompt-caching-2024-07-31"}})
-        self.tokenizer = tiktoken.encoding_for_model(EMBEDDING_MODEL)
+        self.tokenizer = get_tokenizer(EMBEDDING_MODEL)
+        # The prompts are built once per process, so the chains only need composing once per model
+        self._chains = {few_shot: self._get_prompt(few_shot) | self.llm for few_shot in (True, False)}
         self.__update_costs()
 
     '''
@@ -100,71 +161,78 @@ class RAGEngine:
     Method for calculating the cost of the input and output
     
     Parameters:
-    - input_text: The input text to calculate the cost of
-    - output_text: The output text to calculate the cost of
+    - input_tokens: The number of uncached input tokens
+    - output_tokens: The number of output tokens
+    - cache_read_tokens: The number of input tokens read from the prompt cache
+    - cache_write_tokens: The number of input tokens written to the prompt cache
     
     Returns:
     - The cost of the input and output
     '''
-    def _calculate_generation_cost(self, input_tokens, output_tokens):
+    def _calculate_generation_cost(self, input_tokens, output_tokens, cache_read_tokens=0, cache_write_tokens=0):
         input_cost = input_tokens * self.input_cost_per_token
+        input_cost += cache_read_tokens * self.input_cost_per_token * CACHE_READ_COST_MULTIPLIER
+        input_cost += cache_write_tokens * self.input_cost_per_token * CACHE_WRITE_COST_MULTIPLIER
         output_cost = output_tokens * self.output_cost_per_token
         total_cost = input_cost + output_cost
         return total_cost
 
     '''
-    Method for resetting the generation cost
-    '''
-    def _reset_generation_cost(self):
-        self.generation_cost = 0.00
-
-    '''
-    Method for resetting the retrieval cost
-    '''
-    def _reset_retrieval_cost(self):
-        self.retrieval_cost = 0.00
+    Method for splitting a response's input tokens into uncached, cache read and cache write tokens.
+    Newer langchain_anthropic versions report the cache tokens in usage_metadata (included in input_tokens),
+    older ones only in the raw usage of non-streamed responses (excluded from input_tokens).
 
+    Returns:
+    - (uncached input tokens, cache read tokens, cache write tokens, whether the cache usage was reported)
     '''
-    Method for resetting the translation cost
-    '''
-    def _reset_translation_cost(self):
-        self.translation_cost = 0.00
+    def _input_token_usage(self, usage_metadata, response_metadata):
+        input_tokens = usage_metadata.get("input_tokens", 0)
+        details = usage_metadata.get("input_token_details") or {}
+        if details:
+            cache_read = details.get("cache_read", 0) or 0
+            cache_write = details.get("cache_creation", 0) or 0
+            return input_tokens - cache_read - cache_write, cache_read, cache_write, True
+        usage = (response_metadata or {}).get("usage") or {}
+        if "cache_read_input_tokens" in usage or "cache_creation_input_tokens" in usage:
+            return input_tokens, usage.get("cache_read_input_tokens") or 0, usage.get("cache_creation_input_tokens") or 0, True
+        return input_tokens, 0, 0, False
 
     '''
-    Method for resetting all the costs
+    Method for getting the generation prompt
     '''
-    def reset_all_costs(self):
-        self._reset_generation_cost()
-        self._reset_retrieval_cost()
-        self._reset_translation_cost()
+    def _get_prompt(self, few_shot):
+        if few_shot:
+            return get_few_shot_prompt()
+        return get_main_prompt()
 
-    def get_total_cost(self):
-        return self.generation_cost + self.retrieval_cost + self.translation_cost
     '''
     Method for chaining together the components of the RAG engine
     
     Parameters:
     - user_input: The user's input query/question which needs answering
-    - context: The context to use for generating the response
+    - context: The retrieved documents, serialised into a token-budgeted context (see context_builder.py)
+    - costs: The RequestCosts object to add the generation and translation costs to
+    - trace: The RequestTrace to record the context build and generation spans on
+    - deadline: The request's Deadline, generation gets whatever is left of it
     
     Returns:
     - The response from the LLM
     '''
-    def _chain(self, user_input, context, chat_history="", few_shot=False):
-        if few_shot:
-            prompt = get_few_shot_prompt()
-        else:
-            prompt = get_main_prompt()
-
-        chain = prompt | self.llm
-        response = chain.invoke({"question": user_input, "documents": context, "chat_history": chat_history})
-        resp_metadata = response.usage_metadata
+    async def _chain(self, user_input, context, chat_history="", few_shot=False, costs=None, trace=None, deadline=None):
+        chain = self._chains[bool(few_shot)]
+        with trace_span(trace, "context_build") as span:
+            documents = build_context(context, self.tokenizer, span=span)
+        with trace_span(trace, "generation", model=self.model) as span:
+            async with Timeout(deadline.remaining() if deadline is not None else None):
+                response = await chain.ainvoke({"question": user_input, "documents": documents, "chat_history": chat_history})
+            resp_metadata = response.usage_metadata
+            input_tokens, cache_read_tokens, cache_write_tokens, measured = self._input_token_usage(resp_metadata, response.response_metadata)
+            output_tokens = resp_metadata["output_tokens"]
+            span.set(input_tokens=input_tokens, output_tokens=output_tokens, cache_read_tokens=cache_read_tokens, cache_write_tokens=cache_write_tokens)
+        get_prompt_cache_stats().record(input_tokens, cache_read_tokens, cache_write_tokens, measured)
         parsed_response = self.output_parser.invoke(response.content)
-        input_tokens = resp_metadata["input_tokens"]
-        output_tokens = resp_metadata["output_tokens"]
-        gen_cost = self._calculate_generation_cost(input_tokens, output_tokens)
-        self.generation_cost += gen_cost
-        self.translation_cost = self.query_translator.get_total_cost()
+        if costs is not None:
+            costs.generation_cost += self._calculate_generation_cost(input_tokens, output_tokens, cache_read_tokens, cache_write_tokens)
         return parsed_response
     
     '''
@@ -172,73 +240,379 @@ class RAGEngine:
     
     Parameters:
     - user_input: The user's input query/question which needs answering
+    - costs: The RequestCosts object to add the translation costs to
+    - routing: How the multi-query decision is made, one of the ROUTING_* modes (defaults to MULTI_QUERY_ROUTING)
+    - query_vector: The embedding of user_input if it has already been computed
+    - trace: The RequestTrace to record the retrieval spans on
+    - deadline: The request's Deadline, retrieval then gets a share of the remaining budget instead of timeout and
+      degrades to direct retrieval when multi-query won't fit
+    - k: The number of documents to keep, all of them when None
     
     Returns:
-    - The most relevant chunks from the index
+    - The most relevant chunks from the index, a diverse selection of them when diverse_selection is on,
+      with the top hits expanded into passages of neighbouring splits when there is a neighbour_expander
     ''' 
     #TODO - Calculate embedding cost of multi query prompts
-    async def retrieve_relevant_documents(self, user_input, use_reranking=True, timeout=30):
-        async def retrieval_with_timeout():
-            if self.query_translator.should_use_multi_query(user_input):
-                # RAG Fusion method removes duplicates when reranking so no need for unique union in chain
-                if use_reranking:
-                    reranked_retrieval_chain = (
-                        self.query_translator.multi_query_generation()
-                        | self.retriever.map()
-                    )
-                    unflattened_unranked_docs = await asyncio.to_thread(
-                        reranked_retrieval_chain.invoke, {"user_input": user_input}
-                    )
-                    return await asyncio.to_thread(
-                        self.query_translator.reciprocal_rank_fusion, result_docs=unflattened_unranked_docs
-                    )
-                else:
-                    retrieval_chain = (
-                        self.query_translator.multi_query_generation()
-                        | self.retriever.map()
-                        | (lambda docs: self.query_translator.get_unique_union(docs))
-                    )
-                    return await asyncio.to_thread(
-                        retrieval_chain.invoke, {"user_input": user_input}
-                    )
+    async def retrieve_relevant_documents(self, user_input, use_reranking=True, timeout=30, costs=None, routing=None, query_vector=None, trace=None, deadline=None, k=None):
+        routing = routing or DEFAULT_ROUTING
+        # With a deadline retrieval gets a share of what is left, when that's too little for multi-query it goes direct
+        if deadline is not None:
+            timeout = deadline.slice(RETRIEVAL_BUDGET_SHARE)
+            if routing != ROUTING_DIRECT and timeout < MULTI_QUERY_MIN_SECONDS:
+                routing = ROUTING_DIRECT
+                if trace is not None:
+                    trace.set(degraded="multi_query_skipped")
+        if trace is not None:
+            trace.set(routing=routing, retrieval_budget_ms=round(timeout * 1000, 2))
+
+        # Candidate vectors by document_key, collected by the searches for the diversity selection
+        vectors = {} if self.diverse_selection else None
+
+        async def retrieve(routing):
+            nonlocal query_vector
+            # The local router decides from the question embedding, which direct retrieval needs anyway
+            if query_vector is None and routing in (ROUTING_SPECULATIVE, ROUTING_SEQUENTIAL) and self.query_translator.uses_query_vector:
+                query_vector = await self._embed_question(user_input, trace)
+            if routing == ROUTING_SPECULATIVE:
+                return await self._speculative_retrieve(user_input, use_reranking, costs, query_vector, trace, vectors)
+            elif routing == ROUTING_MERGED:
+                queries = await self.query_translator.aroute_and_generate(user_input, costs=costs, trace=trace)
+                if queries:
+                    return await self._multi_query_retrieve(queries, use_reranking, trace, vectors)
+                return await self._direct_retrieve(user_input, query_vector, trace, vectors)
+            elif routing == ROUTING_SEQUENTIAL:
+                if await self.query_translator.ashould_use_multi_query(user_input, costs=costs, trace=trace, query_vector=query_vector):
+                    queries = await self.query_translator.agenerate_queries(user_input, costs=costs, trace=trace)
+                    return await self._multi_query_retrieve(queries, use_reranking, trace, vectors)
+                return await self._direct_retrieve(user_input, query_vector, trace, vectors)
+            elif routing == ROUTING_DIRECT:
+                return await self._direct_retrieve(user_input, query_vector, trace, vectors)
+            elif routing == ROUTING_ALWAYS:
+                queries = await self.query_translator.agenerate_queries(user_input, costs=costs, trace=trace)
+                return await self._multi_query_retrieve(queries, use_reranking, trace, vectors)
             else:
-                return await asyncio.to_thread(
-                    self.retriever.invoke, user_input
-                )
+                raise ValueError(f"Unknown routing mode: {routing}")
 
+        async def retrieval_with_timeout(routing):
+            documents = await retrieve(routing)
+            if vectors is not None:
+                with trace_span(trace, "diversity") as span:
+                    documents = select_diverse(documents, vectors, query_vector=query_vector, span=span)
+            if k is not None:
+                documents = documents[:k]
+            if self.neighbour_expander is not None:
+                with trace_span(trace, "neighbour_expansion") as span:
+                    documents = await self.neighbour_expander.aexpand(documents, span=span)
+            return documents
+
+        try:
+            return await asyncio.wait_for(retrieval_with_timeout(routing), timeout=timeout)
+        except asyncio.TimeoutError:
+            if deadline is None or routing == ROUTING_DIRECT or deadline.expired:
+                logger.error(f"Retrieval operation timed out after {timeout} seconds")
+                raise TimeoutError(f"Retrieval operation timed out after {timeout} seconds") from None
+        # A slow multi-query branch degrades to direct retrieval within what is left of the deadline
+        fallback_timeout = deadline.slice(RETRIEVAL_BUDGET_SHARE)
+        logger.warning(f"Retrieval timed out after {timeout:.2f} seconds, falling back to direct retrieval")
+        if trace is not None:
+            trace.set(degraded="direct_after_timeout")
         try:
-            return await asyncio.wait_for(retrieval_with_timeout(), timeout=timeout)
-        except TimeoutError:
-            logger.error(f"Retrieval operation timed out after {timeout} seconds")
-            raise TimeoutError(f"Retrieval operation timed out after {timeout} seconds") from None
+            return await asyncio.wait_for(retrieval_with_timeout(ROUTING_DIRECT), timeout=fallback_timeout)
+        except asyncio.TimeoutError:
+            logger.error(f"Direct retrieval fallback timed out after {fallback_timeout:.2f} seconds")
+            raise TimeoutError(f"Retrieval operation timed out after {timeout + fallback_timeout:.2f} seconds") from None
+
+    '''
+    Method for retrieving with the routing decision, direct retrieval and query generation all in flight at once.
+    Whichever branch the router doesn't pick is cancelled, so only the router's latency is added to the common path.
+    '''
+    async def _speculative_retrieve(self, user_input, use_reranking, costs, query_vector=None, trace=None, vectors=None):
+        router = asyncio.create_task(self.query_translator.ashould_use_multi_query(user_input, costs=costs, trace=trace, query_vector=query_vector))
+        direct = asyncio.create_task(self._direct_retrieve(user_input, query_vector, trace, vectors))
+        generation = asyncio.create_task(self.query_translator.agenerate_queries(user_input, costs=costs, trace=trace))
+        try:
+            if await router:
+                direct.cancel()
+                queries = await generation
+                return await self._multi_query_retrieve(queries, use_reranking, trace, vectors)
+            generation.cancel()
+            return await direct
+        finally:
+            for task in (router, direct, generation):
+                if not task.done():
+                    task.cancel()
+
+    '''
+    Method for embedding the user's question, recording the embedding cache hits on the trace
+    '''
+    async def _embed_question(self, user_input, trace=None):
+        with trace_span(trace, "embedding") as span:
+            return await self.embedding_model.aembed_query(user_input, span=span)
+
+    '''
+    Method for retrieving documents for the user's input alone, reusing its embedding if already computed.
+    With hybrid retrieval the dense and keyword results are fused with Reciprocal Rank Fusion.
+    '''
+    async def _direct_retrieve(self, user_input, query_vector=None, trace=None, vectors=None):
+        if query_vector is not None:
+            dense = self.retriever.asearch_by_vector(query_vector, trace=trace, vectors=vectors)
+        else:
+            dense = self.retriever.asearch(user_input, trace=trace, vectors=vectors)
+        if self.retriever.keyword_index is None:
+            return await dense
+        ranked_lists = await asyncio.gather(dense, self.retriever.asearch_keywords(user_input, trace=trace))
+        return self._fuse(ranked_lists, True, trace, labels=["dense", "keyword"], weights=[1.0, KEYWORD_FUSION_WEIGHT])
+
+    '''
+    Method for retrieving documents for each generated query and merging the results
+
+    Parameters:
+    - queries: The alternative queries generated from the user's input
+    - use_reranking: Whether to rerank with Reciprocal Rank Fusion rather than take the unique union
+    - trace: The RequestTrace to record the retrieval spans on
+    - vectors: A dict to collect the candidates' vectors in, for the diversity selection
+
+    Returns:
+    - The merged documents
+    '''
+    async def _multi_query_retrieve(self, queries, use_reranking=True, trace=None, vectors=None):
+        # Duplicate variants would only add the same ranking twice, so they're dropped before retrieval
+        queries = list(dict.fromkeys(query.strip() for query in queries if query.strip()))
+        if self.retriever.keyword_index is None:
+            unflattened_docs = await self.retriever.amulti_search(queries, trace=trace, vectors=vectors)
+            labels = [f"dense:{i}" for i in range(len(queries))]
+            weights = [1.0] * len(queries)
+        else:
+            dense, *keyword = await asyncio.gather(
+                self.retriever.amulti_search(queries, trace=trace, vectors=vectors),
+                *(self.retriever.asearch_keywords(query, trace=trace) for query in queries)
+            )
+            unflattened_docs = dense + keyword
+            labels = [f"dense:{i}" for i in range(len(queries))] + [f"keyword:{i}" for i in range(len(queries))]
+            weights = [1.0] * len(queries) + [KEYWORD_FUSION_WEIGHT] * len(queries)
+        return self._fuse(unflattened_docs, use_reranking, trace, labels=labels, weights=weights)
+
+    '''
+    Method for merging ranked lists of documents into one list, recording a span on the trace.
+    Documents are keyed on their vector id and the retrieved objects are kept (see rank_fusion.py).
+
+    Parameters:
+    - ranked_lists: The lists of documents, best first
+    - use_reranking: Whether to rerank with weighted Reciprocal Rank Fusion rather than take the unique union
+    - labels: The name of each list (which query variant and retriever it came from), for the trace
+    - weights: The RRF weight of each list
+
+    Returns:
+    - The merged documents
+    '''
+    def _fuse(self, ranked_lists, use_reranking, trace=None, labels=None, weights=None):
+        with trace_span(trace, "rank_fusion" if use_reranking else "unique_union", lists=len(ranked_lists)) as span:
+            # RAG Fusion method removes duplicates when reranking so no need for unique union
+            if use_reranking:
+                fused = reciprocal_rank_fusion(ranked_lists, weights=weights, labels=labels)
+                merged = [result.document for result in fused]
+                # Which lists found each of the documents that made the top of the fused ranking
+                span.set(top_provenance=[sorted(result.provenance) for result in fused[:self.retriever.k]])
+            else:
+                merged = unique_union(ranked_lists)
+            span.set(documents=len(merged))
+        return merged
 
     '''
-    Method for getting the answer to a user's question
+    Method for getting the answer to a user's question. Concurrent identical questions without history are
+    coalesced (see single_flight.py), requests which didn't run the computation are marked "coalesced".
 
     Parameters:
     - user_input: The user's input query/question which needs answering
+    - include_trace: Whether to include the request's trace (see tracing.py) in the response
+    - profile: The Profile (see profiles.py) setting the retrieval depth, routing and reranking, the engine's
+      defaults when None. Its model is chosen by picking the engine.
+    - rewrite_question: Whether a follow-up question is rewritten into a standalone question for retrieval when
+      there is history (see sessions.py). The answer is still generated for the question as asked.
 
     Returns:
     - The answer to the user's question
     '''
-    #TODO - Handle cost calculation on the fly for each query, don't store in object as engine may be re-used by multiple tenants
-    async def get_answer(self, user_input, few_shot=False, format_response=True, history=""):
+    async def get_answer(self, user_input, few_shot=False, format_response=True, history="", include_trace=False, profile=None, rewrite_question=False):
+        single_flight = get_single_flight()
+        if single_flight is None or history:
+            return await self._get_answer(user_input, few_shot, format_response, history, include_trace, profile, rewrite_question)
+        key = request_key(user_input, "answer", self.credentials_key, few_shot, format_response, include_trace, self._profile_name(profile))
+        result, computed = await single_flight.run(key, lambda: self._get_answer(user_input, few_shot, format_response, history, include_trace, profile))
+        return result if computed else {**result, "coalesced": True}
+
+    async def _get_answer(self, user_input, few_shot, format_response, history, include_trace, profile=None, rewrite_question=False):
+        # Costs and traces are tracked per request, the engine itself may be shared by multiple tenants
+        costs = RequestCosts()
+        trace = RequestTrace()
+        deadline = Deadline()
+        trace.set(model=self.model, streaming=False, profile=self._profile_name(profile))
         try:
-            retrieved = await self.retrieve_relevant_documents(user_input)
+            start = time.perf_counter()
+            query_vector = None
+            # Answers depend on the conversation, so only standalone questions go through the cache
+            use_cache = self.answer_cache is not None and not history
+            if use_cache:
+                # The question embedding is needed for retrieval anyway, so the lookup costs no extra embedding call
+                query_vector = await self._embed_question(user_input, trace)
+                cached = None
+                with trace_span(trace, "answer_cache") as span:
+                    try:
+                        generation = await aget_index_generation()
+                    except Exception as e:
+                        # The cache is only an optimisation, so the request is answered without it
+                        logger.warning(f"Skipping the answer cache, the index generation is unavailable: {e}")
+                        span.set(skipped=True)
+                        use_cache = False
+                    else:
+                        cache_namespace = (self.model, few_shot, format_response, self._profile_name(profile))
+                        cached = self.answer_cache.lookup(query_vector, cache_namespace, generation)
+                        span.set(hit=cached is not None)
+                if cached is not None:
+                    trace.set(cached=True)
+                    return self._with_trace({**cached, "cached": True}, trace, include_trace)
+            elif self.answer_cache is not None:
+                self.answer_cache.record_skip()
+
+            retrieval_query = await self._retrieval_query(user_input, history, rewrite_question, costs, trace)
+            retrieved = await self.retrieve_relevant_documents(retrieval_query, costs=costs, query_vector=query_vector, trace=trace, deadline=deadline, **self._retrieval_options(profile))
+            answer = await self._chain(user_input=user_input, context=retrieved, few_shot=few_shot, chat_history=history, costs=costs, trace=trace, deadline=deadline)
             if format_response:
-                raw = self._chain(user_input=user_input, context=retrieved, few_shot=few_shot, chat_history=history)
-                answer = re.sub(r'<thinking>.*?</thinking>', '', raw, flags=re.DOTALL)
-            else:
-                answer = await asyncio.to_thread(self._chain(user_input=user_input, context=retrieved, few_shot=few_shot, chat_history=history))
-            return {
-                "answer": answer,
-                "generation_cost": self.generation_cost,
-                "retrieval_cost": self.retrieval_cost,
-                "translation_cost": self.translation_cost
-                }
+                answer = re.sub(r'<thinking>.*?</thinking>', '', answer, flags=re.DOTALL)
+            result = {"answer": answer, **costs.as_dict()}
+            if use_cache:
+                self.answer_cache.store(query_vector, cache_namespace, user_input, result, time.perf_counter() - start, generation)
+            trace.set(cached=False, **costs.as_dict())
+            return self._with_trace({**result, "cached": False}, trace, include_trace)
         except Exception as e:
+            trace.set(error=str(e), error_type=type(e).__name__)
+            export_trace(trace)
             logger.error(f"Error getting answer: {e}")
             raise e
+
+    '''
+    Method for finishing a request's trace, exporting it and adding it to the response if it was asked for
+    '''
+    def _with_trace(self, result, trace, include_trace):
+        export_trace(trace)
+        if include_trace:
+            result["trace"] = trace.as_dict()
+        return result
+
+    '''
+    Method for getting the retrieval arguments of a profile, none (the engine's defaults) without one
+    '''
+    def _retrieval_options(self, profile):
+        if profile is None:
+            return {}
+        return {"k": profile.k, "routing": profile.routing, "use_reranking": profile.use_reranking}
+
+    def _profile_name(self, profile):
+        return profile.name if profile is not None else None
+
+    '''
+    Method for getting the query retrieval searches with, the question rewritten into a standalone question when it
+    is a follow-up in a conversation
+    '''
+    async def _retrieval_query(self, user_input, history, rewrite_question, costs, trace):
+        if not (rewrite_question and history):
+            return user_input
+        return await self.query_translator.arewrite_question(user_input, history, costs=costs, trace=trace)
+
+    '''
+    Method for streaming the answer to a user's question as it is generated
+
+    Parameters:
+    - user_input: The user's input query/question which needs answering
+    - format_response: Whether <thinking> blocks should be stripped from the streamed answer
+    - include_trace: Whether to send the request's trace as a "trace" event after the costs
+    - profile: The Profile (see profiles.py) setting the retrieval depth, routing and reranking, as for get_answer
+    - rewrite_question: Whether follow-up questions are rewritten for retrieval, as for get_answer
+
+    Returns:
+    - An async generator of (event, data) tuples; a "sources" event once retrieval finishes,
+      "token" events with visible answer text, and a final "costs" event.
+      Concurrent identical questions without history share one stream, see single_flight.py.
+    '''
+    async def stream_answer(self, user_input, few_shot=False, format_response=True, history="", include_trace=False, profile=None, rewrite_question=False):
+        single_flight = get_single_flight()
+        if single_flight is None or history:
+            events = self._stream_answer(user_input, few_shot, format_response, history, include_trace, profile, rewrite_question)
+        else:
+            key = request_key(user_input, "stream", self.credentials_key, few_shot, format_response, include_trace, self._profile_name(profile))
+            events = single_flight.stream(key, lambda: self._stream_answer(user_input, few_shot, format_response, history, include_trace, profile))
+        async for event in events:
+            yield event
+
+    async def _stream_answer(self, user_input, few_shot, format_response, history, include_trace, profile=None, rewrite_question=False):
+        costs = RequestCosts()
+        trace = RequestTrace()
+        deadline = Deadline()
+        trace.set(model=self.model, streaming=True, profile=self._profile_name(profile))
+        try:
+            retrieval_query = await self._retrieval_query(user_input, history, rewrite_question, costs, trace)
+            retrieved = await self.retrieve_relevant_documents(retrieval_query, costs=costs, trace=trace, deadline=deadline, **self._retrieval_options(profile))
+            yield "sources", self._get_sources(retrieved)
+
+            chain = self._chains[bool(few_shot)]
+            stripper = ThinkingStripper() if format_response else None
+            input_tokens = 0
+            output_tokens = 0
+            cache_read_tokens = 0
+            cache_write_tokens = 0
+            measured = False
+            with trace_span(trace, "context_build") as span:
+                documents = build_context(retrieved, self.tokenizer, span=span)
+            with trace_span(trace, "generation", model=self.model) as span:
+                # The deadline bounds the wait for the first token, once the answer is flowing it runs to the end
+                first_token_timeout = Timeout(deadline.remaining())
+                async with first_token_timeout:
+                    async for chunk in chain.astream({"question": user_input, "documents": documents, "chat_history": history}):
+                        first_token_timeout.disarm()
+                        if chunk.usage_metadata:
+                            chunk_input, chunk_read, chunk_write, chunk_measured = self._input_token_usage(chunk.usage_metadata, chunk.response_metadata)
+                            input_tokens += chunk_input
+                            cache_read_tokens += chunk_read
+                            cache_write_tokens += chunk_write
+                            measured = measured or chunk_measured
+                            output_tokens += chunk.usage_metadata["output_tokens"]
+                        text = chunk.content if isinstance(chunk.content, str) else ""
+                        if stripper:
+                            text = stripper.feed(text)
+                        if text:
+                            if "time_to_first_token_ms" not in span.attributes:
+                                span.set(time_to_first_token_ms=round(span.duration * 1000, 2))
+                            yield "token", text
+                    if stripper:
+                        remaining = stripper.flush()
+                        if remaining:
+                            yield "token", remaining
+                span.set(input_tokens=input_tokens, output_tokens=output_tokens, cache_read_tokens=cache_read_tokens, cache_write_tokens=cache_write_tokens)
+
+            get_prompt_cache_stats().record(input_tokens, cache_read_tokens, cache_write_tokens, measured)
+            costs.generation_cost += self._calculate_generation_cost(input_tokens, output_tokens, cache_read_tokens, cache_write_tokens)
+            trace.set(**costs.as_dict())
+            yield "costs", costs.as_dict()
+        except BaseException as e:
+            # Includes the client disconnecting, which closes the generator mid-stream
+            trace.set(error=str(e) or type(e).__name__, error_type=type(e).__name__)
+            raise
+        finally:
+            export_trace(trace)
+        if include_trace:
+            yield "trace", trace.as_dict()
+
+    '''
+    Method for listing the unique videos used as context, in the order they were retrieved
+    '''
+    def _get_sources(self, documents):
+        sources = {}
+        for doc in documents:
+            url = doc.metadata.get("video_url")
+            if url and url not in sources:
+                sources[url] = {"video_title": doc.metadata.get("video_title"), "video_url": url}
+        return list(sources.values())
+
     '''
     Method for getting the answer to a user's question along with the relevant context
 
@@ -250,5 +624,5 @@ class RAGEngine:
     '''
     async def get_answer_with_context(self, user_input, few_shot=False):
         retrieved = await self.retrieve_relevant_documents(user_input)
-        answer = self._chain(user_input=user_input, context=retrieved, few_shot=few_shot)
+        answer = await self._chain(user_input=user_input, context=retrieved, few_shot=few_shot)
         return {"answer": answer, "context": retrieved}
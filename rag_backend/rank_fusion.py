@@ -0,0 +1,117 @@
+from typing import Any, Dict, List, NamedTuple
+
+import numpy as np
+
+RRF_K = 60
+
+class FusedResult(NamedTuple):
+    """
+    A document after fusion, with its fused score and the rank it had in each result list which retrieved it
+    """
+    document: Any
+    score: float
+    provenance: Dict[Any, int]
+
+'''
+Returns the identity of a retrieved split, without touching its text. Documents from the local index carry
+their vector id; Pinecone results don't, so the id is rebuilt the way the scraper-indexer creates it.
+Documents with neither fall back to their text.
+'''
+def document_key(doc):
+    if getattr(doc, "id", None):
+        return doc.id
+    metadata = doc.metadata
+    if "video_id" in metadata and "chunk_index" in metadata and "split_index" in metadata:
+        return f"{metadata['video_id']}_chunk{int(metadata['chunk_index'])}_split{int(metadata['split_index'])}"
+    return doc.page_content
+
+# Maps every occurrence to a dense document index, keeping the first object seen for each key
+def _index_documents(result_lists, labels, get_document):
+    positions = {}
+    documents = []
+    provenance = []
+    occurrence_indices = []
+    for label, results in zip(labels, result_lists):
+        indices = np.empty(len(results), dtype=np.int64)
+        for rank, result in enumerate(results):
+            doc = get_document(result)
+            key = document_key(doc)
+            index = positions.get(key)
+            if index is None:
+                index = positions[key] = len(documents)
+                documents.append(doc)
+                provenance.append({})
+            provenance[index].setdefault(label, rank)
+            indices[rank] = index
+        occurrence_indices.append(indices)
+    return documents, provenance, occurrence_indices
+
+def _ranked(documents, provenance, scores):
+    # Stable, so ties keep the order documents were first seen in
+    order = np.argsort(-scores, kind="stable")
+    return [FusedResult(documents[i], float(scores[i]), provenance[i]) for i in order]
+
+'''
+Weighted Reciprocal Rank Fusion, each occurrence of a document adds weight / (rank + k).
+Duplicates within one list each contribute, as the original QueryTranslator implementation did.
+
+Parameters:
+- result_lists: Lists of documents, best first
+- k: The RRF constant, larger values flatten the rank contributions
+- weights: A weight per list, defaults to 1 for every list
+- labels: A label per list reported in the provenance (e.g. the query variant), defaults to the list index
+
+Returns:
+- FusedResults, best first, holding the original document objects
+'''
+def reciprocal_rank_fusion(result_lists, k=RRF_K, weights=None, labels=None) -> List[FusedResult]:
+    labels = labels if labels is not None else list(range(len(result_lists)))
+    weights = weights if weights is not None else [1.0] * len(result_lists)
+    documents, provenance, occurrence_indices = _index_documents(result_lists, labels, lambda doc: doc)
+    if not documents:
+        return []
+    contributions = [weight / (np.arange(len(indices), dtype=np.float64) + k) for weight, indices in zip(weights, occurrence_indices)]
+    scores = np.bincount(np.concatenate(occurrence_indices), weights=np.concatenate(contributions), minlength=len(documents))
+    return _ranked(documents, provenance, scores)
+
+'''
+CombSUM score fusion, each list's scores are min-max normalised to [0, 1] then summed with the list's weight,
+so lists with different score scales (cosine similarity, BM25) can be combined
+
+Parameters:
+- scored_lists: Lists of (document, score) pairs, best first
+- weights: A weight per list, defaults to 1 for every list
+- labels: A label per list reported in the provenance, defaults to the list index
+
+Returns:
+- FusedResults, best first, holding the original document objects
+'''
+def comb_sum(scored_lists, weights=None, labels=None) -> List[FusedResult]:
+    labels = labels if labels is not None else list(range(len(scored_lists)))
+    weights = weights if weights is not None else [1.0] * len(scored_lists)
+    documents, provenance, occurrence_indices = _index_documents(scored_lists, labels, lambda result: result[0])
+    if not documents:
+        return []
+    contributions = []
+    for weight, results in zip(weights, scored_lists):
+        scores = np.fromiter((score for _, score in results), dtype=np.float64, count=len(results))
+        if len(scores):
+            spread = scores.max() - scores.min()
+            scores = (scores - scores.min()) / spread if spread else np.ones_like(scores)
+        contributions.append(weight * scores)
+    scores = np.bincount(np.concatenate(occurrence_indices), weights=np.concatenate(contributions), minlength=len(documents))
+    return _ranked(documents, provenance, scores)
+
+'''
+Merges lists of documents, keeping the first occurrence of each document in list order
+'''
+def unique_union(result_lists):
+    seen = set()
+    documents = []
+    for results in result_lists:
+        for doc in results:
+            key = document_key(doc)
+            if key not in seen:
+                seen.add(key)
+                documents.append(doc)
+    return documents
@@ -0,0 +1,71 @@
+import threading
+
+class RequestCosts:
+    """
+    Cost counters for a single request. Created per request so that one engine can serve
+    concurrent requests without their costs bleeding into each other.
+    """
+    def __init__(self):
+        self.generation_cost = 0.00
+        self.retrieval_cost = 0.00
+        self.translation_cost = 0.00
+
+    def get_total_cost(self):
+        return self.generation_cost + self.retrieval_cost + self.translation_cost
+
+    '''
+    Returns the costs in the shape used by the API response
+    '''
+    def as_dict(self):
+        return {
+            "generation_cost": self.generation_cost,
+            "retrieval_cost": self.retrieval_cost,
+            "translation_cost": self.translation_cost
+        }
+
+class PromptCacheStats:
+    """
+    Process-wide Anthropic prompt cache counters over every generation call, reported by /health.
+    Calls where the cache usage isn't reported (streaming with older langchain_anthropic versions) are counted
+    as unmeasured and left out of the hit rate.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.calls_with_reads = 0
+        self.unmeasured_calls = 0
+        self.uncached_input_tokens = 0
+        self.cache_read_tokens = 0
+        self.cache_write_tokens = 0
+
+    def record(self, uncached_input_tokens, cache_read_tokens, cache_write_tokens, measured=True):
+        with self._lock:
+            if not measured:
+                self.unmeasured_calls += 1
+                return
+            self.calls += 1
+            self.calls_with_reads += int(cache_read_tokens > 0)
+            self.uncached_input_tokens += uncached_input_tokens
+            self.cache_read_tokens += cache_read_tokens
+            self.cache_write_tokens += cache_write_tokens
+
+    '''
+    Returns the counters, the hit rate being the share of input tokens read from the cache
+    '''
+    def stats(self):
+        with self._lock:
+            input_tokens = self.uncached_input_tokens + self.cache_read_tokens + self.cache_write_tokens
+            return {
+                "calls": self.calls,
+                "calls_with_reads": self.calls_with_reads,
+                "unmeasured_calls": self.unmeasured_calls,
+                "uncached_input_tokens": self.uncached_input_tokens,
+                "cache_read_tokens": self.cache_read_tokens,
+                "cache_write_tokens": self.cache_write_tokens,
+                "hit_rate": self.cache_read_tokens / input_tokens if input_tokens else 0.0,
+            }
+
+_prompt_cache_stats = PromptCacheStats()
+
+def get_prompt_cache_stats():
+    return _prompt_cache_stats
@@ -0,0 +1,114 @@
+import asyncio
+from typing import Any, List
+
+from langchain_core.callbacks import AsyncCallbackManagerForRetrieverRun, CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.retrievers import BaseRetriever
+
+try:
+    from .embedding_cache import CachedEmbeddings
+    from .executors import get_executor
+    from .rank_fusion import document_key
+    from .deadline import get_hedger
+    from .tracing import trace_span
+except ImportError:
+    from embedding_cache import CachedEmbeddings
+    from executors import get_executor
+    from rank_fusion import document_key
+    from deadline import get_hedger
+    from tracing import trace_span
+
+class SharedIndexRetriever(BaseRetriever):
+    """
+    Retriever which embeds queries with a per-key embedding model and searches a shared vector store by vector.
+    Behaves like vector_store.as_retriever(search_kwargs={"k": k}), but lets many engines share one store.
+    The async path embeds natively and runs the blocking vector search on the dedicated vector_search executor.
+
+    Parameters:
+    - vector_store: The shared vector store to search
+    - embedding_model: The embedding model used to embed the query
+    - k: The number of documents to return
+    - keyword_index: The optional index searched with BM25 alongside the vector store (see bm25_index.py)
+    - keyword_k: The number of documents to return from the keyword search
+    - fetch_k: The number of candidates fetched with their vectors when a search collects vectors (see diversity.py)
+    """
+    vector_store: Any
+    embedding_model: Embeddings
+    k: int = 5
+    keyword_index: Any = None
+    keyword_k: int = 5
+    fetch_k: int = 20
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        embedding = self.embedding_model.embed_query(query)
+        return [doc for doc, _ in self.vector_store.similarity_search_by_vector_with_score(embedding, k=self.k)]
+
+    async def _aget_relevant_documents(self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun) -> List[Document]:
+        embedding = await self.embedding_model.aembed_query(query)
+        return await self.asearch_by_vector(embedding)
+
+    '''
+    Embeds the query and searches with it, like ainvoke but recording embedding and vector search spans on the trace
+    '''
+    async def asearch(self, query: str, trace=None, vectors=None) -> List[Document]:
+        embedding = (await self._aembed([query], trace))[0]
+        return await self.asearch_by_vector(embedding, trace=trace, vectors=vectors)
+
+    '''
+    Searches with an already computed query embedding, so callers which embed the question for other reasons
+    don't pay for a second embedding call.
+    When a vectors dict is given, fetch_k candidates are fetched along with their vectors, which are added to
+    it by document_key for the selection stage.
+    '''
+    async def asearch_by_vector(self, embedding: List[float], trace=None, vectors=None) -> List[Document]:
+        if vectors is not None:
+            k = max(self.k, self.fetch_k)
+            with trace_span(trace, "vector_search", k=k, include_vectors=True) as span:
+                results = await get_hedger("vector_search").call(
+                    lambda: get_executor("vector_search").run(self.vector_store.similarity_search_by_vector_with_vectors, embedding, k=k)
+                )
+                span.set(results=len(results))
+            for doc, _, vector in results:
+                vectors[document_key(doc)] = vector
+            return [doc for doc, _, _ in results]
+        with trace_span(trace, "vector_search", k=self.k) as span:
+            results = await get_hedger("vector_search").call(
+                lambda: get_executor("vector_search").run(self.vector_store.similarity_search_by_vector_with_score, embedding, k=self.k)
+            )
+            span.set(results=len(results))
+        return [doc for doc, _ in results]
+
+    '''
+    Searches the keyword index for the query, on the vector_search executor as scoring is CPU bound
+    '''
+    async def asearch_keywords(self, query: str, trace=None) -> List[Document]:
+        with trace_span(trace, "keyword_search", k=self.keyword_k) as span:
+            results = await get_executor("vector_search").run(self.keyword_index.keyword_search, query, k=self.keyword_k)
+            span.set(results=len(results))
+        return [doc for doc, _ in results]
+
+    '''
+    Retrieves documents for several queries at once. All queries are embedded in a single embed_documents call
+    and the vector searches are fanned out concurrently, so the whole stage costs roughly one round trip of each.
+
+    Returns:
+    - One list of documents per query, in the same order as the queries
+    '''
+    async def amulti_search(self, queries: List[str], trace=None, vectors=None) -> List[List[Document]]:
+        unique_queries = list(dict.fromkeys(queries))
+        embeddings = await self._aembed(unique_queries, trace)
+        results = await asyncio.gather(*(self.asearch_by_vector(embedding, trace=trace, vectors=vectors) for embedding in embeddings))
+        by_query = dict(zip(unique_queries, results))
+        return [by_query[query] for query in queries]
+
+    # Only the cached embeddings can report cache hits, other embedding models just get timed
+    async def _aembed(self, texts, trace):
+        with trace_span(trace, "embedding") as span:
+            if isinstance(self.embedding_model, CachedEmbeddings):
+                return await self.embedding_model.aembed_documents(texts, span=span)
+            span.set(texts=len(texts))
+            return await get_hedger("embedding").call(lambda: self.embedding_model.aembed_documents(texts))
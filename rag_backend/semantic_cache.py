@@ -0,0 +1,176 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+DEFAULT_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95"))
+DEFAULT_TTL_SECONDS = float(os.getenv("SEMANTIC_CACHE_TTL", "86400"))
+DEFAULT_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "2000"))
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "true").lower() == "true"
+
+class _CacheEntry:
+    def __init__(self, question, result, latency, expires_at):
+        self.question = question
+        self.result = result
+        self.latency = latency
+        self.expires_at = expires_at
+
+class SemanticAnswerCache:
+    """
+    Cache of previous answers looked up by cosine similarity of the question embedding, so near-identical
+    questions ("how to improve sleep", "tips for better sleep") skip retrieval and generation entirely.
+    Vectors live in a preallocated float32 matrix, so a lookup is a single matrix-vector product.
+    Entries expire after a TTL, the least recently used entry is evicted when full, and everything is
+    dropped when the index generation changes, as answers may no longer reflect the index.
+
+    Parameters:
+    - dimensions: The size of the question embeddings
+    - threshold: The minimum cosine similarity for a hit
+    - ttl_seconds: How long an answer stays valid
+    - max_entries: The maximum number of cached answers
+    """
+    def __init__(self, dimensions, threshold=DEFAULT_THRESHOLD, ttl_seconds=DEFAULT_TTL_SECONDS, max_entries=DEFAULT_MAX_ENTRIES):
+        self.dimensions = dimensions
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._vectors = np.zeros((max_entries, dimensions), dtype=np.float32)
+        # Namespace id per slot, -1 marks a free slot
+        self._slot_namespaces = np.full(max_entries, -1, dtype=np.int32)
+        self._namespace_ids = {}
+        self._entries = OrderedDict()
+        self._free_slots = list(range(max_entries - 1, -1, -1))
+        self._generation = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.skipped = 0
+        self.saved_latency = 0.0
+
+    '''
+    Looks up a previously answered question
+
+    Parameters:
+    - vector: The embedding of the incoming question
+    - namespace: Anything else the answer depends on (model, prompt options), answers are never shared across namespaces
+    - generation: The current index generation, a change invalidates every entry
+
+    Returns:
+    - The cached result, or None on a miss
+    '''
+    def lookup(self, vector, namespace, generation=None):
+        query = self._normalise(vector)
+        with self._lock:
+            self._check_generation(generation)
+            namespace_id = self._namespace_ids.get(namespace)
+            if namespace_id is None or not self._entries:
+                self.misses += 1
+                return None
+            scores = self._vectors @ query
+            scores[self._slot_namespaces != namespace_id] = -np.inf
+            now = time.monotonic()
+            while True:
+                slot = int(np.argmax(scores))
+                if scores[slot] < self.threshold:
+                    self.misses += 1
+                    return None
+                entry = self._entries[slot]
+                if entry.expires_at > now:
+                    break
+                # Expired entries are dropped, a live one above the threshold may still match
+                self._evict(slot)
+                scores[slot] = -np.inf
+            self._entries.move_to_end(slot)
+            self.hits += 1
+            self.saved_latency += entry.latency
+            return entry.result
+
+    '''
+    Stores an answer
+
+    Parameters:
+    - vector: The embedding of the answered question
+    - namespace: The namespace the answer belongs to
+    - question: The question text, kept for inspection only
+    - result: The response to return on a hit
+    - latency: How long producing the answer took, reported as saved latency on hits
+    - generation: The index generation the answer was produced against
+    '''
+    def store(self, vector, namespace, question, result, latency=0.0, generation=None):
+        row = self._normalise(vector)
+        with self._lock:
+            self._check_generation(generation)
+            if not self._free_slots:
+                oldest_slot = next(iter(self._entries))
+                self._evict(oldest_slot)
+            slot = self._free_slots.pop()
+            namespace_id = self._namespace_ids.setdefault(namespace, len(self._namespace_ids))
+            self._vectors[slot] = row
+            self._slot_namespaces[slot] = namespace_id
+            self._entries[slot] = _CacheEntry(question, result, latency, time.monotonic() + self.ttl_seconds)
+
+    '''
+    Records a request which bypassed the cache, e.g. because it had chat history
+    '''
+    def record_skip(self):
+        with self._lock:
+            self.skipped += 1
+
+    '''
+    Drops every entry
+    '''
+    def clear(self):
+        with self._lock:
+            self._clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "skipped": self.skipped,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "saved_latency_seconds": self.saved_latency,
+            }
+
+    def _check_generation(self, generation):
+        if generation != self._generation:
+            self._clear()
+            self._generation = generation
+
+    def _clear(self):
+        self._entries.clear()
+        self._slot_namespaces.fill(-1)
+        self._vectors.fill(0.0)
+        self._free_slots = list(range(self.max_entries - 1, -1, -1))
+
+    def _evict(self, slot):
+        del self._entries[slot]
+        self._slot_namespaces[slot] = -1
+        self._vectors[slot] = 0.0
+        self._free_slots.append(slot)
+
+    def _normalise(self, vector):
+        row = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(row)
+        return row / norm if norm else row
+
+_cache = None
+_cache_lock = threading.Lock()
+
+'''
+Returns the process-wide answer cache, or None if it is disabled
+'''
+def get_answer_cache(dimensions):
+    global _cache
+    if not SEMANTIC_CACHE_ENABLED:
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = SemanticAnswerCache(dimensions)
+    return _cache
@@ -0,0 +1,295 @@
+import asyncio
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import redis.asyncio as redis
+from redis.exceptions import RedisError, WatchError
+
+try:
+    from .query_translator import LOW_COST_LLM
+    from .shared_resources import get_tokenizer
+    from .logger import logger as logger
+except ImportError:
+    from query_translator import LOW_COST_LLM
+    from shared_resources import get_tokenizer
+    from logger import logger as logger
+
+# How long a conversation is kept after its last turn
+SESSION_TTL_SECONDS = int(os.getenv("SESSION_TTL_SECONDS", "86400"))
+# Once the verbatim turns are longer than this, the older ones are folded into the rolling summary
+SESSION_HISTORY_TOKEN_THRESHOLD = int(os.getenv("SESSION_HISTORY_TOKEN_THRESHOLD", "1000"))
+# The most recent turns are always kept verbatim
+SESSION_RECENT_TURNS = int(os.getenv("SESSION_RECENT_TURNS", "2"))
+SESSION_SUMMARY_MAX_WORDS = int(os.getenv("SESSION_SUMMARY_MAX_WORDS", "200"))
+# Verbatim turns kept if summarising keeps failing, the oldest are dropped past this
+SESSION_MAX_TURNS = int(os.getenv("SESSION_MAX_TURNS", "20"))
+# Conversations kept by the in-process store, used when there's no REDIS_URL
+SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", "10000"))
+
+def new_session():
+    return {"summary": "", "summary_through": 0, "turns": []}
+
+def turns_text(turns):
+    return "\n\n".join(f"User: {turn['user']}\nAssistant: {turn['assistant']}" for turn in turns)
+
+'''
+Returns the chat history passed to the prompts, the rolling summary followed by the verbatim turns
+'''
+def history_text(session):
+    parts = []
+    if session["summary"]:
+        parts.append(f"Summary of the earlier conversation: {session['summary']}")
+    if session["turns"]:
+        parts.append(turns_text(session["turns"]))
+    return "\n\n".join(parts)
+
+class MemorySessionStore:
+    """
+    In-process LRU of conversations with a TTL. Sessions are stored serialised, so callers never share
+    (and mutate) the stored copy. Conversations are only visible to the worker which served them.
+
+    Parameters:
+    - max_size: The number of conversations kept
+    - ttl_seconds: How long a conversation is kept after it was last saved
+    """
+    def __init__(self, max_size=SESSION_CACHE_SIZE, ttl_seconds=SESSION_TTL_SECONDS):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    async def aget(self, conversation_id):
+        with self._lock:
+            return self._get(conversation_id)
+
+    async def aset(self, conversation_id, session):
+        with self._lock:
+            self._set(conversation_id, session)
+
+    '''
+    Atomically updates a conversation with update(session), which gets None for a new one and returns the
+    session to save, or None to leave it as it is. Returns what update returned.
+    '''
+    async def aupdate(self, conversation_id, update):
+        with self._lock:
+            session = update(self._get(conversation_id))
+            if session is not None:
+                self._set(conversation_id, session)
+        return session
+
+    def _get(self, conversation_id):
+        entry = self._entries.get(conversation_id)
+        if entry is None:
+            return None
+        expires_at, data = entry
+        if expires_at <= time.monotonic():
+            del self._entries[conversation_id]
+            return None
+        self._entries.move_to_end(conversation_id)
+        return json.loads(data)
+
+    def _set(self, conversation_id, session):
+        self._entries[conversation_id] = (time.monotonic() + self.ttl_seconds, json.dumps(session))
+        self._entries.move_to_end(conversation_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+class RedisSessionStore:
+    """
+    Conversations in Redis as JSON with a TTL, so every worker sees the same history
+
+    Parameters:
+    - redis_client: A redis.asyncio client
+    - ttl_seconds: How long a conversation is kept after it was last saved
+    - prefix: The prefix of every key
+    """
+    def __init__(self, redis_client, ttl_seconds=SESSION_TTL_SECONDS, prefix="session:"):
+        self.redis = redis_client
+        self.ttl_seconds = ttl_seconds
+        self.prefix = prefix
+
+    async def aget(self, conversation_id):
+        data = await self.redis.get(self.prefix + conversation_id)
+        return None if data is None else json.loads(data)
+
+    async def aset(self, conversation_id, session):
+        await self.redis.set(self.prefix + conversation_id, json.dumps(session), ex=self.ttl_seconds)
+
+    '''
+    Atomically updates a conversation as MemorySessionStore.aupdate does, with an optimistic transaction which
+    is retried when another worker changed the conversation meanwhile
+    '''
+    async def aupdate(self, conversation_id, update):
+        key = self.prefix + conversation_id
+        async with self.redis.pipeline(transaction=True) as pipeline:
+            while True:
+                try:
+                    await pipeline.watch(key)
+                    data = await pipeline.get(key)
+                    session = update(None if data is None else json.loads(data))
+                    if session is None:
+                        await pipeline.reset()
+                        return None
+                    pipeline.multi()
+                    pipeline.set(key, json.dumps(session), ex=self.ttl_seconds)
+                    await pipeline.execute()
+                    return session
+                except WatchError:
+                    continue
+
+class ConversationSessions:
+    """
+    Server-side conversation history, so clients send a conversation id instead of the whole history.
+    Each conversation keeps its recent turns verbatim and a rolling summary of the older ones. Once the verbatim
+    turns pass the token threshold, the older turns are folded into the summary by the low cost LLM in the
+    background, so the history in the prompt stays roughly the same size however long the conversation gets.
+    Conversations are updated atomically, so concurrent turns are never lost. Conversation ids are chosen by
+    clients, callers should scope them to the caller (see main.py). Store failures are logged and treated as an
+    empty conversation, they never fail a request.
+
+    Parameters:
+    - store: A MemorySessionStore or RedisSessionStore
+    - tokenizer: The tokenizer the threshold is measured with
+    - token_threshold: The verbatim turn tokens above which older turns are summarised
+    - recent_turns: The number of turns always kept verbatim
+    - summary_max_words: The length the summary is asked to stay under
+    - max_turns: The most verbatim turns kept if summarising fails
+    """
+    def __init__(self, store, tokenizer=None, token_threshold=SESSION_HISTORY_TOKEN_THRESHOLD, recent_turns=SESSION_RECENT_TURNS,
+                 summary_max_words=SESSION_SUMMARY_MAX_WORDS, max_turns=SESSION_MAX_TURNS):
+        self.store = store
+        self._tokenizer = tokenizer
+        self.token_threshold = token_threshold
+        self.recent_turns = recent_turns
+        self.summary_max_words = summary_max_words
+        self.max_turns = max_turns
+        self._tasks = set()
+        self._condensing = set()
+        self.condensed = 0
+        self.condense_failures = 0
+
+    # Loaded on first use, so /health doesn't load the encoding
+    @property
+    def tokenizer(self):
+        if self._tokenizer is None:
+            self._tokenizer = get_tokenizer(LOW_COST_LLM)
+        return self._tokenizer
+
+    '''
+    Returns the chat history of a conversation, empty for a new (or expired) one
+    '''
+    async def ahistory(self, conversation_id):
+        return history_text(await self._aload(conversation_id))
+
+    '''
+    Appends a turn to a conversation, and summarises its older turns in the background if it has grown past the threshold
+
+    Parameters:
+    - conversation_id: The conversation's id
+    - question: The user's question
+    - answer: The answer, any <thinking> blocks are left out of the history
+    - translator: The QueryTranslator whose low cost LLM writes the summary
+    '''
+    async def arecord_turn(self, conversation_id, question, answer, translator):
+        answer = re.sub(r'<thinking>.*?</thinking>', '', answer, flags=re.DOTALL).strip()
+
+        def append(session):
+            last = session["turns"][-1]["n"] if session["turns"] else session["summary_through"]
+            session["turns"].append({"n": last + 1, "user": question, "assistant": answer})
+            session["turns"] = session["turns"][-self.max_turns:]
+            return session
+
+        session = await self._aupdate(conversation_id, append)
+        if session is None:
+            return
+        if self._turns_to_fold(session) and conversation_id not in self._condensing:
+            self._condensing.add(conversation_id)
+            task = asyncio.create_task(self.acondense(conversation_id, translator))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+            task.add_done_callback(lambda _: self._condensing.discard(conversation_id))
+
+    '''
+    Folds a conversation's older turns into its summary. The conversation is read again before writing, turns added
+    meanwhile are kept, and nothing is written if another worker summarised it first.
+    '''
+    async def acondense(self, conversation_id, translator):
+        try:
+            session = await self._aload(conversation_id)
+            fold = self._turns_to_fold(session)
+            if not fold:
+                return
+            summary = await translator.asummarise_history(session["summary"], turns_text(fold), self.summary_max_words)
+            through = fold[-1]["n"]
+
+            def fold_into_summary(latest):
+                if latest["summary_through"] != session["summary_through"]:
+                    return None
+                latest["summary"] = summary
+                latest["summary_through"] = through
+                latest["turns"] = [turn for turn in latest["turns"] if turn["n"] > through]
+                return latest
+
+            if await self._aupdate(conversation_id, fold_into_summary) is not None:
+                self.condensed += 1
+        except Exception as e:
+            self.condense_failures += 1
+            logger.warning(f"Failed to summarise conversation history: {e}")
+
+    def stats(self):
+        return {
+            "store": type(self.store).__name__,
+            "condensing": len(self._condensing),
+            "condensed": self.condensed,
+            "condense_failures": self.condense_failures,
+        }
+
+    # The turns to summarise, every turn but the most recent ones once the verbatim turns are over the threshold
+    def _turns_to_fold(self, session):
+        turns = session["turns"]
+        if len(turns) <= self.recent_turns:
+            return []
+        if len(self.tokenizer.encode(turns_text(turns))) <= self.token_threshold:
+            return []
+        return turns[:len(turns) - self.recent_turns]
+
+    async def _aload(self, conversation_id):
+        try:
+            session = await self.store.aget(conversation_id)
+        except RedisError as e:
+            logger.warning(f"Failed to load conversation, continuing without its history - Redis error: {e}")
+            return new_session()
+        return session if session is not None else new_session()
+
+    # Returns the updated session, None when update left it as it was or the store failed
+    async def _aupdate(self, conversation_id, update):
+        try:
+            return await self.store.aupdate(conversation_id, lambda session: update(session if session is not None else new_session()))
+        except RedisError as e:
+            logger.warning(f"Failed to save conversation - Redis error: {e}")
+            return None
+
+_sessions = None
+
+'''
+Returns the worker's ConversationSessions, stored in Redis when REDIS_URL is set and in process otherwise.
+Created on first use from within the event loop, which the Redis client is bound to.
+'''
+def get_sessions():
+    global _sessions
+    if _sessions is None:
+        redis_url = os.getenv("REDIS_URL")
+        if redis_url:
+            client = redis.from_url(redis_url, ssl_cert_reqs=None) if redis_url.startswith("rediss://") else redis.from_url(redis_url)
+            store = RedisSessionStore(client)
+        else:
+            store = MemorySessionStore()
+        _sessions = ConversationSessions(store)
+    return _sessions
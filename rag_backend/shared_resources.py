@@ -0,0 +1,163 @@
+import hashlib
+import os
+import threading
+import time
+import numpy as np
+import tiktoken
+
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_pinecone import PineconeVectorStore
+from pinecone import Pinecone
+
+try:
+    from .executors import get_executor
+    from .local_vector_index import LocalVectorIndex
+except ImportError:
+    from executors import get_executor
+    from local_vector_index import LocalVectorIndex
+
+# Process-wide singletons for resources that only depend on server configuration.
+# Anything keyed on a user's API key lives in the engine pool instead.
+
+_lock = threading.Lock()
+_pinecone_index = None
+_vector_store = None
+_keyword_index = None
+_tokenizers = {}
+_index_generation = None
+_index_generation_checked_at = 0.0
+
+'''
+Hashes the API keys and model into the key of anything held per caller (pooled engines, coalesced requests), so raw
+keys are never held as dictionary keys
+'''
+def hash_api_keys(openai_api_key, anthropic_api_key, model):
+    digest = hashlib.sha256()
+    for part in (openai_api_key, anthropic_api_key, model):
+        digest.update((part or "").encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+INDEX_GENERATION_CHECK_SECONDS = float(os.getenv("INDEX_GENERATION_CHECK_SECONDS", "300"))
+
+# Where vector searches go, "pinecone" or "local" (a memory-mapped snapshot in LOCAL_INDEX_DIR, see local_vector_index.py)
+VECTOR_BACKEND_PINECONE = "pinecone"
+VECTOR_BACKEND_LOCAL = "local"
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", VECTOR_BACKEND_PINECONE)
+# Adds BM25 keyword search over the snapshot in LOCAL_INDEX_DIR alongside either vector backend, see bm25_index.py
+HYBRID_RETRIEVAL = os.getenv("HYBRID_RETRIEVAL", "false").lower() == "true"
+
+class SharedPineconeVectorStore(PineconeVectorStore):
+    """
+    PineconeVectorStore with a search which also returns the matched vectors, for diversity-aware selection,
+    and a fetch of documents by vector id, for neighbour expansion
+    """
+    def similarity_search_by_vector_with_vectors(self, embedding, *, k=4, filter=None, namespace=None):
+        results = self._index.query(vector=embedding, top_k=k, include_metadata=True, include_values=True, namespace=namespace, filter=filter)
+        matches = []
+        for match in results["matches"]:
+            metadata = dict(match["metadata"])
+            text = metadata.pop(self._text_key, "")
+            matches.append((Document(id=match["id"], page_content=text, metadata=metadata), match["score"], np.asarray(match["values"], dtype=np.float32)))
+        return matches
+
+    def fetch_documents(self, vector_ids, namespace=None):
+        response = self._index.fetch(ids=list(vector_ids), namespace=namespace)
+        documents = {}
+        for vector_id, vector in response.vectors.items():
+            metadata = dict(vector.metadata or {})
+            text = metadata.pop(self._text_key, "")
+            documents[vector_id] = Document(id=vector_id, page_content=text, metadata=metadata)
+        return documents
+
+class _UnboundEmbeddings(Embeddings):
+    """
+    Placeholder embedding for the shared vector store. The store is only ever searched by vector,
+    with queries embedded by the per-key embedding model, so it must never embed text itself.
+    """
+    def embed_documents(self, texts):
+        raise NotImplementedError("The shared vector store is searched by vector, embed with the per-key embedding model")
+
+    def embed_query(self, text):
+        raise NotImplementedError("The shared vector store is searched by vector, embed with the per-key embedding model")
+
+'''
+Returns the process-wide Pinecone index handle, creating it on first use
+'''
+def get_pinecone_index():
+    global _pinecone_index
+    if _pinecone_index is None:
+        with _lock:
+            if _pinecone_index is None:
+                _pinecone_index = Pinecone(api_key=os.getenv("PINECONE_API_KEY")).Index(name=os.getenv("INDEX_NAME"), host=os.getenv("INDEX_HOST"))
+    return _pinecone_index
+
+'''
+Returns the process-wide vector store, either wrapping the shared Pinecone index or a local snapshot,
+depending on VECTOR_BACKEND. Both are searched with similarity_search_by_vector_with_score.
+'''
+def get_vector_store():
+    global _vector_store
+    if _vector_store is None:
+        if VECTOR_BACKEND == VECTOR_BACKEND_LOCAL:
+            with _lock:
+                if _vector_store is None:
+                    _vector_store = LocalVectorIndex(os.getenv("LOCAL_INDEX_DIR"))
+        elif VECTOR_BACKEND == VECTOR_BACKEND_PINECONE:
+            index = get_pinecone_index()
+            with _lock:
+                if _vector_store is None:
+                    _vector_store = SharedPineconeVectorStore(index=index, embedding=_UnboundEmbeddings())
+        else:
+            raise ValueError(f"Unknown vector backend: {VECTOR_BACKEND}")
+    return _vector_store
+
+'''
+Returns the process-wide keyword index for hybrid retrieval, or None when HYBRID_RETRIEVAL is off.
+With the local backend this is the vector store itself, otherwise the snapshot is opened just for its BM25 index.
+'''
+def get_keyword_index():
+    global _keyword_index
+    if not HYBRID_RETRIEVAL:
+        return None
+    if VECTOR_BACKEND == VECTOR_BACKEND_LOCAL:
+        return get_vector_store()
+    if _keyword_index is None:
+        with _lock:
+            if _keyword_index is None:
+                _keyword_index = LocalVectorIndex(os.getenv("LOCAL_INDEX_DIR"))
+    return _keyword_index
+
+'''
+Returns a cached tiktoken encoding for the given model, loading it only once per process
+'''
+def get_tokenizer(model):
+    tokenizer = _tokenizers.get(model)
+    if tokenizer is None:
+        with _lock:
+            tokenizer = _tokenizers.get(model)
+            if tokenizer is None:
+                tokenizer = tiktoken.encoding_for_model(model)
+                _tokenizers[model] = tokenizer
+    return tokenizer
+
+'''
+Returns an identifier for the current contents of the index, used to invalidate anything derived from it.
+INDEX_GENERATION can be set on deploy or after re-indexing. The local backend uses its snapshot name; for Pinecone
+the total vector count is used, which changes whenever the scraper-indexer adds videos. The count is refreshed at
+most every INDEX_GENERATION_CHECK_SECONDS.
+'''
+async def aget_index_generation():
+    global _index_generation, _index_generation_checked_at
+    generation = os.getenv("INDEX_GENERATION")
+    if generation:
+        return generation
+    if VECTOR_BACKEND == VECTOR_BACKEND_LOCAL:
+        return get_vector_store().generation
+    now = time.monotonic()
+    if _index_generation is None or now - _index_generation_checked_at > INDEX_GENERATION_CHECK_SECONDS:
+        _index_generation_checked_at = now
+        stats = await get_executor("vector_search").run(get_pinecone_index().describe_index_stats)
+        _index_generation = str(stats["total_vector_count"])
+    return _index_generation
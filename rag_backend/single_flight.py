@@ -0,0 +1,341 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+
+import redis.asyncio as redis
+from redis.exceptions import LockError, RedisError
+
+try:
+    from .logger import logger as logger
+except ImportError:
+    from logger import logger as logger
+
+SINGLE_FLIGHT_ENABLED = os.getenv("SINGLE_FLIGHT_ENABLED", "true").lower() == "true"
+# How long a worker may hold a question before other workers stop waiting and answer it themselves
+SINGLE_FLIGHT_LEASE_SECONDS = float(os.getenv("SINGLE_FLIGHT_LEASE_SECONDS", "60"))
+# How long a finished answer (or stream) stays in Redis for workers still waiting on it
+SINGLE_FLIGHT_RESULT_TTL_SECONDS = int(os.getenv("SINGLE_FLIGHT_RESULT_TTL_SECONDS", "10"))
+SINGLE_FLIGHT_POLL_SECONDS = float(os.getenv("SINGLE_FLIGHT_POLL_SECONDS", "0.05"))
+
+'''
+Returns the key identical requests are coalesced on, the normalised question plus anything else the answer depends on
+'''
+def request_key(question, *options):
+    normalised = " ".join(question.lower().split())
+    return hashlib.sha256(json.dumps([normalised, *options]).encode("utf-8")).hexdigest()
+
+class _Call:
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+
+class _SharedStream:
+    """
+    The events of one streamed answer, replayed to subscribers which join late and followed live after that
+    """
+    def __init__(self):
+        self.events = []
+        self.done = False
+        self.error = None
+        self.subscribers = 0
+        self.task = None
+        # Whether the events come from another worker's stream rather than a computation in this one
+        self.followed = False
+        self._changed = asyncio.Event()
+
+    def publish(self, event):
+        self.events.append(event)
+        self._notify()
+
+    def finish(self, error=None):
+        self.done = True
+        self.error = error
+        self._notify()
+
+    async def wait(self):
+        await self._changed.wait()
+
+    def _notify(self):
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+class SingleFlight:
+    """
+    Coalesces identical in-flight requests, so one computation runs and every waiter shares its result or its stream.
+    Within a worker, waiters share one task. With a Redis client the worker running a key holds a lease on it, and
+    the other workers wait for the result (or follow the stream through a Redis stream) instead of computing it too.
+    The computation is only cancelled once every waiter has gone. A failure may be down to the request which was
+    computed, so the waiters it failed retry once through the single flight, where one of them computes the request
+    again for the rest, and a failure of that retry is passed on. Redis failures are logged and the request is
+    computed locally, they never fail a request.
+
+    Parameters:
+    - redis_client: An optional redis.asyncio client, for coalescing across workers
+    - lease_seconds: How long a worker holds a key before others give up waiting on it
+    - result_ttl_seconds: How long a finished result stays in Redis for late waiters
+    - poll_interval: How often a waiting worker checks for the result
+    - prefix: The prefix of every Redis key
+    """
+    def __init__(self, redis_client=None, lease_seconds=SINGLE_FLIGHT_LEASE_SECONDS, result_ttl_seconds=SINGLE_FLIGHT_RESULT_TTL_SECONDS,
+                 poll_interval=SINGLE_FLIGHT_POLL_SECONDS, prefix="single_flight:"):
+        self.redis = redis_client
+        self.lease_seconds = lease_seconds
+        self.result_ttl_seconds = result_ttl_seconds
+        self.poll_interval = poll_interval
+        self.prefix = prefix
+        self._calls = {}
+        self._streams = {}
+        self.computed = 0
+        self.local_coalesced = 0
+        self.shared_coalesced = 0
+
+    '''
+    Runs factory() once for concurrent callers with the same key
+
+    Parameters:
+    - key: The request key, see request_key
+    - factory: A callable returning an awaitable of a JSON serialisable result
+    - retry: Whether to retry through the single flight if the shared computation fails
+
+    Returns:
+    - The result, and whether this caller's request was the one computed
+    '''
+    async def run(self, key, factory, retry=True):
+        call = self._calls.get(key)
+        leader = call is None
+        if leader:
+            call = self._calls[key] = _Call(asyncio.ensure_future(self._compute(key, factory)))
+            call.task.add_done_callback(lambda _: self._forget(self._calls, key, call))
+        else:
+            self.local_coalesced += 1
+        call.waiters += 1
+        try:
+            result, shared = await asyncio.shield(call.task)
+        except Exception as e:
+            if leader or not retry:
+                raise
+            error = e
+        else:
+            return result, leader and not shared
+        finally:
+            call.waiters -= 1
+            if call.waiters == 0 and not call.task.done():
+                call.task.cancel()
+        # The failed call has been forgotten by now, so the first waiter to retry starts a new one and the rest join it
+        logger.warning(f"Coalesced request failed, retrying it - {type(error).__name__}: {error}")
+        return await self.run(key, factory, retry=False)
+
+    '''
+    Streams the events of factory() once for concurrent callers with the same key, callers joining late are
+    sent the events they missed first
+
+    Parameters:
+    - key: The request key, see request_key
+    - factory: A callable returning an async iterator of JSON serialisable events
+    - retry: Whether to retry through the single flight if the shared stream fails before sending anything
+
+    Returns:
+    - An async generator of the events
+    '''
+    async def stream(self, key, factory, retry=True):
+        shared = self._streams.get(key)
+        leader = shared is None
+        if leader:
+            shared = self._streams[key] = _SharedStream()
+            shared.task = asyncio.ensure_future(self._compute_stream(key, factory, shared))
+            shared.task.add_done_callback(lambda _: self._forget(self._streams, key, shared))
+        else:
+            self.local_coalesced += 1
+        shared.subscribers += 1
+        index = 0
+        try:
+            while True:
+                while index < len(shared.events):
+                    yield shared.events[index]
+                    index += 1
+                if shared.done:
+                    if shared.error is None:
+                        return
+                    if leader and not shared.followed:
+                        raise shared.error
+                    break
+                await shared.wait()
+        finally:
+            shared.subscribers -= 1
+            if shared.subscribers == 0 and not shared.task.done():
+                shared.task.cancel()
+        # A follower which has been sent part of the answer can only report that it stopped. The others retry once
+        # through the single flight like run's waiters do.
+        if index:
+            raise RuntimeError("The answer stopped before finishing")
+        if not retry:
+            raise shared.error
+        logger.warning(f"Coalesced stream failed, retrying it - {type(shared.error).__name__}")
+        async for event in self.stream(key, factory, retry=False):
+            yield event
+
+    def stats(self):
+        return {
+            "in_flight": len(self._calls) + len(self._streams),
+            "computed": self.computed,
+            "local_coalesced": self.local_coalesced,
+            "shared_coalesced": self.shared_coalesced,
+            "shared": self.redis is not None,
+        }
+
+    # Only removes the entry if it still belongs to the finished call, a new one may have replaced it
+    def _forget(self, calls, key, call):
+        if calls.get(key) is call:
+            del calls[key]
+
+    async def _compute(self, key, factory):
+        lock, shared = await self._acquire_or_wait(key, self._shared_result)
+        if shared is not None:
+            return shared, True
+        self.computed += 1
+        try:
+            result = await factory()
+            if lock is not None:
+                await self._redis_call(self.redis.set(self._key("result", key), json.dumps(result), ex=self.result_ttl_seconds))
+            return result, False
+        finally:
+            await self._release(lock)
+
+    async def _compute_stream(self, key, factory, shared):
+        try:
+            lock, started = await self._acquire_or_wait(key, self._shared_stream_started)
+            if started:
+                shared.followed = True
+                await self._follow_shared_stream(key, shared)
+                self.shared_coalesced += 1
+            else:
+                self.computed += 1
+                try:
+                    await self._lead_stream(key, factory, shared, lock)
+                finally:
+                    await self._release(lock)
+            shared.finish()
+        except asyncio.CancelledError:
+            shared.finish(asyncio.CancelledError())
+            raise
+        except Exception as e:
+            # Forgotten before its subscribers wake up, so their retries start a new stream rather than rejoin this one
+            self._forget(self._streams, key, shared)
+            shared.finish(e)
+
+    '''
+    Takes the key's lease, or waits for the worker holding it. Returns (lock, None) when this worker should compute,
+    the lock being None when there's no Redis or it failed, or (None, shared) once find_shared finds another
+    worker's result.
+    '''
+    async def _acquire_or_wait(self, key, find_shared):
+        if self.redis is None:
+            return None, None
+        lock = self.redis.lock(self._key("lock", key), timeout=self.lease_seconds, blocking=False)
+        deadline = time.monotonic() + self.lease_seconds
+        try:
+            while time.monotonic() < deadline:
+                shared = await find_shared(key)
+                if shared is not None:
+                    return None, shared
+                if await lock.acquire():
+                    return lock, None
+                await asyncio.sleep(self.poll_interval)
+        except RedisError as e:
+            logger.warning(f"Single flight falling back to local computation - Redis error: {e}")
+            return None, None
+        logger.warning(f"Single flight gave up waiting on another worker after {self.lease_seconds}s, computing locally")
+        return None, None
+
+    async def _shared_result(self, key):
+        data = await self.redis.get(self._key("result", key))
+        if data is None:
+            return None
+        self.shared_coalesced += 1
+        return json.loads(data)
+
+    # A stream which ended in an error is left for its followers, retries lead a new one rather than follow it
+    async def _shared_stream_started(self, key):
+        last = await self.redis.xrevrange(self._key("stream", key), count=1)
+        if not last or "error" in json.loads(last[0][1][b"data"]):
+            return None
+        return True
+
+    async def _lead_stream(self, key, factory, shared, lock):
+        stream_key = self._key("stream", key)
+        if lock is not None:
+            # A finished stream from an earlier request may still be there for its late followers
+            await self._redis_call(self.redis.delete(stream_key))
+        try:
+            async for event in factory():
+                shared.publish(event)
+                if lock is not None:
+                    await self._redis_call(self._append(stream_key, {"event": event}, self.lease_seconds))
+        except Exception:
+            # Only marks the failure, the error itself isn't passed on to other workers' requests
+            if lock is not None:
+                await self._redis_call(self._append(stream_key, {"error": True}, self.result_ttl_seconds))
+            raise
+        if lock is not None:
+            await self._redis_call(self._append(stream_key, {"end": True}, self.result_ttl_seconds))
+
+    async def _append(self, stream_key, entry, ttl):
+        pipeline = self.redis.pipeline(transaction=False)
+        pipeline.xadd(stream_key, {"data": json.dumps(entry)})
+        pipeline.expire(stream_key, int(ttl))
+        await pipeline.execute()
+
+    # Follows another worker's stream until its end or error marker. If nothing arrives within the lease its worker has died.
+    async def _follow_shared_stream(self, key, shared):
+        stream_key = self._key("stream", key)
+        last_id = "0"
+        block_ms = int(self.lease_seconds * 1000)
+        while True:
+            response = await self.redis.xread({stream_key: last_id}, block=block_ms)
+            if not response:
+                raise RuntimeError("The worker answering this question stopped before finishing")
+            for entry_id, fields in response[0][1]:
+                last_id = entry_id
+                entry = json.loads(fields[b"data"])
+                if entry.get("end"):
+                    return
+                if "error" in entry:
+                    raise RuntimeError("The worker answering this question failed")
+                shared.publish(tuple(entry["event"]) if isinstance(entry["event"], list) else entry["event"])
+
+    async def _release(self, lock):
+        if lock is None:
+            return
+        try:
+            await lock.release()
+        except (LockError, RedisError) as e:
+            logger.warning(f"Failed to release single flight lease: {e}")
+
+    async def _redis_call(self, awaitable):
+        try:
+            return await awaitable
+        except RedisError as e:
+            logger.warning(f"Single flight Redis write failed: {e}")
+
+    def _key(self, kind, key):
+        return f"{self.prefix}{kind}:{key}"
+
+_single_flight = None
+
+'''
+Returns the worker's SingleFlight, shared through Redis when REDIS_URL is set, or None when SINGLE_FLIGHT_ENABLED is off.
+Created on first use from within the event loop, which the Redis client is bound to.
+'''
+def get_single_flight():
+    global _single_flight
+    if not SINGLE_FLIGHT_ENABLED:
+        return None
+    if _single_flight is None:
+        redis_url = os.getenv("REDIS_URL")
+        client = None
+        if redis_url:
+            client = redis.from_url(redis_url, ssl_cert_reqs=None) if redis_url.startswith("rediss://") else redis.from_url(redis_url)
+        _single_flight = SingleFlight(client)
+    return _single_flight
@@ -0,0 +1,111 @@
+import asyncio
+import os
+import sys
+from types import SimpleNamespace
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from rag_backend.admission import AdmissionController, AdmissionRejected, LocalRateLimiter, TokenBucket, admission_key
+
+def test_admission_key_hides_the_api_key():
+    key = admission_key("sk-ant-secret")
+    assert "secret" not in key
+    assert key == admission_key("sk-ant-secret") != admission_key("sk-ant-other")
+
+@pytest.mark.asyncio
+async def test_requests_over_the_cap_wait_for_a_slot():
+    controller = AdmissionController(max_in_flight=1, queue_size=4, service_seconds=0.01)
+    first = await controller.acquire("a", deadline_seconds=10)
+    waiter = asyncio.create_task(controller.acquire("a", deadline_seconds=10))
+    await asyncio.sleep(0)
+    assert not waiter.done()
+    assert controller.stats()["waiting"] == 1
+
+    first.release()
+    second = await asyncio.wait_for(waiter, timeout=1)
+    assert controller.in_flight == 1, "The slot should be handed over rather than freed"
+    second.release()
+    second.release()
+    assert controller.in_flight == 0
+
+@pytest.mark.asyncio
+async def test_waiting_requests_are_served_round_robin_across_keys():
+    controller = AdmissionController(max_in_flight=1, queue_size=10, service_seconds=0.01)
+    running = await controller.acquire("busy", deadline_seconds=10)
+    order = []
+
+    async def request(key):
+        ticket = await controller.acquire(key, deadline_seconds=10)
+        order.append(key)
+        await asyncio.sleep(0)
+        ticket.release()
+
+    tasks = [asyncio.create_task(request(key)) for key in ("busy", "busy", "busy", "quiet")]
+    await asyncio.sleep(0)
+    running.release()
+    await asyncio.wait_for(asyncio.gather(*tasks), timeout=1)
+    assert order == ["busy", "quiet", "busy", "busy"]
+
+@pytest.mark.asyncio
+async def test_requests_which_would_miss_their_deadline_are_shed():
+    controller = AdmissionController(max_in_flight=1, queue_size=10, service_seconds=5)
+    ticket = await controller.acquire("a", deadline_seconds=30)
+    with pytest.raises(AdmissionRejected) as rejected:
+        await controller.acquire("b", deadline_seconds=8)
+    assert rejected.value.status_code == 503
+    assert rejected.value.retry_after == 5
+    assert controller.stats()["shed"] == 1
+    assert controller.stats()["waiting"] == 0
+    ticket.release()
+
+@pytest.mark.asyncio
+async def test_full_queues_shed_requests():
+    controller = AdmissionController(max_in_flight=1, queue_size=1, service_seconds=0.01)
+    ticket = await controller.acquire("a", deadline_seconds=10)
+    waiter = asyncio.create_task(controller.acquire("b", deadline_seconds=10))
+    await asyncio.sleep(0)
+    with pytest.raises(AdmissionRejected):
+        await controller.acquire("c", deadline_seconds=10)
+    ticket.release()
+    (await waiter).release()
+
+@pytest.mark.asyncio
+async def test_cancelled_waiters_leave_the_queue():
+    controller = AdmissionController(max_in_flight=1, queue_size=4, service_seconds=0.01)
+    ticket = await controller.acquire("a", deadline_seconds=10)
+    waiter = asyncio.create_task(controller.acquire("b", deadline_seconds=10))
+    await asyncio.sleep(0)
+    waiter.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await waiter
+    assert controller.stats()["waiting"] == 0
+    ticket.release()
+    assert controller.in_flight == 0
+
+@pytest.mark.asyncio
+async def test_service_time_follows_finished_pipelines():
+    controller = AdmissionController(max_in_flight=2, service_seconds=10)
+    ticket = await controller.acquire("a")
+    ticket.release()
+    assert controller.service_seconds < 10
+    assert controller.estimated_wait("a") == pytest.approx(controller.service_seconds / 2)
+
+def test_token_bucket_allows_bursts_then_refills():
+    bucket = TokenBucket(capacity=2, period=60)
+    assert bucket.take() == 0
+    assert bucket.take() == 0
+    assert bucket.take() == pytest.approx(30, rel=0.01)
+
+@pytest.mark.asyncio
+async def test_local_rate_limiter_limits_each_caller():
+    limiter = LocalRateLimiter(times=1, seconds=60)
+
+    def request(ip):
+        return SimpleNamespace(headers={}, client=SimpleNamespace(host=ip), scope={"path": "/prompt"})
+
+    await limiter(request("1.1.1.1"), None)
+    await limiter(request("2.2.2.2"), None)
+    with pytest.raises(AdmissionRejected) as rejected:
+        await limiter(request("1.1.1.1"), None)
+    assert rejected.value.status_code == 429
+    assert rejected.value.retry_after == 60
@@ -0,0 +1,39 @@
+import math
+import os
+import sys
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from rag_backend.bm25_index import BM25Index, build_bm25_index, tokenize
+
+texts = [
+    "Alpha-GPC is a choline supplement used for focus",
+    "Sleep and light exposure in the morning set the circadian clock",
+    "Morning sunlight viewing improves sleep and sleep quality",
+    "Cold exposure increases dopamine",
+]
+
+def test_tokenize_lowercases_and_drops_stopwords():
+    assert tokenize("The Alpha-GPC and L-Tyrosine") == ["alpha", "gpc", "l", "tyrosine"]
+
+def test_exact_terms_rank_first():
+    index = build_bm25_index(texts)
+    assert [row for row, _ in index.search("alpha gpc dose", k=2)] == [0]
+    assert index.search("unrelated words", k=2) == []
+
+def test_scores_match_the_bm25_formula():
+    index = build_bm25_index(texts, k1=1.2, b=0.75)
+    results = dict(index.search("sleep", k=4))
+    lengths = [len(tokenize(text)) for text in texts]
+    average = sum(lengths) / len(lengths)
+    idf = math.log(1 + (4 - 2 + 0.5) / (2 + 0.5))
+    expected = idf * 2 * 2.2 / (2 + 1.2 * (0.25 + 0.75 * lengths[2] / average))
+    assert set(results) == {1, 2}
+    assert results[2] == pytest.approx(expected, rel=1e-5), "Repeated terms should raise the score"
+    assert results[2] > results[1]
+
+def test_save_and_load_round_trip(tmp_path):
+    index = build_bm25_index(texts)
+    index.save(str(tmp_path))
+    loaded = BM25Index.load(str(tmp_path))
+    assert loaded.search("morning sleep", k=3) == index.search("morning sleep", k=3)
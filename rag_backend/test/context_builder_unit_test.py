@@ -0,0 +1,33 @@
+import os
+import sys
+from langchain_core.documents import Document
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from rag_backend.context_builder import build_context
+
+class WordTokenizer:
+    def encode(self, text):
+        return text.split()
+
+def split(video_id, chunk_index, split_index, content):
+    return Document(page_content=content, metadata={"chunk_index": float(chunk_index), "split_index": float(split_index), "video_id": video_id, "video_title": f"Episode {video_id}", "video_url": f"https://www.youtube.com/watch?v={video_id}"})
+
+def test_splits_are_grouped_by_video_with_metadata_once():
+    docs = [split("abc", 0, 2, "second split"), split("xyz", 1, 0, "other video"), split("abc", 0, 1, "first split")]
+    context = build_context(docs, WordTokenizer(), max_tokens=1000)
+    assert context.count("https://www.youtube.com/watch?v=abc") == 1, "Each video's url should appear once"
+    assert context.index("first split") < context.index("second split"), "Splits should be in transcript order within a video"
+    assert context.index("Episode abc") < context.index("Episode xyz"), "Videos should keep the rank order of their best split"
+    assert '<split chunk="0" index="1">' in context
+
+def test_budget_and_document_cap_are_enforced():
+    docs = [split("abc", 0, i, "word " * 20) for i in range(5)]
+    tokenizer = WordTokenizer()
+    context = build_context(docs, tokenizer, max_tokens=60)
+    assert len(tokenizer.encode(context)) <= 60
+    assert context.count("<split ") == 2
+    assert build_context(docs, tokenizer, max_tokens=1000, max_documents=3).count("<split ") == 3
+
+def test_titles_are_escaped():
+    doc = Document(page_content="text", metadata={"video_id": "1", "video_title": 'The "Best" <Sleep>', "video_url": "u"})
+    assert 'title="The &quot;Best&quot; &lt;Sleep&gt;"' in build_context([doc], WordTokenizer())
@@ -0,0 +1,87 @@
+import asyncio
+import os
+import sys
+import time
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from rag_backend.deadline import Deadline, Hedger, LatencyTracker, Timeout
+
+def warmed_hedger(latency, samples=10):
+    tracker = LatencyTracker(window=100, min_samples=samples)
+    for _ in range(samples):
+        tracker.record(latency)
+    return Hedger("test", min_delay=0.0, enabled=True, tracker=tracker)
+
+def test_deadline_slices_what_is_left():
+    deadline = Deadline(10)
+    assert deadline.slice(0.5) == pytest.approx(5, abs=0.1)
+    assert not deadline.expired
+    assert Deadline(0).expired and Deadline(0).slice(0.5) == 0
+
+@pytest.mark.asyncio
+async def test_calls_are_not_hedged_until_latencies_are_known():
+    hedger = Hedger("test", enabled=True, tracker=LatencyTracker(min_samples=5))
+    attempts = 0
+
+    async def attempt():
+        nonlocal attempts
+        attempts += 1
+        await asyncio.sleep(0.02)
+        return attempts
+
+    assert await hedger.call(attempt) == 1
+    assert hedger.stats()["hedged"] == 0 and hedger.stats()["delay_ms"] is None
+
+@pytest.mark.asyncio
+async def test_slow_first_attempt_is_hedged_and_the_second_wins():
+    hedger = warmed_hedger(0.01)
+    attempts = []
+
+    async def attempt():
+        attempts.append(len(attempts))
+        # The first attempt is stuck, the hedge answers straight away
+        await asyncio.sleep(5 if len(attempts) == 1 else 0)
+        return len(attempts)
+
+    start = time.perf_counter()
+    assert await hedger.call(attempt) == 2
+    assert time.perf_counter() - start < 1
+    assert hedger.stats()["hedged"] == 1 and hedger.stats()["hedge_wins"] == 1
+
+@pytest.mark.asyncio
+async def test_fast_calls_are_not_hedged_and_a_failed_hedge_falls_back_to_the_first():
+    hedger = warmed_hedger(0.05)
+
+    async def fast():
+        return "fast"
+
+    assert await hedger.call(fast) == "fast"
+    assert hedger.stats()["hedged"] == 0
+
+    attempts = 0
+
+    async def second_fails():
+        nonlocal attempts
+        attempts += 1
+        if attempts == 2:
+            raise ConnectionError("hedge failed")
+        await asyncio.sleep(0.1)
+        return "first"
+
+    assert await hedger.call(second_fails) == "first"
+
+@pytest.mark.asyncio
+async def test_timeout_raises_once_the_time_runs_out():
+    with pytest.raises(asyncio.TimeoutError):
+        async with Timeout(0.01):
+            await asyncio.sleep(1)
+    async with Timeout(None):
+        await asyncio.sleep(0)
+
+@pytest.mark.asyncio
+async def test_disarmed_timeout_lets_the_block_finish():
+    async with Timeout(0.02) as timeout:
+        timeout.disarm()
+        await asyncio.sleep(0.05)
+    assert not timeout.expired
@@ -0,0 +1,44 @@
+import os
+import sys
+import numpy as np
+from langchain_core.documents import Document
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from rag_backend.diversity import mmr_select, select_diverse
+from rag_backend.tracing import RequestTrace
+
+def split(video_id, split_index):
+    return Document(id=f"{video_id}_chunk0_split{split_index}", page_content=f"Content {split_index}", metadata={"video_id": video_id})
+
+def test_mmr_prefers_unlike_candidates():
+    vectors = np.array([[1, 0], [1, 0], [0, 1]], dtype=np.float32)
+    selected, duplicates = mmr_select(vectors, [1.0, 0.9, 0.8], k=2, lambda_mult=0.5)
+    assert selected == [0, 2], "The second copy of the best candidate adds nothing new"
+    assert duplicates == 0
+    assert mmr_select(vectors, [1.0, 0.9, 0.8], k=2, lambda_mult=1.0)[0] == [0, 1], "Lambda 1 ranks on relevance alone"
+
+def test_splits_per_video_are_capped():
+    documents = [split("a", 0), split("a", 1), split("a", 2), split("b", 0)]
+    vectors = {doc.id: vector for doc, vector in zip(documents, np.eye(4, dtype=np.float32))}
+    selected = select_diverse(documents, vectors, k=4, lambda_mult=1.0, max_per_video=2)
+    assert [doc.id for doc in selected] == ["a_chunk0_split0", "a_chunk0_split1", "b_chunk0_split0"]
+
+def test_near_duplicates_are_dropped_and_recorded():
+    documents = [split("a", 0), split("b", 0), split("c", 0)]
+    vectors = {"a_chunk0_split0": [1.0, 0.0], "b_chunk0_split0": [0.99, 0.01], "c_chunk0_split0": [0.0, 1.0]}
+    trace = RequestTrace()
+    with trace.span("diversity") as span:
+        selected = select_diverse(documents, vectors, k=3, lambda_mult=1.0, duplicate_threshold=0.95, span=span)
+    assert [doc.id for doc in selected] == ["a_chunk0_split0", "c_chunk0_split0"]
+    assert trace.as_dict()["spans"][0]["duplicates"] == 1
+
+def test_relevance_comes_from_the_query_vector_when_given():
+    documents = [split("a", 0), split("b", 0)]
+    vectors = {"a_chunk0_split0": [1.0, 0.0], "b_chunk0_split0": [0.0, 1.0]}
+    assert select_diverse(documents, vectors, k=1)[0].id == "a_chunk0_split0", "Without a query vector rank order is kept"
+    assert select_diverse(documents, vectors, query_vector=[0.1, 0.9], k=1)[0].id == "b_chunk0_split0"
+
+def test_documents_without_vectors_are_kept():
+    documents = [split("a", 0), split("b", 0)]
+    selected = select_diverse(documents, {"a_chunk0_split0": [1.0, 0.0]}, k=2)
+    assert [doc.id for doc in selected] == ["a_chunk0_split0", "b_chunk0_split0"]
@@ -0,0 +1,63 @@
+import os
+import sys
+import pytest
+from langchain_core.embeddings import Embeddings
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from rag_backend import embedding_cache
+from rag_backend.executors import ExecutorSaturatedError
+from rag_backend.embedding_cache import CachedEmbeddings, MemoryEmbeddingStore, SQLiteEmbeddingStore, embedding_cache_key
+
+class CountingEmbeddings(Embeddings):
+    def __init__(self):
+        self.embedded = []
+
+    def embed_documents(self, texts):
+        self.embedded.extend(texts)
+        return [[float(len(text)), 0.5, -1.0] for text in texts]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+def test_repeated_and_duplicate_texts_are_embedded_once():
+    underlying = CountingEmbeddings()
+    cached = CachedEmbeddings(underlying, model="test-model", memory_store=MemoryEmbeddingStore())
+    vectors = cached.embed_documents(["sleep tips", "sleep  tips ", "focus"])
+    assert vectors[0] == vectors[1] == [10.0, 0.5, -1.0], "Whitespace variants should share an entry"
+    assert cached.embed_query("focus") == [5.0, 0.5, -1.0]
+    assert underlying.embedded == ["sleep tips", "focus"], "Each normalised text should only be embedded once"
+
+def test_shared_tier_is_used_across_memory_stores(tmp_path):
+    shared = SQLiteEmbeddingStore(str(tmp_path / "embeddings.db"))
+    first = CachedEmbeddings(CountingEmbeddings(), model="test-model", memory_store=MemoryEmbeddingStore(), shared_store=shared)
+    first.embed_query("dopamine")
+    underlying = CountingEmbeddings()
+    second = CachedEmbeddings(underlying, model="test-model", memory_store=MemoryEmbeddingStore(), shared_store=shared)
+    assert second.embed_query("dopamine") == [8.0, 0.5, -1.0]
+    assert underlying.embedded == [] and second.stats()["shared_hits"] == 1, "A fresh process should hit the shared tier"
+
+def test_keys_depend_on_model():
+    assert embedding_cache_key("sleep", "model-a") != embedding_cache_key("sleep", "model-b")
+
+@pytest.mark.asyncio
+async def test_async_path_uses_cache():
+    underlying = CountingEmbeddings()
+    cached = CachedEmbeddings(underlying, model="test-model", memory_store=MemoryEmbeddingStore(max_entries=1))
+    await cached.aembed_query("a")
+    await cached.aembed_query("a")
+    await cached.aembed_query("b")
+    await cached.aembed_query("a")
+    assert underlying.embedded == ["a", "b", "a"], "Memory tier should evict beyond its maximum size"
+
+@pytest.mark.asyncio
+async def test_saturated_shared_tier_is_a_miss(tmp_path, monkeypatch):
+    class SaturatedExecutor:
+        async def run(self, fn, *args):
+            raise ExecutorSaturatedError("Executor 'embedding_cache' is saturated")
+
+    monkeypatch.setattr(embedding_cache, "get_executor", lambda name: SaturatedExecutor())
+    underlying = CountingEmbeddings()
+    shared = SQLiteEmbeddingStore(str(tmp_path / "embeddings.db"))
+    cached = CachedEmbeddings(underlying, model="test-model", memory_store=MemoryEmbeddingStore(), shared_store=shared)
+    assert await cached.aembed_query("sleep") == [5.0, 0.5, -1.0]
+    assert underlying.embedded == ["sleep"]
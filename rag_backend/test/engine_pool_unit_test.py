@@ -0,0 +1,41 @@
+import os
+import sys
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from rag_backend import engine_pool
+from rag_backend.engine_pool import EnginePool, hash_api_keys
+
+class FakeEngine:
+    def __init__(self, openai_api_key, anthropic_api_key, model):
+        self.openai_api_key = openai_api_key
+        self.anthropic_api_key = anthropic_api_key
+        self.model = model
+
+@pytest.fixture(autouse=True)
+def fake_engine(monkeypatch):
+    monkeypatch.setattr(engine_pool, "RAGEngine", FakeEngine)
+
+def test_same_keys_reuse_engine():
+    pool = EnginePool(max_size=2)
+    first = pool.get("sk-a", "ak-a")
+    assert pool.get("sk-a", "ak-a") is first, "Engines should be reused for the same API keys"
+    assert pool.stats()["hits"] == 1 and pool.stats()["misses"] == 1
+
+def test_different_model_gets_different_engine():
+    pool = EnginePool(max_size=2)
+    assert pool.get("sk-a", "ak-a", model="m1") is not pool.get("sk-a", "ak-a", model="m2"), "Engines should be keyed on model as well as API keys"
+
+def test_least_recently_used_engine_is_evicted():
+    pool = EnginePool(max_size=2)
+    a = pool.get("sk-a", "ak")
+    pool.get("sk-b", "ak")
+    pool.get("sk-a", "ak")
+    pool.get("sk-c", "ak")
+    assert len(pool) == 2, "Pool should never exceed its maximum size"
+    assert pool.get("sk-a", "ak") is a, "Recently used engine should survive eviction"
+
+def test_hash_does_not_contain_raw_keys():
+    key = hash_api_keys("sk-secret", "ak-secret", "model")
+    assert "secret" not in key
+    assert key != hash_api_keys("sk-secre", "tak-secret", "model"), "Key boundaries should be part of the hash"
@@ -0,0 +1,50 @@
+import os
+import sys
+import time
+import asyncio
+import threading
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from rag_backend.executors import BoundedExecutor, ExecutorSaturatedError
+
+@pytest.mark.asyncio
+async def test_run_returns_result_and_counts_calls():
+    executor = BoundedExecutor("test", max_workers=2, max_queue=2)
+    assert await executor.run(lambda x, y=0: x + y, 1, y=2) == 3
+    stats = executor.stats()
+    assert stats["submitted"] == 1 and stats["completed"] == 1 and stats["active"] == 0
+
+@pytest.mark.asyncio
+async def test_calls_beyond_queue_are_rejected():
+    executor = BoundedExecutor("test", max_workers=1, max_queue=1)
+    release = threading.Event()
+    blocked = [asyncio.create_task(executor.run(release.wait)) for _ in range(2)]
+    await asyncio.sleep(0.05)
+    with pytest.raises(ExecutorSaturatedError):
+        await executor.run(time.sleep, 0)
+    release.set()
+    await asyncio.gather(*blocked)
+    stats = executor.stats()
+    assert stats["rejected"] == 1, "Saturated call should be counted as rejected"
+    assert stats["peak_in_flight"] == 2 and stats["queued"] == 0
+
+@pytest.mark.asyncio
+async def test_cancelled_callers_keep_their_slot_until_the_call_finishes():
+    executor = BoundedExecutor("test", max_workers=1, max_queue=0)
+    release = threading.Event()
+    caller = asyncio.create_task(executor.run(release.wait))
+    await asyncio.sleep(0.05)
+    caller.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await caller
+    with pytest.raises(ExecutorSaturatedError):
+        await executor.run(time.sleep, 0)
+    assert executor.stats()["active"] == 1
+    release.set()
+    for _ in range(100):
+        if executor.in_flight == 0:
+            break
+        await asyncio.sleep(0.01)
+    assert await executor.run(lambda: "ok") == "ok"
+    assert executor.stats()["queued"] == 0
@@ -0,0 +1,225 @@
+import asyncio
+import os
+import sys
+import json
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from rag_backend.jobs import JobQueue, JobQueueFull, LocalJobBackend, RedisJobBackend
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.calls = []
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self.calls.append(getattr(self.redis, name)(*args, **kwargs))
+
+    async def execute(self):
+        return [await call for call in self.calls]
+
+class FakeRedis:
+    """
+    The part of redis.asyncio RedisJobBackend's queue uses, shared by backends standing in for separate workers
+    """
+    def __init__(self):
+        self.values = {}
+        self.lists = {}
+
+    def pipeline(self, transaction=False):
+        return FakePipeline(self)
+
+    async def get(self, key):
+        return self.values.get(key)
+
+    async def set(self, key, value, ex=None):
+        self.values[key] = str(value).encode("utf-8")
+
+    async def exists(self, key):
+        return int(key in self.values)
+
+    async def delete(self, key):
+        self.values.pop(key, None)
+
+    async def llen(self, key):
+        return len(self.lists.get(key, []))
+
+    async def lpush(self, key, value):
+        self.lists.setdefault(key, []).insert(0, value.encode("utf-8"))
+
+    async def rpush(self, key, value):
+        self.lists.setdefault(key, []).append(value)
+
+    async def lrange(self, key, start, end):
+        return list(self.lists.get(key, []))
+
+    async def lrem(self, key, count, value):
+        if value not in self.lists.get(key, []):
+            return 0
+        self.lists[key].remove(value)
+        return 1
+
+    async def blmove(self, source, destination, timeout, src, dest):
+        assert (src, dest) == ("RIGHT", "LEFT")
+        if not self.lists.get(source):
+            await asyncio.sleep(timeout)
+            return None
+        value = self.lists[source].pop()
+        self.lists.setdefault(destination, []).insert(0, value)
+        return value
+
+    async def xadd(self, key, fields):
+        self.lists.setdefault(key, []).append(fields)
+
+    async def expire(self, key, ttl):
+        pass
+
+async def answer_runner(request, secrets):
+    assert secrets == {"openai_api_key": "sk-test"}
+    yield "sources", [{"video_title": "Sleep", "video_url": "https://youtu.be/sleep"}]
+    await asyncio.sleep(0.01)
+    yield "token", "Get morning "
+    yield "token", "sunlight"
+    yield "costs", {"generation_cost": 0.01, "retrieval_cost": 0.0, "translation_cost": 0.0}
+
+async def wait_for(job_queue, job_id, status):
+    while (await job_queue.get(job_id))["status"] != status:
+        await asyncio.sleep(0.005)
+    return await job_queue.get(job_id)
+
+@pytest.mark.asyncio
+async def test_submitted_jobs_are_answered_in_the_background():
+    job_queue = JobQueue(LocalJobBackend(), workers=2)
+    job = await job_queue.submit({"user_input": "How do I sleep better?"}, {"openai_api_key": "sk-test"})
+    assert job["status"] == "queued"
+    assert "sk-test" not in str(await job_queue.get(job["id"])), "API keys shouldn't be saved with the job"
+
+    job_queue.start(answer_runner)
+    try:
+        finished = await asyncio.wait_for(wait_for(job_queue, job["id"], "done"), timeout=1)
+    finally:
+        await job_queue.stop()
+    assert finished["result"]["answer"] == "Get morning sunlight"
+    assert finished["result"]["generation_cost"] == 0.01
+    assert finished["result"]["sources"][0]["video_title"] == "Sleep"
+    assert finished["finished_at"] >= finished["started_at"] >= finished["created_at"]
+    assert job_queue.stats()["completed"] == 1
+
+@pytest.mark.asyncio
+async def test_subscribers_get_every_event_and_the_result():
+    job_queue = JobQueue(LocalJobBackend(), workers=1)
+    job = await job_queue.submit({"user_input": "How do I sleep better?"}, {"openai_api_key": "sk-test"})
+    job_queue.start(answer_runner)
+    try:
+        early = asyncio.create_task(asyncio.wait_for(collect(job_queue, job["id"]), timeout=1))
+        await wait_for(job_queue, job["id"], "done")
+        late = await asyncio.wait_for(collect(job_queue, job["id"]), timeout=1)
+    finally:
+        await job_queue.stop()
+    for events in (await early, late):
+        assert [event for event, _ in events] == ["sources", "token", "token", "costs", "done"]
+        assert events[-1][1]["answer"] == "Get morning sunlight"
+
+async def collect(job_queue, job_id):
+    return [event async for event in job_queue.events(job_id)]
+
+@pytest.mark.asyncio
+async def test_failed_jobs_report_the_error():
+    async def failing_runner(request, secrets):
+        yield "sources", []
+        raise RuntimeError("Anthropic is overloaded")
+
+    job_queue = JobQueue(LocalJobBackend(), workers=1)
+    job = await job_queue.submit({"user_input": "How do I sleep better?"})
+    job_queue.start(failing_runner)
+    try:
+        failed = await asyncio.wait_for(wait_for(job_queue, job["id"], "failed"), timeout=1)
+        events = await asyncio.wait_for(collect(job_queue, job["id"]), timeout=1)
+    finally:
+        await job_queue.stop()
+    assert failed["error"] == "Anthropic is overloaded"
+    assert events[-1] == ("error", {"detail": "Anthropic is overloaded"})
+
+@pytest.mark.asyncio
+async def test_workers_bound_the_jobs_run_at_once():
+    running = 0
+    most_running = 0
+
+    async def slow_runner(request, secrets):
+        nonlocal running, most_running
+        running += 1
+        most_running = max(most_running, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+        yield "token", "done"
+
+    job_queue = JobQueue(LocalJobBackend(), workers=2)
+    jobs = [await job_queue.submit({"user_input": str(i)}) for i in range(6)]
+    job_queue.start(slow_runner)
+    try:
+        for job in jobs:
+            await asyncio.wait_for(wait_for(job_queue, job["id"], "done"), timeout=1)
+    finally:
+        await job_queue.stop()
+    assert most_running == 2
+
+@pytest.mark.asyncio
+async def test_full_queues_turn_jobs_away():
+    job_queue = JobQueue(LocalJobBackend(max_size=1), workers=1)
+    await job_queue.submit({"user_input": "first"})
+    with pytest.raises(JobQueueFull):
+        await job_queue.submit({"user_input": "second"})
+    assert await job_queue.get("missing") is None
+
+@pytest.mark.asyncio
+async def test_stopped_jobs_fail_and_end_their_events():
+    started = asyncio.Event()
+
+    async def hanging_runner(request, secrets):
+        yield "sources", []
+        started.set()
+        await asyncio.Event().wait()
+
+    job_queue = JobQueue(LocalJobBackend(), workers=1)
+    job = await job_queue.submit({"user_input": "How do I sleep better?"})
+    job_queue.start(hanging_runner)
+    await asyncio.wait_for(started.wait(), timeout=1)
+    await job_queue.stop()
+
+    stopped = await job_queue.get(job["id"])
+    events = await asyncio.wait_for(collect(job_queue, job["id"]), timeout=1)
+    assert stopped["status"] == "failed"
+    assert events[-1] == ("error", {"detail": "The job was stopped before it finished"})
+
+@pytest.mark.asyncio
+async def test_finished_redis_jobs_leave_the_processing_list():
+    fake_redis = FakeRedis()
+    job_queue = JobQueue(RedisJobBackend(fake_redis, poll_seconds=0.01), workers=1)
+    job = await job_queue.submit({"user_input": "How do I sleep better?"}, {"openai_api_key": "sk-test"})
+    job_queue.start(answer_runner)
+    try:
+        finished = await asyncio.wait_for(wait_for(job_queue, job["id"], "done"), timeout=1)
+        while fake_redis.lists["jobs:processing"]:
+            await asyncio.sleep(0.005)
+    finally:
+        await job_queue.stop()
+    assert finished["result"]["answer"] == "Get morning sunlight"
+    assert "jobs:lease:" + job["id"] not in fake_redis.values
+
+@pytest.mark.asyncio
+async def test_jobs_taken_by_a_crashed_worker_are_requeued():
+    fake_redis = FakeRedis()
+    crashed = RedisJobBackend(fake_redis, poll_seconds=0.01)
+    await crashed.enqueue("abandoned", {"request": {"user_input": "How do I sleep better?"}, "secrets": {}})
+    await crashed.enqueue("running", {"request": {"user_input": "What about caffeine?"}, "secrets": {}})
+    assert (await crashed.dequeue())[0] == "abandoned"
+    assert (await crashed.dequeue())[0] == "running"
+    # The crashed worker's lease on its job runs out, while another worker still holds the job it's running
+    del fake_redis.values["jobs:lease:abandoned"]
+
+    worker = RedisJobBackend(fake_redis, lease_seconds=0.01, poll_seconds=0.01)
+    job_id, payload = await asyncio.wait_for(worker.dequeue(), timeout=1)
+    assert job_id == "abandoned"
+    assert payload["request"] == {"user_input": "How do I sleep better?"}
+    assert [json.loads(entry)["id"] for entry in fake_redis.lists["jobs:processing"]] == ["abandoned", "running"]
+    assert fake_redis.lists["jobs:queue"] == []
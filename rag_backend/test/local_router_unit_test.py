@@ -0,0 +1,57 @@
+import base64
+import json
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from rag_backend.local_router import LocalRouter, evaluate_router, load_decisions, train_router
+from rag_backend.query_translator import QueryTranslator
+
+def separable_data(n=200, dimensions=16, seed=0):
+    rng = np.random.default_rng(seed)
+    vectors = rng.normal(size=(n, dimensions)).astype(np.float32)
+    labels = (vectors[:, 0] > 0).astype(np.float32)
+    return vectors, labels
+
+def test_trained_router_agrees_with_labels():
+    vectors, labels = separable_data()
+    router = train_router(vectors, labels, epochs=300)
+    evaluation = evaluate_router(router, vectors, labels)
+    assert evaluation["agreement"] > 0.95
+    assert evaluation["confident_agreement"] >= evaluation["agreement"], "Confident decisions should be the most accurate"
+
+def test_unsure_decisions_fall_back():
+    router = LocalRouter(weights=[1.0, 0.0], bias=0.0, confidence=0.9)
+    assert router.decide([5.0, 0.0])[0] is True
+    assert router.decide([-5.0, 0.0])[0] is False
+    assert router.decide([0.1, 0.0])[0] is None
+    assert router.stats()["local_decisions"] == 2 and router.stats()["fallbacks"] == 1
+
+def test_save_and_load_round_trip(tmp_path):
+    router = LocalRouter(weights=[0.5, -0.25], bias=0.1, confidence=0.8, metadata={"trained_on": 2})
+    path = str(tmp_path / "router.npz")
+    router.save(path)
+    loaded = LocalRouter.load(path)
+    assert np.allclose(loaded.weights, router.weights) and loaded.bias == pytest.approx(0.1)
+    assert loaded.confidence == pytest.approx(0.8) and loaded.metadata == {"trained_on": 2}
+
+def test_load_decisions_keeps_latest_per_question(tmp_path):
+    path = tmp_path / "decisions.jsonl"
+    def record(question, vector, decision):
+        embedding = base64.b64encode(np.asarray(vector, dtype=np.float32).tobytes()).decode("ascii")
+        return json.dumps({"question": question, "use_multi_query": decision, "embedding": embedding})
+    path.write_text("\n".join([record("a", [1, 2], False), record("b", [3, 4], True), record("a", [1, 2], True)]) + "\n")
+    vectors, labels = load_decisions(str(path))
+    assert vectors.tolist() == [[1.0, 2.0], [3.0, 4.0]]
+    assert labels.tolist() == [1.0, 1.0]
+
+@pytest.mark.asyncio
+async def test_confident_local_decision_skips_the_llm():
+    translator = QueryTranslator(openai_api_key="sk-fake")
+    translator.local_router = LocalRouter(weights=[1.0], bias=0.0)
+    async def llm_router(query, costs=None, trace=None):
+        raise AssertionError("The LLM router shouldn't be called")
+    translator._allm_should_use_multi_query = llm_router
+    assert await translator.ashould_use_multi_query("q", query_vector=[10.0]) is True
@@ -0,0 +1,53 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from rag_backend.local_vector_index import LocalVectorIndex, write_snapshot
+
+def split_row(video_id, split_index, vector):
+    metadata = {"chunk_index": 0, "split_index": split_index, "video_id": video_id, "video_title": "Huberman Lab", "video_url": f"https://www.youtube.com/watch?v={video_id}", "text": f"Content {split_index}"}
+    return f"{video_id}_chunk0_split{split_index}", vector, metadata
+
+@pytest.fixture
+def index_root(tmp_path):
+    rows = [split_row("123", i, vector) for i, vector in enumerate(np.eye(4, dtype=np.float32))]
+    write_snapshot(str(tmp_path), rows, len(rows), 4, dtype="float16", name="first")
+    return str(tmp_path)
+
+def test_top_k_matches_exact_cosine_ranking(index_root):
+    index = LocalVectorIndex(index_root)
+    results = index.similarity_search_by_vector_with_score([0.1, 0.9, 0.3, 0.0], k=2)
+    assert [doc.page_content for doc, _ in results] == ["Content 1", "Content 2"]
+    assert results[0][1] == pytest.approx(0.9 / np.linalg.norm([0.1, 0.9, 0.3]), rel=1e-3), "Scores should be cosine similarities"
+    doc = results[0][0]
+    assert doc.id == "123_chunk0_split1"
+    assert "text" not in doc.metadata and doc.metadata["video_id"] == "123", "Documents should look like PineconeVectorStore results"
+
+def test_new_snapshot_is_swapped_in(index_root):
+    index = LocalVectorIndex(index_root, reload_interval=0)
+    assert index.generation == "first"
+    write_snapshot(index_root, [split_row("456", 0, [1, 0, 0, 0])], 1, 4, dtype="float32", name="second")
+    results = index.similarity_search_by_vector_with_score([1, 0, 0, 0], k=5)
+    assert index.generation == "second"
+    assert [doc.metadata["video_id"] for doc, _ in results] == ["456"]
+
+def test_keyword_search_returns_documents_from_the_snapshot(index_root):
+    index = LocalVectorIndex(index_root)
+    results = index.keyword_search("content 2", k=1)
+    assert [doc.id for doc, _ in results] == ["123_chunk0_split2"]
+    assert results[0][0].page_content == "Content 2"
+
+def test_search_with_vectors_returns_the_stored_vectors(index_root):
+    index = LocalVectorIndex(index_root)
+    results = index.similarity_search_by_vector_with_vectors([0.1, 0.9, 0.3, 0.0], k=2)
+    assert [doc.id for doc, _, _ in results] == ["123_chunk0_split1", "123_chunk0_split2"]
+    assert results[0][2].dtype == np.float32
+    assert results[0][2] == pytest.approx([0, 1, 0, 0])
+
+def test_fetch_documents_by_vector_id(index_root):
+    index = LocalVectorIndex(index_root)
+    documents = index.fetch_documents(["123_chunk0_split3", "123_chunk0_split9"])
+    assert list(documents) == ["123_chunk0_split3"], "Ids which aren't in the snapshot should be left out"
+    assert documents["123_chunk0_split3"].page_content == "Content 3"
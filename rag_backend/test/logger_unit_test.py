@@ -0,0 +1,54 @@
+import json
+import logging
+import os
+import queue
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from rag_backend.logger import DroppingQueueHandler, JsonFormatter, TextFormatter, log_file_path, payload_sizes, truncate_payload
+
+def make_record(message, *args, **extra):
+    record = logging.LogRecord("root", logging.INFO, __file__, 1, message, args, None)
+    record.__dict__.update(extra)
+    return record
+
+def test_json_records_include_extra_fields():
+    entry = json.loads(JsonFormatter().format(make_record("Answered %s", "question", seconds=1.5)))
+    assert entry["message"] == "Answered question"
+    assert entry["level"] == "INFO"
+    assert entry["seconds"] == 1.5
+
+def test_text_records_keep_the_original_format():
+    line = TextFormatter().format(make_record("Answered", seconds=1.5))
+    assert line.endswith(' - INFO - Answered {"seconds": 1.5}')
+
+def test_payloads_are_truncated():
+    payload = truncate_payload({"history": "x" * 50, "sources": list(range(25)), "few_shot": True}, max_chars=10)
+    assert payload["history"] == "xxxxxxxxxx... (40 more chars)"
+    assert payload["sources"][-1] == "... (5 more items)"
+    assert len(payload["sources"]) == 21
+    assert payload["few_shot"] is True
+    assert payload_sizes({"history": "x" * 50, "few_shot": True}) == {"history": 50, "few_shot": True}
+
+def test_queue_handler_drops_records_instead_of_blocking():
+    handler = DroppingQueueHandler(queue.Queue(maxsize=1))
+    handler.handle(make_record("first"))
+    handler.handle(make_record("second"))
+    assert handler.dropped == 1
+
+def test_queue_handler_builds_the_message_and_keeps_the_traceback_out_of_it():
+    handler = DroppingQueueHandler(queue.Queue())
+    try:
+        raise ValueError("boom")
+    except ValueError:
+        record = logging.LogRecord("root", logging.ERROR, __file__, 1, "Failed for %s", ("question",), sys.exc_info())
+    handler.handle(record)
+    queued = handler.queue.get_nowait()
+    assert queued.msg == "Failed for question"
+    assert queued.args is None
+    assert "ValueError: boom" in queued.exc_text
+    assert queued.exc_info is None
+
+def test_each_process_gets_its_own_log_file():
+    assert log_file_path("app-{pid}.log") == os.path.join(os.getcwd(), f"app-{os.getpid()}.log")
+    assert log_file_path("/var/log/app.log") == "/var/log/app.log"
@@ -0,0 +1,83 @@
+import os
+import sys
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from prometheus_client import REGISTRY
+from rag_backend import metrics
+from rag_backend.metrics import record_trace, render_metrics
+from rag_backend.tracing import RequestTrace
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0.0
+
+def answered_trace():
+    trace = RequestTrace()
+    trace.set(model="claude-3-5-sonnet-20240620", streaming=False, cached=False, generation_cost=0.01, retrieval_cost=0.0, translation_cost=0.001)
+    with trace.span("routing", model="gpt-4o-mini") as span:
+        span.set(input_tokens=100, output_tokens=1, use_multi_query=True)
+    with trace.span("embedding") as span:
+        span.set(texts=5, memory_hits=2, shared_hits=1, misses=2)
+    with trace.span("answer_cache") as span:
+        span.set(hit=False)
+    with trace.span("generation", model="claude-3-5-sonnet-20240620") as span:
+        span.set(input_tokens=2000, output_tokens=300, cache_read_tokens=1500, cache_write_tokens=0)
+    trace.finish()
+    return trace
+
+def test_answered_requests_record_latency_tokens_routing_and_caches():
+    before = {
+        "requests": sample("rag_request_duration_seconds_count", streaming="false", outcome="ok"),
+        "generation": sample("rag_stage_duration_seconds_count", stage="generation"),
+        "input": sample("rag_tokens_total", model="claude-3-5-sonnet-20240620", kind="input"),
+        "cache_read": sample("rag_tokens_total", model="claude-3-5-sonnet-20240620", kind="cache_read"),
+        "routing": sample("rag_routing_decisions_total", router="llm", multi_query="true"),
+        "embedding_hits": sample("rag_cache_requests_total", cache="embedding", result="hit"),
+        "answer_misses": sample("rag_cache_requests_total", cache="answer", result="miss"),
+        "cost": sample("rag_cost_dollars_total", kind="generation"),
+    }
+    record_trace(answered_trace())
+    assert sample("rag_request_duration_seconds_count", streaming="false", outcome="ok") == before["requests"] + 1
+    assert sample("rag_stage_duration_seconds_count", stage="generation") == before["generation"] + 1
+    assert sample("rag_tokens_total", model="claude-3-5-sonnet-20240620", kind="input") == before["input"] + 2000
+    assert sample("rag_tokens_total", model="claude-3-5-sonnet-20240620", kind="cache_read") == before["cache_read"] + 1500
+    assert sample("rag_routing_decisions_total", router="llm", multi_query="true") == before["routing"] + 1
+    assert sample("rag_cache_requests_total", cache="embedding", result="hit") == before["embedding_hits"] + 3
+    assert sample("rag_cache_requests_total", cache="answer", result="miss") == before["answer_misses"] + 1
+    assert sample("rag_cost_dollars_total", kind="generation") == pytest.approx(before["cost"] + 0.01)
+
+def test_errors_and_timeouts_are_counted_by_stage():
+    trace = RequestTrace()
+    trace.set(streaming=True, degraded="direct_after_timeout")
+    trace.span("vector_search").__enter__().set(error="CancelledError")
+    trace.span("generation", model="claude-3-5-sonnet-20240620").__enter__().set(error="TimeoutError")
+    trace.span("embedding").__enter__().set(error="APIConnectionError")
+    trace.set(error="timed out", error_type="TimeoutError")
+    trace.finish()
+
+    before = {
+        "retrieval": sample("rag_upstream_timeouts_total", stage="retrieval"),
+        "generation": sample("rag_upstream_timeouts_total", stage="generation"),
+        "embedding": sample("rag_upstream_errors_total", stage="embedding", error="APIConnectionError"),
+        "cancelled": sample("rag_upstream_errors_total", stage="vector_search", error="CancelledError"),
+        "failed": sample("rag_request_duration_seconds_count", streaming="true", outcome="error"),
+    }
+    record_trace(trace)
+    assert sample("rag_upstream_timeouts_total", stage="retrieval") == before["retrieval"] + 1
+    assert sample("rag_upstream_timeouts_total", stage="generation") == before["generation"] + 1
+    assert sample("rag_upstream_errors_total", stage="embedding", error="APIConnectionError") == before["embedding"] + 1
+    assert sample("rag_upstream_errors_total", stage="vector_search", error="CancelledError") == before["cancelled"]
+    assert sample("rag_request_duration_seconds_count", streaming="true", outcome="error") == before["failed"] + 1
+
+def test_metrics_are_rendered_in_the_prometheus_text_format():
+    record_trace(answered_trace())
+    content, content_type = render_metrics()
+    assert content_type.startswith("text/plain")
+    assert b"rag_request_duration_seconds_bucket" in content
+
+def test_disabled_metrics_record_and_render_nothing(monkeypatch):
+    monkeypatch.setattr(metrics, "METRICS_ENABLED", False)
+    monkeypatch.setattr(metrics, "_metrics", None)
+    record_trace(answered_trace())
+    assert metrics._metrics is None
+    assert render_metrics()[0] == b""
@@ -0,0 +1,50 @@
+import os
+import sys
+import pytest
+from langchain_core.documents import Document
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from rag_backend.context_builder import build_context
+from rag_backend.neighbour_expansion import NeighbourExpander, SplitCache, parse_vector_id
+
+def split(video_id, chunk_index, split_index):
+    return Document(page_content=f"{video_id} {chunk_index}.{split_index}", metadata={"video_id": video_id, "chunk_index": float(chunk_index), "split_index": float(split_index)})
+
+class WordTokenizer:
+    def encode(self, text):
+        return text.split()
+
+class FakeStore:
+    def __init__(self, splits):
+        self.splits = {f"{doc.metadata['video_id']}_chunk{int(doc.metadata['chunk_index'])}_split{int(doc.metadata['split_index'])}": doc for doc in splits}
+        self.fetches = []
+
+    def fetch_documents(self, vector_ids):
+        self.fetches.append(list(vector_ids))
+        return {vector_id: self.splits[vector_id] for vector_id in vector_ids if vector_id in self.splits}
+
+def test_parse_vector_id():
+    assert parse_vector_id("ab_c_chunk2_split10") == ("ab_c", 2, 10), "Video ids may contain underscores"
+    assert parse_vector_id("not a split") is None
+
+@pytest.mark.asyncio
+async def test_hits_are_merged_with_their_neighbours_in_one_fetch():
+    store = FakeStore([split("abc", 0, i) for i in range(5)])
+    expander = NeighbourExpander(store, window=1, top_n=2)
+    # Splits 1 and 3 are both hits, their windows touch so they become one passage at the rank of split 3
+    documents = [split("abc", 0, 3), split("xyz", 0, 7), split("abc", 0, 1)]
+    expanded = await expander.aexpand(documents)
+    assert len(store.fetches) == 1, "Neighbours should be fetched in one batch"
+    assert [doc.page_content for doc in expanded] == ["abc 0.2 abc 0.3 abc 0.4", "xyz 0.7", "abc 0.1"]
+    assert expanded[0].metadata["split_index"] == 2 and expanded[0].metadata["last_split_index"] == 4
+    assert '<split chunk="0" index="2" to="4">' in build_context(expanded, WordTokenizer())
+
+@pytest.mark.asyncio
+async def test_adjacent_hits_form_one_passage_and_missing_splits_are_cached():
+    store = FakeStore([split("abc", 0, i) for i in range(3)])
+    expander = NeighbourExpander(store, window=1, top_n=2, cache=SplitCache(max_size=10))
+    documents = [split("abc", 0, 2), split("abc", 0, 1)]
+    expanded = await expander.aexpand(documents)
+    assert [doc.page_content for doc in expanded] == ["abc 0.0 abc 0.1 abc 0.2"], "The second hit is absorbed into the first's passage"
+    await expander.aexpand(documents)
+    assert len(store.fetches) == 1, "Fetched splits and ids past the end of the chunk should come from the cache"
@@ -0,0 +1,40 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from rag_backend import profiles
+from rag_backend.local_router import LocalRouter
+from rag_backend.profiles import PROFILE_BALANCED, PROFILE_FAST, PROFILE_THOROUGH, aresolve_profile, choose_profile
+
+def test_short_factual_questions_are_fast():
+    assert choose_profile("What is the ideal bedroom temperature for sleep?").name == PROFILE_FAST
+    assert choose_profile("How much caffeine is too much?").name == PROFILE_FAST
+
+def test_complex_or_long_questions_stay_balanced():
+    assert choose_profile("Why does morning sunlight improve sleep?").name == PROFILE_BALANCED
+    assert choose_profile("What is the difference between NSDR and meditation?").name == PROFILE_BALANCED
+    assert choose_profile("What are all of the supplements mentioned for sleep and focus and how should each of them be dosed?").name == PROFILE_BALANCED
+    assert choose_profile("Tell me about dopamine").name == PROFILE_BALANCED, "Only factual openers go to the fast profile"
+
+def test_router_signal_overrides_the_text_features():
+    question = "What is the ideal bedroom temperature for sleep?"
+    assert choose_profile(question, multi_query_probability=0.9).name == PROFILE_BALANCED
+    assert choose_profile(question, multi_query_probability=0.1).name == PROFILE_FAST
+
+@pytest.mark.asyncio
+async def test_auto_embeds_only_when_the_local_router_is_loaded(monkeypatch):
+    embedded = []
+
+    async def aembed(question):
+        embedded.append(question)
+        return [1.0, 0.0]
+
+    monkeypatch.setattr(profiles, "get_local_router", lambda: None)
+    assert (await aresolve_profile("auto", "How much caffeine is too much?", aembed)).name == PROFILE_FAST
+    assert embedded == []
+    monkeypatch.setattr(profiles, "get_local_router", lambda: LocalRouter(np.array([10.0, 0.0]), 0.0))
+    assert (await aresolve_profile("auto", "How much caffeine is too much?", aembed)).name == PROFILE_BALANCED
+    assert (await aresolve_profile("thorough", "How much caffeine is too much?", aembed)).name == PROFILE_THOROUGH
+    assert len(embedded) == 1
@@ -0,0 +1,87 @@
+import asyncio
+import os
+import sys
+import time
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from rag_backend import profiling
+from rag_backend.profiling import MemoryTracker, StackSampler
+
+def _busy(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+async def _slow_call():
+    await asyncio.sleep(0.1)
+
+@pytest.mark.asyncio
+async def test_request_profiles_follow_child_tasks_through_awaits():
+    async def child():
+        await _slow_call()
+        _busy(0.05)
+
+    sampler = StackSampler(interval=0.002, task=asyncio.current_task()).start()
+    await asyncio.ensure_future(child())
+    sampler.stop()
+
+    assert sampler.samples > 0
+    assert any(stack.endswith("_slow_call (profiling_unit_test.py);sleep (tasks.py);<awaiting>") for stack in sampler.stacks)
+    assert any(stack.endswith("child (profiling_unit_test.py);_busy (profiling_unit_test.py)") for stack in sampler.stacks)
+    assert asyncio.get_running_loop().get_task_factory() is None, "The task factory should only be installed while profiling"
+
+@pytest.mark.asyncio
+async def test_request_profiles_leave_out_other_tasks():
+    async def other():
+        await asyncio.sleep(0.01)
+        _busy(0.05)
+
+    unrelated = asyncio.create_task(other())
+    sampler = StackSampler(interval=0.002, task=asyncio.current_task()).start()
+    await unrelated
+    sampler.stop()
+    assert not any("other (profiling_unit_test.py)" in stack for stack in sampler.stacks)
+
+@pytest.mark.asyncio
+async def test_process_profiles_sample_the_idle_event_loop():
+    sampler = StackSampler(interval=0.002).start()
+    await asyncio.sleep(0.05)
+    sampler.stop()
+    sampler.stop()
+
+    assert any(stack.endswith(";<idle>") for stack in sampler.stacks)
+    lines = sampler.collapsed().splitlines()
+    assert lines and all(line.rsplit(" ", 1)[1].isdigit() for line in lines)
+    profile = sampler.as_dict(top=1)
+    assert profile["samples"] == sampler.samples
+    assert len(profile["stacks"]) == 1
+
+def test_admin_token_is_needed(monkeypatch):
+    monkeypatch.setattr(profiling, "PROFILING_ENABLED", True)
+    monkeypatch.setattr(profiling, "ADMIN_TOKEN", "secret")
+    assert profiling.is_admin("secret")
+    assert not profiling.is_admin("wrong")
+    assert not profiling.is_admin(None)
+    monkeypatch.setattr(profiling, "ADMIN_TOKEN", "")
+    assert not profiling.is_admin("")
+    monkeypatch.setattr(profiling, "ADMIN_TOKEN", "secret")
+    monkeypatch.setattr(profiling, "PROFILING_ENABLED", False)
+    assert not profiling.is_admin("secret")
+
+class Leaked:
+    pass
+
+def test_memory_diff_shows_what_grew():
+    tracker = MemoryTracker()
+    tracker.start(frames=1)
+    try:
+        leaked = [Leaked() for _ in range(2000)]
+        diff = tracker.diff(limit=5)
+    finally:
+        tracker.stop()
+
+    assert diff["allocations"][0]["traceback"].startswith(os.path.abspath(__file__))
+    growth = {entry["type"]: entry["count_diff"] for entry in diff["object_growth"]}
+    assert growth.get(f"{__name__}.Leaked", 0) >= len(leaked)
+    assert not tracker.tracing
@@ -0,0 +1,31 @@
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from rag_backend.prompts import get_few_shot_prompt, get_main_prompt
+from rag_backend.example_prompts import example_with_bad_context
+
+def format_prompt(prompt, question):
+    return prompt.format_messages(question=question, documents="<video></video>", chat_history="")
+
+def test_prompts_are_built_once():
+    assert get_few_shot_prompt() is get_few_shot_prompt()
+    assert get_main_prompt() is get_main_prompt()
+
+def test_static_prefix_is_identical_between_requests():
+    for prompt in (get_few_shot_prompt(), get_main_prompt()):
+        first = format_prompt(prompt, "What is dopamine?")
+        second = format_prompt(prompt, "How do I sleep {better}?")
+        assert first[:-1] == second[:-1], "Only the final human turn should change"
+        assert "How do I sleep {better}?" in second[-1].content
+
+def test_examples_render_their_answers_and_end_with_a_cache_breakpoint():
+    messages = format_prompt(get_few_shot_prompt(), "q")
+    last_example = messages[-2]
+    assert last_example.content[0]["cache_control"] == {"type": "ephemeral"}
+    assert last_example.content[0]["text"] == f"<answer>{example_with_bad_context['answer']}</answer>"
+    assert not any("{answer}" in str(message.content) for message in messages)
+
+def test_main_prompt_has_no_cache_breakpoint():
+    system_message = format_prompt(get_main_prompt(), "q")[0]
+    assert isinstance(system_message.content, str), "The main system prompt is too short to be cached"
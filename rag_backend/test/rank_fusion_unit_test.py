@@ -0,0 +1,41 @@
+import os
+import sys
+import pytest
+from langchain_core.documents import Document
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from rag_backend.rank_fusion import comb_sum, document_key, reciprocal_rank_fusion, unique_union
+
+def split(split_index, content=None, **metadata):
+    return Document(page_content=content or f"Content {split_index}", metadata={"video_id": "abc", "chunk_index": 0.0, "split_index": float(split_index), **metadata})
+
+def test_document_key_prefers_the_vector_id():
+    assert document_key(Document(id="abc_chunk0_split1", page_content="x")) == "abc_chunk0_split1"
+    assert document_key(split(3)) == "abc_chunk0_split3", "Pinecone results should be keyed like the indexed vector ids"
+    assert document_key(Document(page_content="only text")) == "only text"
+
+def test_rrf_keeps_the_original_objects_with_scores_and_provenance():
+    first = split(1, extra="kept")
+    results = reciprocal_rank_fusion([[first, split(2)], [split(2), split(3)]], labels=["a", "b"])
+    assert [document_key(r.document) for r in results] == ["abc_chunk0_split2", "abc_chunk0_split1", "abc_chunk0_split3"]
+    assert results[1].document is first, "The retrieved object should be returned, metadata included"
+    assert results[0].score == pytest.approx(1 / 61 + 1 / 60)
+    assert results[0].provenance == {"a": 1, "b": 0}
+
+def test_weights_change_the_ranking():
+    lists = [[split(1)], [split(2)]]
+    assert document_key(reciprocal_rank_fusion(lists)[0].document) == "abc_chunk0_split1", "Ties keep first-seen order"
+    assert document_key(reciprocal_rank_fusion(lists, weights=[1.0, 2.0])[0].document) == "abc_chunk0_split2"
+
+def test_comb_sum_normalises_each_list():
+    dense = [(split(1), 0.9), (split(2), 0.85), (split(4), 0.8)]
+    keyword = [(split(2), 40.0), (split(3), 10.0)]
+    results = comb_sum([dense, keyword])
+    assert document_key(results[0].document) == "abc_chunk0_split2"
+    assert results[0].score == pytest.approx(1.5)
+    assert {document_key(r.document): r.score for r in results}["abc_chunk0_split3"] == pytest.approx(0.0)
+
+def test_unique_union_keeps_first_occurrences_in_order():
+    first = split(2)
+    assert unique_union([[first, split(1)], [split(2), split(3)]])[0] is first
+    assert len(unique_union([[split(1)], [split(1)]])) == 1
@@ -0,0 +1,39 @@
+import os
+import sys
+import pytest
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from rag_backend.retriever import SharedIndexRetriever
+
+class BatchCountingEmbeddings(Embeddings):
+    def __init__(self):
+        self.batches = []
+
+    def embed_documents(self, texts):
+        self.batches.append(texts)
+        return [[float(len(text))] for text in texts]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+    async def aembed_documents(self, texts):
+        return self.embed_documents(texts)
+
+class FakeVectorStore:
+    def similarity_search_by_vector_with_score(self, embedding, k):
+        return [(Document(page_content=f"{embedding[0]}-{i}"), 1.0) for i in range(k)]
+
+@pytest.mark.asyncio
+async def test_multi_search_embeds_all_queries_in_one_call():
+    embeddings = BatchCountingEmbeddings()
+    retriever = SharedIndexRetriever(vector_store=FakeVectorStore(), embedding_model=embeddings, k=2)
+    results = await retriever.amulti_search(["a", "bb", "a"])
+    assert embeddings.batches == [["a", "bb"]], "Unique queries should be embedded in a single batch"
+    assert [[d.page_content for d in docs] for docs in results] == [["1.0-0", "1.0-1"], ["2.0-0", "2.0-1"], ["1.0-0", "1.0-1"]]
+
+@pytest.mark.asyncio
+async def test_single_query_matches_search_by_vector():
+    retriever = SharedIndexRetriever(vector_store=FakeVectorStore(), embedding_model=BatchCountingEmbeddings(), k=1)
+    assert await retriever.ainvoke("abc") == await retriever.asearch_by_vector([3.0])
@@ -0,0 +1,170 @@
+import asyncio
+import os
+import sys
+import pytest
+from langchain_core.documents import Document
+from langchain_core.messages import AIMessage
+from langchain_core.runnables import RunnableLambda
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from rag_backend.query_translator import QueryTranslator
+from rag_backend.rag_engine import RAGEngine
+from rag_backend.request_costs import RequestCosts
+
+def split(split_index):
+    return Document(page_content=f"Content {split_index}", metadata={"video_id": "abc", "chunk_index": 0.0, "split_index": float(split_index)})
+
+DIRECT_DOCS = [split(1), split(2)]
+MULTI_QUERY_DOCS = [[split(3), split(1)], [split(3), split(4)]]
+
+class FakeTranslator:
+    """
+    Stands in for QueryTranslator, recording which calls were made and which were cancelled
+    """
+    def __init__(self, use_multi_query=True, router_delay=0.0, generation_delay=0.0, router_error=None, generation_error=None, plan=None):
+        self.use_multi_query = use_multi_query
+        self.router_delay = router_delay
+        self.generation_delay = generation_delay
+        self.router_error = router_error
+        self.generation_error = generation_error
+        self.plan = plan
+        self.uses_query_vector = False
+        self.calls = []
+        self.cancelled = []
+
+    async def _call(self, name, delay, error, result):
+        self.calls.append(name)
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            self.cancelled.append(name)
+            raise
+        if error is not None:
+            raise error
+        return result
+
+    async def ashould_use_multi_query(self, query, costs=None, trace=None, query_vector=None):
+        return await self._call("route", self.router_delay, self.router_error, self.use_multi_query)
+
+    async def agenerate_queries(self, query, costs=None, trace=None):
+        return await self._call("generate", self.generation_delay, self.generation_error, ["first variant", "second variant"])
+
+    async def aroute_and_generate(self, query, costs=None, trace=None):
+        return await self._call("route_and_generate", 0, None, self.plan)
+
+class FakeRetriever:
+    def __init__(self, direct_delay=0.0):
+        self.direct_delay = direct_delay
+        self.keyword_index = None
+        self.k = 4
+        self.calls = []
+        self.cancelled = []
+
+    async def asearch(self, query, trace=None, vectors=None):
+        self.calls.append("direct")
+        try:
+            await asyncio.sleep(self.direct_delay)
+        except asyncio.CancelledError:
+            self.cancelled.append("direct")
+            raise
+        return list(DIRECT_DOCS)
+
+    async def amulti_search(self, queries, trace=None, vectors=None):
+        self.calls.append("multi_query")
+        return [list(docs) for docs in MULTI_QUERY_DOCS[:len(queries)]]
+
+def engine(translator, retriever=None):
+    rag_engine = RAGEngine.__new__(RAGEngine)
+    rag_engine.query_translator = translator
+    rag_engine.retriever = retriever or FakeRetriever()
+    rag_engine.diverse_selection = False
+    rag_engine.neighbour_expander = None
+    return rag_engine
+
+def keys(documents):
+    return [int(doc.metadata["split_index"]) for doc in documents]
+
+@pytest.mark.asyncio
+async def test_speculative_routing_takes_multi_query_and_cancels_direct_retrieval():
+    translator = FakeTranslator(use_multi_query=True, router_delay=0.01)
+    retriever = FakeRetriever(direct_delay=1)
+    documents = await engine(translator, retriever).retrieve_relevant_documents("How do I sleep better?", routing="speculative")
+    assert keys(documents) == [3, 1, 4]
+    assert retriever.cancelled == ["direct"], "Direct retrieval should be cancelled once the router picks multi-query"
+    assert translator.cancelled == []
+
+@pytest.mark.asyncio
+async def test_speculative_routing_takes_direct_retrieval_and_cancels_query_generation():
+    translator = FakeTranslator(use_multi_query=False, router_delay=0.01, generation_delay=1)
+    retriever = FakeRetriever()
+    documents = await engine(translator, retriever).retrieve_relevant_documents("How do I sleep better?", routing="speculative")
+    assert keys(documents) == [1, 2]
+    assert translator.cancelled == ["generate"], "Query generation should be cancelled once the router picks direct retrieval"
+    assert "multi_query" not in retriever.calls
+
+@pytest.mark.asyncio
+async def test_speculative_routing_surfaces_a_failing_branch_and_cancels_the_rest():
+    translator = FakeTranslator(use_multi_query=True, router_delay=0.01, generation_error=RuntimeError("OpenAI is down"))
+    retriever = FakeRetriever(direct_delay=1)
+    with pytest.raises(RuntimeError, match="OpenAI is down"):
+        await engine(translator, retriever).retrieve_relevant_documents("How do I sleep better?", routing="speculative")
+    assert retriever.cancelled == ["direct"]
+
+    translator = FakeTranslator(router_error=RuntimeError("Router failed"), generation_delay=1)
+    retriever = FakeRetriever(direct_delay=1)
+    with pytest.raises(RuntimeError, match="Router failed"):
+        await engine(translator, retriever).retrieve_relevant_documents("How do I sleep better?", routing="speculative")
+    assert translator.cancelled == ["generate"] and retriever.cancelled == ["direct"]
+
+@pytest.mark.asyncio
+async def test_merged_routing_follows_the_plan():
+    translator = FakeTranslator(plan=["first variant", "second variant"])
+    documents = await engine(translator).retrieve_relevant_documents("How do I sleep better?", routing="merged")
+    assert keys(documents) == [3, 1, 4]
+    assert translator.calls == ["route_and_generate"]
+
+    translator = FakeTranslator(plan=[])
+    documents = await engine(translator).retrieve_relevant_documents("How do I sleep better?", routing="merged")
+    assert keys(documents) == [1, 2]
+
+@pytest.mark.asyncio
+async def test_direct_and_always_routing_skip_the_router():
+    translator = FakeTranslator()
+    documents = await engine(translator).retrieve_relevant_documents("How do I sleep better?", routing="direct")
+    assert keys(documents) == [1, 2]
+    assert translator.calls == []
+
+    translator = FakeTranslator(use_multi_query=False)
+    documents = await engine(translator).retrieve_relevant_documents("How do I sleep better?", routing="always")
+    assert keys(documents) == [3, 1, 4]
+    assert translator.calls == ["generate"]
+
+@pytest.mark.asyncio
+async def test_unknown_routing_modes_are_rejected():
+    with pytest.raises(ValueError):
+        await engine(FakeTranslator()).retrieve_relevant_documents("How do I sleep better?", routing="sometimes")
+
+@pytest.mark.asyncio
+async def test_query_generation_costs_are_recorded():
+    translator = QueryTranslator("sk-fake")
+    translator.llm = RunnableLambda(lambda _: AIMessage(content="first variant\nsecond variant", usage_metadata={"input_tokens": 1000, "output_tokens": 100, "total_tokens": 1100}))
+    costs = RequestCosts()
+    assert await translator.agenerate_queries("How do I sleep better?", costs=costs) == ["first variant", "second variant"]
+    assert costs.translation_cost == pytest.approx(translator.calculate_token_cost(1000, 100))
+
+@pytest.mark.asyncio
+async def test_cancelled_query_generation_still_records_the_prompt_cost():
+    async def never_answers(_):
+        await asyncio.Event().wait()
+
+    translator = QueryTranslator("sk-fake")
+    translator.llm = RunnableLambda(never_answers)
+    # Counted by words rather than with the tokenizer, which is downloaded on first use
+    translator.count_tokens = lambda query, response: (len(query.split()), len(response.split()))
+    costs = RequestCosts()
+    generation = asyncio.create_task(translator.agenerate_queries("How do I sleep better?", costs=costs))
+    await asyncio.sleep(0.01)
+    generation.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await generation
+    assert costs.translation_cost > translator.calculate_token_cost(5, 0), "A cancelled speculative generation is still billed for its whole prompt"
@@ -0,0 +1,58 @@
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from rag_backend.semantic_cache import SemanticAnswerCache
+
+NAMESPACE = ("claude", True, True)
+
+def unit(*values):
+    vector = np.array(values, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+def test_similar_question_hits_and_dissimilar_misses():
+    cache = SemanticAnswerCache(dimensions=3, threshold=0.95)
+    cache.store(unit(1, 0, 0), NAMESPACE, "how to improve sleep", {"answer": "sleep"}, latency=12.0)
+    assert cache.lookup(unit(1, 0.1, 0), NAMESPACE) == {"answer": "sleep"}, "Near-identical question should hit"
+    assert cache.lookup(unit(0, 1, 0), NAMESPACE) is None, "Unrelated question should miss"
+    stats = cache.stats()
+    assert stats["hits"] == 1 and stats["misses"] == 1 and stats["hit_rate"] == 0.5
+    assert stats["saved_latency_seconds"] == 12.0
+
+def test_answers_are_not_shared_across_namespaces():
+    cache = SemanticAnswerCache(dimensions=3)
+    cache.store(unit(1, 0, 0), NAMESPACE, "q", {"answer": "a"})
+    assert cache.lookup(unit(1, 0, 0), ("claude", False, True)) is None
+
+def test_least_recently_used_entry_is_evicted():
+    cache = SemanticAnswerCache(dimensions=3, max_entries=2)
+    cache.store(unit(1, 0, 0), NAMESPACE, "a", {"answer": "a"})
+    cache.store(unit(0, 1, 0), NAMESPACE, "b", {"answer": "b"})
+    cache.lookup(unit(1, 0, 0), NAMESPACE)
+    cache.store(unit(0, 0, 1), NAMESPACE, "c", {"answer": "c"})
+    assert cache.lookup(unit(0, 1, 0), NAMESPACE) is None, "Least recently used entry should have been evicted"
+    assert cache.lookup(unit(1, 0, 0), NAMESPACE) == {"answer": "a"}
+
+def test_expired_entries_miss():
+    cache = SemanticAnswerCache(dimensions=3, ttl_seconds=0.01)
+    cache.store(unit(1, 0, 0), NAMESPACE, "q", {"answer": "a"})
+    time.sleep(0.02)
+    assert cache.lookup(unit(1, 0, 0), NAMESPACE) is None
+    assert cache.stats()["entries"] == 0
+
+def test_expired_best_match_does_not_hide_a_live_one():
+    cache = SemanticAnswerCache(dimensions=3, threshold=0.9, ttl_seconds=0.01)
+    cache.store(unit(1, 0, 0), NAMESPACE, "expired", {"answer": "old"})
+    cache.ttl_seconds = 60
+    cache.store(unit(1, 0.2, 0), NAMESPACE, "live", {"answer": "new"})
+    time.sleep(0.02)
+    assert cache.lookup(unit(1, 0, 0), NAMESPACE) == {"answer": "new"}
+    assert cache.stats()["entries"] == 1
+
+def test_new_index_generation_invalidates_entries():
+    cache = SemanticAnswerCache(dimensions=3)
+    cache.store(unit(1, 0, 0), NAMESPACE, "q", {"answer": "a"}, generation="100")
+    assert cache.lookup(unit(1, 0, 0), NAMESPACE, generation="100") == {"answer": "a"}
+    assert cache.lookup(unit(1, 0, 0), NAMESPACE, generation="150") is None, "Entries from an older index generation should be dropped"
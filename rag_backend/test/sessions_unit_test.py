@@ -0,0 +1,179 @@
+import asyncio
+import os
+import sys
+import pytest
+from redis.exceptions import WatchError
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from rag_backend.sessions import ConversationSessions, MemorySessionStore, RedisSessionStore, history_text, new_session
+
+class WordTokenizer:
+    def encode(self, text):
+        return text.split()
+
+class FakeTranslator:
+    def __init__(self):
+        self.calls = []
+
+    async def asummarise_history(self, summary, messages, max_words, costs=None):
+        self.calls.append((summary, messages))
+        return f"summary of {len(self.calls)} batches"
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.watched = None
+        self.commands = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.reset()
+
+    async def watch(self, key):
+        self.watched = (key, self.redis.versions.get(key, 0))
+
+    async def get(self, key):
+        # Yields, so concurrent updates interleave between the read and the write
+        await asyncio.sleep(0)
+        return self.redis.values.get(key)
+
+    def multi(self):
+        pass
+
+    def set(self, key, value, ex=None):
+        self.commands.append((key, value))
+
+    async def execute(self):
+        key, version = self.watched
+        if self.redis.versions.get(key, 0) != version:
+            self.commands = []
+            raise WatchError("Watched variable changed")
+        for key, value in self.commands:
+            self.redis.values[key] = value
+            self.redis.versions[key] = self.redis.versions.get(key, 0) + 1
+        self.commands = []
+
+    async def reset(self):
+        self.watched = None
+        self.commands = []
+
+class FakeRedis:
+    """
+    The WATCH/MULTI transactions RedisSessionStore.aupdate uses, a watched key's version changes on every write
+    """
+    def __init__(self):
+        self.values = {}
+        self.versions = {}
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    async def get(self, key):
+        return self.values.get(key)
+
+def make_sessions(**kwargs):
+    options = {"token_threshold": 30, "recent_turns": 1, "max_turns": 20}
+    options.update(kwargs)
+    return ConversationSessions(MemorySessionStore(), tokenizer=WordTokenizer(), **options)
+
+async def wait_for_condensing(sessions):
+    while sessions._tasks:
+        await asyncio.gather(*list(sessions._tasks))
+
+def test_history_text_puts_the_summary_before_the_recent_turns():
+    session = new_session()
+    assert history_text(session) == ""
+    session["summary"] = "Discussed sleep"
+    session["turns"].append({"n": 3, "user": "What about caffeine?", "assistant": "Delay it"})
+    assert history_text(session) == "Summary of the earlier conversation: Discussed sleep\n\nUser: What about caffeine?\nAssistant: Delay it"
+
+@pytest.mark.asyncio
+async def test_turns_are_kept_verbatim_below_the_threshold():
+    sessions = make_sessions()
+    translator = FakeTranslator()
+    await sessions.arecord_turn("c1", "How do I sleep better?", "<thinking>plan</thinking>Get morning sunlight", translator)
+    await wait_for_condensing(sessions)
+    assert await sessions.ahistory("c1") == "User: How do I sleep better?\nAssistant: Get morning sunlight"
+    assert await sessions.ahistory("other") == ""
+    assert translator.calls == []
+
+@pytest.mark.asyncio
+async def test_older_turns_are_folded_into_the_summary_past_the_threshold():
+    sessions = make_sessions()
+    translator = FakeTranslator()
+    for i in range(3):
+        await sessions.arecord_turn("c1", f"question {i}", "a long answer " * 5, translator)
+        await wait_for_condensing(sessions)
+
+    session = await sessions.store.aget("c1")
+    assert session["summary"] == "summary of 2 batches"
+    assert [turn["n"] for turn in session["turns"]] == [3], "Only the most recent turn should stay verbatim"
+    assert session["summary_through"] == 2
+    assert "question 0" in translator.calls[0][1]
+    assert translator.calls[1][0] == "summary of 1 batches", "The existing summary should be extended"
+    assert (await sessions.ahistory("c1")).startswith("Summary of the earlier conversation: summary of 2 batches")
+    assert sessions.stats()["condensed"] == 2
+
+@pytest.mark.asyncio
+async def test_turns_added_while_summarising_are_kept():
+    sessions = make_sessions()
+    release = asyncio.Event()
+
+    class SlowTranslator(FakeTranslator):
+        async def asummarise_history(self, summary, messages, max_words, costs=None):
+            await release.wait()
+            return await super().asummarise_history(summary, messages, max_words, costs)
+
+    translator = SlowTranslator()
+    await sessions.arecord_turn("c1", "question 0", "a long answer " * 5, translator)
+    await sessions.arecord_turn("c1", "question 1", "a long answer " * 5, translator)
+    # Lets the summarising task read the conversation before the next turn is added
+    await asyncio.sleep(0)
+    await sessions.arecord_turn("c1", "question 2", "a long answer " * 5, translator)
+    release.set()
+    await wait_for_condensing(sessions)
+
+    session = await sessions.store.aget("c1")
+    assert session["summary_through"] == 1
+    assert [turn["n"] for turn in session["turns"]] == [2, 3]
+
+@pytest.mark.asyncio
+async def test_failed_summaries_keep_the_turns():
+    sessions = make_sessions(max_turns=3)
+
+    class FailingTranslator:
+        async def asummarise_history(self, summary, messages, max_words, costs=None):
+            raise RuntimeError("rate limited")
+
+    for i in range(5):
+        await sessions.arecord_turn("c1", f"question {i}", "a long answer " * 5, FailingTranslator())
+        await wait_for_condensing(sessions)
+
+    session = await sessions.store.aget("c1")
+    assert session["summary"] == ""
+    assert [turn["n"] for turn in session["turns"]] == [3, 4, 5], "The oldest turns should be dropped past max_turns"
+    assert sessions.stats()["condense_failures"] > 0
+
+@pytest.mark.asyncio
+async def test_memory_store_expires_and_evicts_conversations():
+    store = MemorySessionStore(max_size=2, ttl_seconds=60)
+    for conversation_id in ("a", "b", "c"):
+        await store.aset(conversation_id, new_session())
+    assert await store.aget("a") is None
+    assert await store.aget("c") == new_session()
+
+    expired = MemorySessionStore(ttl_seconds=0)
+    await expired.aset("a", new_session())
+    assert await expired.aget("a") is None
+
+@pytest.mark.asyncio
+async def test_concurrent_turns_are_all_kept():
+    sessions = ConversationSessions(RedisSessionStore(FakeRedis()), tokenizer=WordTokenizer(), token_threshold=1000)
+    translator = FakeTranslator()
+    await asyncio.gather(*(sessions.arecord_turn("c1", f"question {i}", "answer", translator) for i in range(5)))
+
+    session = await sessions.store.aget("c1")
+    assert [turn["n"] for turn in session["turns"]] == [1, 2, 3, 4, 5]
+    assert sorted(turn["user"] for turn in session["turns"]) == [f"question {i}" for i in range(5)]
@@ -0,0 +1,371 @@
+import asyncio
+import os
+import sys
+import time
+import pytest
+from redis.exceptions import LockError
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from rag_backend.single_flight import SingleFlight, request_key
+
+class FakeLock:
+    def __init__(self, redis, name, timeout):
+        self.redis = redis
+        self.name = name
+        self.timeout = timeout
+
+    async def acquire(self):
+        owner, expires_at = self.redis.locks.get(self.name, (None, 0))
+        if owner is not None and expires_at > time.monotonic():
+            return False
+        self.redis.locks[self.name] = (self, time.monotonic() + self.timeout)
+        return True
+
+    async def release(self):
+        if self.redis.locks.get(self.name, (None, 0))[0] is not self:
+            raise LockError("Cannot release a lock that's no longer owned")
+        del self.redis.locks[self.name]
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.calls = []
+
+    def xadd(self, *args):
+        self.calls.append(self.redis.xadd(*args))
+
+    def expire(self, *args):
+        self.calls.append(self.redis.expire(*args))
+
+    async def execute(self):
+        return [await call for call in self.calls]
+
+class FakeRedis:
+    """
+    The part of redis.asyncio SingleFlight uses, shared by SingleFlight instances standing in for separate workers
+    """
+    def __init__(self):
+        self.values = {}
+        self.streams = {}
+        self.locks = {}
+        self._changed = asyncio.Event()
+
+    def lock(self, name, timeout, blocking):
+        return FakeLock(self, name, timeout)
+
+    def pipeline(self, transaction=False):
+        return FakePipeline(self)
+
+    async def get(self, key):
+        return self.values.get(key)
+
+    async def set(self, key, value, ex=None):
+        self.values[key] = value.encode("utf-8")
+
+    async def exists(self, key):
+        return int(key in self.values or key in self.streams)
+
+    async def delete(self, key):
+        self.values.pop(key, None)
+        self.streams.pop(key, None)
+
+    async def xadd(self, key, fields):
+        entries = self.streams.setdefault(key, [])
+        entries.append((str(len(entries) + 1), {name.encode("utf-8"): value.encode("utf-8") for name, value in fields.items()}))
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def expire(self, key, ttl):
+        pass
+
+    async def xrevrange(self, key, count):
+        return list(reversed(self.streams.get(key, [])))[:count]
+
+    async def xread(self, streams, block):
+        (key, last_id), = streams.items()
+        try:
+            while True:
+                entries = [entry for entry in self.streams.get(key, []) if int(entry[0]) > int(last_id)]
+                if entries:
+                    return [[key, entries]]
+                await asyncio.wait_for(self._changed.wait(), timeout=block / 1000)
+        except asyncio.TimeoutError:
+            return []
+
+def test_request_key_normalises_the_question():
+    assert request_key("How do I  sleep better?", "model") == request_key(" how do i sleep better? ", "model")
+    assert request_key("How do I sleep better?", "model") != request_key("How do I sleep better?", "other model")
+
+@pytest.mark.asyncio
+async def test_concurrent_identical_requests_share_one_computation():
+    single_flight = SingleFlight()
+    calls = 0
+
+    async def answer():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        return {"answer": "Get morning sunlight"}
+
+    results = await asyncio.gather(*(single_flight.run("key", answer) for _ in range(5)))
+    assert calls == 1
+    assert [computed for _, computed in results] == [True, False, False, False, False]
+    assert all(result == {"answer": "Get morning sunlight"} for result, _ in results)
+    await single_flight.run("key", answer)
+    assert calls == 2, "Finished requests shouldn't be reused, that's the answer cache's job"
+
+@pytest.mark.asyncio
+async def test_errors_are_not_shared_and_the_computation_survives_its_first_caller():
+    single_flight = SingleFlight()
+    release = asyncio.Event()
+    calls = 0
+
+    async def answer():
+        nonlocal calls
+        calls += 1
+        await release.wait()
+        if calls == 1:
+            raise ValueError("upstream failure")
+        return {"answer": "Get morning sunlight"}
+
+    first = asyncio.create_task(single_flight.run("key", answer))
+    second = asyncio.create_task(single_flight.run("key", answer))
+    await asyncio.sleep(0)
+    first.cancel()
+    release.set()
+    assert await second == ({"answer": "Get morning sunlight"}, True), "The follower should compute its own answer"
+    assert calls == 2
+
+@pytest.mark.asyncio
+async def test_failed_followers_retry_with_one_more_computation():
+    single_flight = SingleFlight()
+    calls = 0
+
+    async def answer():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        if calls == 1:
+            raise ValueError("rate limited")
+        return {"answer": "Get morning sunlight"}
+
+    leader, *followers = await asyncio.gather(*(single_flight.run("key", answer) for _ in range(6)), return_exceptions=True)
+    assert isinstance(leader, ValueError)
+    assert calls == 2, "The followers should share one retry rather than each compute their own"
+    assert all(result == {"answer": "Get morning sunlight"} for result, _ in followers)
+    assert [computed for _, computed in followers].count(True) == 1
+
+@pytest.mark.asyncio
+async def test_a_failed_retry_is_passed_on():
+    single_flight = SingleFlight()
+    calls = 0
+
+    async def failing():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        raise ValueError("rate limited")
+
+    results = await asyncio.gather(*(single_flight.run("key", failing) for _ in range(6)), return_exceptions=True)
+    assert calls == 2
+    assert all(isinstance(result, ValueError) for result in results)
+    assert single_flight.stats()["in_flight"] == 0
+
+@pytest.mark.asyncio
+async def test_failed_stream_followers_retry_with_one_more_computation():
+    single_flight = SingleFlight()
+    calls = 0
+
+    async def events():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        if calls == 1:
+            raise ValueError("rate limited")
+        yield ("token", "Hello")
+
+    async def consume():
+        return [event async for event in single_flight.stream("key", events)]
+
+    leader, *followers = await asyncio.gather(*(consume() for _ in range(6)), return_exceptions=True)
+    assert isinstance(leader, ValueError)
+    assert calls == 2
+    assert followers == [[("token", "Hello")]] * 5
+
+@pytest.mark.asyncio
+async def test_late_stream_subscribers_get_the_events_they_missed():
+    single_flight = SingleFlight()
+    calls = 0
+    second_joined = asyncio.Event()
+
+    async def events():
+        nonlocal calls
+        calls += 1
+        yield ("sources", [])
+        await second_joined.wait()
+        yield ("token", "Hello")
+        yield ("costs", {"total_cost": 0.01})
+
+    async def consume(join=None):
+        received = []
+        async for event in single_flight.stream("key", events):
+            received.append(event)
+            if join is not None:
+                join.set()
+        return received
+
+    first = asyncio.create_task(consume())
+    await asyncio.sleep(0)
+    second = asyncio.create_task(consume(join=second_joined))
+    assert await first == await second == [("sources", []), ("token", "Hello"), ("costs", {"total_cost": 0.01})]
+    assert calls == 1
+
+@pytest.mark.asyncio
+async def test_stream_is_cancelled_once_every_subscriber_has_gone():
+    single_flight = SingleFlight()
+    cancelled = asyncio.Event()
+
+    async def events():
+        try:
+            yield ("sources", [])
+            await asyncio.sleep(10)
+        finally:
+            cancelled.set()
+
+    stream = single_flight.stream("key", events)
+    assert await stream.__anext__() == ("sources", [])
+    await stream.aclose()
+    await asyncio.wait_for(cancelled.wait(), timeout=1)
+    assert single_flight.stats()["in_flight"] == 0
+
+@pytest.mark.asyncio
+async def test_workers_wait_on_the_lease_and_share_the_result():
+    redis = FakeRedis()
+    workers = [SingleFlight(redis, lease_seconds=5, poll_interval=0.01) for _ in range(2)]
+    release = asyncio.Event()
+    calls = 0
+
+    async def answer():
+        nonlocal calls
+        calls += 1
+        await release.wait()
+        return {"answer": "Get morning sunlight"}
+
+    first = asyncio.create_task(workers[0].run("key", answer))
+    await asyncio.sleep(0.02)
+    second = asyncio.create_task(workers[1].run("key", answer))
+    await asyncio.sleep(0.05)
+    assert not second.done(), "The second worker should wait for the lease holder"
+    release.set()
+    assert await first == ({"answer": "Get morning sunlight"}, True)
+    assert await second == ({"answer": "Get morning sunlight"}, False)
+    assert calls == 1
+    assert workers[1].stats()["shared_coalesced"] == 1
+    assert not redis.locks, "The lease should be released"
+
+@pytest.mark.asyncio
+async def test_workers_compute_themselves_when_the_lease_holder_fails():
+    redis = FakeRedis()
+    workers = [SingleFlight(redis, lease_seconds=5, poll_interval=0.01) for _ in range(2)]
+    release = asyncio.Event()
+
+    async def failing():
+        await release.wait()
+        raise ValueError("invalid API key")
+
+    async def answer():
+        return {"answer": "Get morning sunlight"}
+
+    first = asyncio.create_task(workers[0].run("key", failing))
+    await asyncio.sleep(0.02)
+    second = asyncio.create_task(workers[1].run("key", answer))
+    await asyncio.sleep(0.02)
+    release.set()
+    with pytest.raises(ValueError):
+        await first
+    assert await second == ({"answer": "Get morning sunlight"}, True)
+
+@pytest.mark.asyncio
+async def test_other_workers_follow_the_stream():
+    redis = FakeRedis()
+    workers = [SingleFlight(redis, lease_seconds=5, poll_interval=0.01) for _ in range(2)]
+    release = asyncio.Event()
+    calls = 0
+
+    async def events():
+        nonlocal calls
+        calls += 1
+        yield ("sources", [])
+        await release.wait()
+        yield ("token", "Hello")
+
+    async def consume(worker):
+        return [event async for event in worker.stream("key", events)]
+
+    first = asyncio.create_task(consume(workers[0]))
+    await asyncio.sleep(0.02)
+    second = asyncio.create_task(consume(workers[1]))
+    await asyncio.sleep(0.02)
+    release.set()
+    assert await first == await second == [("sources", []), ("token", "Hello")]
+    assert calls == 1
+    assert workers[1].stats()["shared_coalesced"] == 1
+
+@pytest.mark.asyncio
+async def test_stream_followers_compute_themselves_when_the_leader_fails_early():
+    redis = FakeRedis()
+    workers = [SingleFlight(redis, lease_seconds=5, poll_interval=0.01) for _ in range(2)]
+    release = asyncio.Event()
+
+    calls = 0
+
+    async def failing():
+        await release.wait()
+        raise ValueError("rate limited")
+        yield
+
+    async def events():
+        nonlocal calls
+        calls += 1
+        yield ("token", "Hello")
+
+    async def consume(worker, factory):
+        return [event async for event in worker.stream("key", factory)]
+
+    first = asyncio.create_task(consume(workers[0], failing))
+    await asyncio.sleep(0.02)
+    followers = [asyncio.create_task(consume(workers[1], events)) for _ in range(3)]
+    await asyncio.sleep(0.02)
+    release.set()
+    with pytest.raises(ValueError):
+        await first
+    assert await asyncio.gather(*followers) == [[("token", "Hello")]] * 3, "The followers shouldn't get the leader's error"
+    assert calls == 1, "The followers should share one retry"
+
+@pytest.mark.asyncio
+async def test_stream_followers_are_told_when_the_answer_stops_midway():
+    redis = FakeRedis()
+    workers = [SingleFlight(redis, lease_seconds=5, poll_interval=0.01) for _ in range(2)]
+    release = asyncio.Event()
+
+    async def failing():
+        yield ("sources", [])
+        await release.wait()
+        raise ValueError("rate limited")
+
+    received = []
+
+    async def consume(worker):
+        async for event in worker.stream("key", failing):
+            received.append(event)
+
+    first = asyncio.create_task(consume(workers[0]))
+    await asyncio.sleep(0.02)
+    second = asyncio.create_task(consume(workers[1]))
+    await asyncio.sleep(0.02)
+    release.set()
+    with pytest.raises(ValueError):
+        await first
+    with pytest.raises(RuntimeError, match="stopped before finishing"):
+        await second
+    assert received == [("sources", []), ("sources", [])]
@@ -0,0 +1,34 @@
+import os
+import re
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from rag_backend.thinking_filter import ThinkingStripper
+
+sample_completion = "<thinking>Plan the answer using the hippocampus splits</thinking>The hippocampus is key for memory.<thinking>second</thinking> Sources: <https://www.youtube.com/watch?v=123>"
+
+def strip_in_chunks(text, size):
+    stripper = ThinkingStripper()
+    out = [stripper.feed(text[i:i + size]) for i in range(0, len(text), size)]
+    out.append(stripper.flush())
+    return "".join(out)
+
+def test_matches_regex_for_every_chunk_size():
+    expected = re.sub(r'<thinking>.*?</thinking>', '', sample_completion, flags=re.DOTALL)
+    for size in range(1, len(sample_completion) + 1):
+        assert strip_in_chunks(sample_completion, size) == expected, f"Chunk size {size} should give the same result as the regex"
+
+def test_visible_text_is_not_held_back():
+    stripper = ThinkingStripper()
+    assert stripper.feed("<think") == "", "A possible partial tag should be held back"
+    assert stripper.feed("ing>hidden</thinking>Hello") == "Hello", "Text after the thinking block should be emitted immediately"
+
+def test_partial_tag_that_never_completes_is_plain_text():
+    stripper = ThinkingStripper()
+    assert stripper.feed("a < b and <thin") == "a < b and "
+    assert stripper.flush() == "<thin", "An incomplete tag at the end of the stream should be emitted as text"
+
+def test_unclosed_thinking_block_is_dropped():
+    stripper = ThinkingStripper()
+    assert stripper.feed("Answer<thinking>never closed") == "Answer"
+    assert stripper.flush() == ""
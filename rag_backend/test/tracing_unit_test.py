@@ -0,0 +1,55 @@
+import asyncio
+import json
+import os
+import sys
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from rag_backend.tracing import JsonlSink, RequestTrace, trace_span
+
+def test_spans_are_recorded_with_attributes_in_start_order():
+    trace = RequestTrace(request_id="req")
+    with trace.span("routing", model="gpt-4o-mini") as span:
+        span.set(input_tokens=10)
+    with trace_span(trace, "generation"):
+        pass
+    result = trace.as_dict()
+    assert result["request_id"] == "req"
+    assert [s["name"] for s in result["spans"]] == ["routing", "generation"]
+    assert result["spans"][0]["input_tokens"] == 10 and result["spans"][0]["model"] == "gpt-4o-mini"
+    assert result["spans"][1]["start_ms"] >= result["spans"][0]["start_ms"]
+
+def test_failed_span_records_the_error():
+    trace = RequestTrace()
+    with pytest.raises(ValueError):
+        with trace.span("vector_search"):
+            raise ValueError("boom")
+    assert trace.as_dict()["spans"][0]["error"] == "ValueError"
+
+@pytest.mark.asyncio
+async def test_cancelled_span_is_recorded():
+    trace = RequestTrace()
+    async def branch():
+        with trace.span("direct"):
+            await asyncio.sleep(10)
+    task = asyncio.create_task(branch())
+    await asyncio.sleep(0)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    assert trace.as_dict()["spans"][0]["error"] == "CancelledError"
+
+def test_no_trace_span_is_discarded():
+    with trace_span(None, "embedding") as span:
+        span.set(misses=1)
+
+def test_sink_appends_one_json_line_per_trace(tmp_path):
+    path = tmp_path / "traces.jsonl"
+    sink = JsonlSink(str(path))
+    for request_id in ("a", "b"):
+        trace = RequestTrace(request_id=request_id)
+        trace.finish()
+        sink.write(trace.as_dict())
+    sink.flush()
+    lines = path.read_text().splitlines()
+    assert [json.loads(line)["request_id"] for line in lines] == ["a", "b"]
@@ -0,0 +1,69 @@
+OPEN_TAG = "<thinking>"
+CLOSE_TAG = "</thinking>"
+
+'''
+Returns the length of the longest suffix of text which is a proper prefix of tag,
+i.e. how much of the text could still turn out to be the start of the tag
+'''
+def _partial_tag_length(text, tag):
+    for length in range(min(len(text), len(tag) - 1), 0, -1):
+        if text.endswith(tag[:length]):
+            return length
+    return 0
+
+class ThinkingStripper:
+    """
+    Incremental parser which removes <thinking>...</thinking> blocks from streamed text.
+    Matches re.sub(r'<thinking>.*?</thinking>', '', text, flags=re.DOTALL) over the full completion for
+    closed blocks, but works chunk by chunk, holding back only text that might be part of a split tag.
+    Unlike the regex, an unclosed <thinking> block is dropped up to the end of the stream, since its
+    content can't be shown before knowing whether the block closes.
+    """
+    def __init__(self):
+        self._buffer = ""
+        self._inside = False
+
+    '''
+    Feeds the next chunk of streamed text
+
+    Parameters:
+    - chunk: The next piece of text from the LLM
+
+    Returns:
+    - The text which is safe to show to the user, may be empty
+    '''
+    def feed(self, chunk):
+        self._buffer += chunk
+        visible = []
+        while self._buffer:
+            if not self._inside:
+                idx = self._buffer.find(OPEN_TAG)
+                if idx >= 0:
+                    visible.append(self._buffer[:idx])
+                    self._buffer = self._buffer[idx + len(OPEN_TAG):]
+                    self._inside = True
+                    continue
+                held = _partial_tag_length(self._buffer, OPEN_TAG)
+                visible.append(self._buffer[:len(self._buffer) - held])
+                self._buffer = self._buffer[len(self._buffer) - held:]
+            else:
+                idx = self._buffer.find(CLOSE_TAG)
+                if idx >= 0:
+                    self._buffer = self._buffer[idx + len(CLOSE_TAG):]
+                    self._inside = False
+                    continue
+                # Thinking content is dropped, only keep what could be the start of the closing tag
+                held = _partial_tag_length(self._buffer, CLOSE_TAG)
+                self._buffer = self._buffer[len(self._buffer) - held:]
+            break
+        return "".join(visible)
+
+    '''
+    Flushes any held back text once the stream has finished. A dangling partial opening tag is
+    plain text at this point, an unclosed thinking block is dropped.
+    '''
+    def flush(self):
+        remaining = "" if self._inside else self._buffer
+        self._buffer = ""
+        self._inside = False
+        return remaining
@@ -0,0 +1,177 @@
+import json
+import os
+import queue
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+try:
+    from .metrics import record_trace
+    from .logger import logger as logger
+except ImportError:
+    from metrics import record_trace
+    from logger import logger as logger
+
+# Traces are appended to this JSONL file for offline analysis, nothing is exported when it isn't set
+TRACE_LOG_PATH = os.getenv("TRACE_LOG_PATH")
+TRACE_SINK_QUEUE_SIZE = int(os.getenv("TRACE_SINK_QUEUE_SIZE", "1000"))
+
+class Span:
+    """
+    A timed stage of a request, with attributes such as token counts and cache hits
+    """
+    def __init__(self, name, start, attributes=None):
+        self.name = name
+        self.start = start
+        self.end = None
+        self.attributes = dict(attributes or {})
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    @property
+    def duration(self):
+        return (self.end if self.end is not None else time.perf_counter()) - self.start
+
+class RequestTrace:
+    """
+    Spans recorded over a single request. Created per request alongside RequestCosts and passed down through
+    RAGEngine, QueryTranslator and the retriever, so concurrent requests on a pooled engine never share one.
+    Spans may overlap, the retrieval branches run concurrently.
+
+    Parameters:
+    - request_id: The identifier reported with the trace, a random one is generated if not given
+    """
+    def __init__(self, request_id=None):
+        self.request_id = request_id or uuid.uuid4().hex
+        self.started_at = time.time()
+        self._start = time.perf_counter()
+        self._end = None
+        self.spans = []
+        self.attributes = {}
+
+    '''
+    Times the enclosed block as a span, the span is yielded so attributes can be added as they become known.
+    The span is recorded even if the block raises or is cancelled, with the error noted.
+    '''
+    @contextmanager
+    def span(self, name, **attributes):
+        span = Span(name, time.perf_counter(), attributes)
+        self.spans.append(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.set(error=type(e).__name__)
+            raise
+        finally:
+            span.end = time.perf_counter()
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def finish(self):
+        if self._end is None:
+            self._end = time.perf_counter()
+
+    @property
+    def duration(self):
+        return (self._end if self._end is not None else time.perf_counter()) - self._start
+
+    '''
+    Returns the trace in the shape used by the API response and the JSONL sink, times in milliseconds
+    relative to the start of the request
+    '''
+    def as_dict(self):
+        end = self._end if self._end is not None else time.perf_counter()
+        return {
+            "request_id": self.request_id,
+            "started_at": self.started_at,
+            "duration_ms": round((end - self._start) * 1000, 2),
+            **self.attributes,
+            "spans": [
+                {
+                    "name": span.name,
+                    "start_ms": round((span.start - self._start) * 1000, 2),
+                    "duration_ms": round(span.duration * 1000, 2),
+                    **span.attributes
+                }
+                for span in sorted(self.spans, key=lambda span: span.start)
+            ]
+        }
+
+'''
+Returns trace.span(name) when there is a trace, otherwise a span which is discarded.
+Lets helpers take an optional trace without branching on it, the same way they take optional costs.
+'''
+@contextmanager
+def trace_span(trace, name, **attributes):
+    if trace is None:
+        yield Span(name, time.perf_counter(), attributes)
+    else:
+        with trace.span(name, **attributes) as span:
+            yield span
+
+class JsonlSink:
+    """
+    Appends records to a JSONL file from a background thread, so requests never wait on disk.
+    When the queue is full records are dropped and counted rather than blocking the request.
+    Used for traces, and for anything else logged per request for offline analysis.
+
+    Parameters:
+    - path: The file to append to
+    - max_queue: The number of records allowed to wait for the writer
+    """
+    def __init__(self, path, max_queue=TRACE_SINK_QUEUE_SIZE):
+        self.path = path
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = threading.Thread(target=self._write_loop, name=f"rag-sink-{os.path.basename(path)}", daemon=True)
+        self._thread.start()
+
+    def write(self, record):
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    '''
+    Blocks until every queued record has been written, used by tests and on shutdown
+    '''
+    def flush(self):
+        self._queue.join()
+
+    def _write_loop(self):
+        while True:
+            record = self._queue.get()
+            try:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(record, default=str) + "\n")
+            except Exception as e:
+                logger.warning(f"Failed to write record to {self.path}: {e}")
+            finally:
+                self._queue.task_done()
+
+_sink = None
+_sink_lock = threading.Lock()
+
+'''
+Returns the process-wide trace sink, or None when TRACE_LOG_PATH isn't set
+'''
+def get_trace_sink():
+    global _sink
+    if _sink is None and TRACE_LOG_PATH:
+        with _sink_lock:
+            if _sink is None:
+                _sink = JsonlSink(TRACE_LOG_PATH)
+    return _sink
+
+'''
+Finishes a trace, records its metrics (see metrics.py) and hands it to the sink, if one is configured
+'''
+def export_trace(trace):
+    trace.finish()
+    record_trace(trace)
+    sink = get_trace_sink()
+    if sink is not None:
+        sink.write(trace.as_dict())